@@ -0,0 +1,115 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Benchmark the fused pointwise scoring against the model forward pass.
+
+For each way of scoring a batch, the number of operators launched, the number of
+allocations and allocated memory, and the mean wall time are reported. Operator and allocation counts
+come from torch.profiler and are the same from run to run, unlike the timings.
+
+    python benchmarks/bench_pointwise.py --batch-size 4096 --candidates 100
+"""
+import argparse
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from youchoose.extraction.nn_latent_matrix_factorization import NNMatrixFactorization
+from youchoose.interaction.pointwise import FoldedScorer
+
+
+def count_ops(fn) -> dict:
+    """
+    Count the top level operators, the gpu kernels, and the allocations of one
+    call.
+    """
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+
+    with torch.no_grad(), profile(activities=activities, profile_memory=True) as prof:
+        fn()
+
+    events = prof.events()
+    kernels = [e for e in events if e.device_type == torch.autograd.DeviceType.CUDA]
+
+    return {
+        "ops": sum(1 for e in events if e.cpu_parent is None and e.name != "[memory]"),
+        "kernels": len(kernels),
+        "allocations": sum(1 for e in events if e.self_cpu_memory_usage > 0),
+        "allocated_mb": sum(max(e.self_cpu_memory_usage, 0) for e in events) / 2**20,
+    }
+
+
+def time_call(fn, repeat: int = 200, warmup: int = 20) -> float:
+    """
+    Mean wall time of a call in microseconds.
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    return 1e6 * (time.perf_counter() - start) / repeat
+
+
+def cases(n_users: int, n_items: int, n_factors: int, batch_size: int, n_cand: int):
+    """
+    The scoring functions to compare, keyed by name.
+    """
+    model = NNMatrixFactorization(n_users, n_items, n_factors=n_factors).eval()
+    scorer = FoldedScorer.from_model(model)
+
+    user = torch.randint(0, n_users, (batch_size,))
+    item = torch.randint(0, n_items, (batch_size,))
+    candidates = torch.randint(0, n_items, (batch_size, n_cand))
+    repeated = user.unsqueeze(1).repeat(1, n_cand)
+
+    return {
+        "pairs: forward": lambda: model(user, item),
+        "pairs: folded": lambda: scorer.pairs(user, item),
+        "candidates: repeated forward": lambda: model(repeated, candidates),
+        "candidates: bmm": lambda: model.score_candidates(user, candidates),
+        "candidates: folded bmm": lambda: scorer.candidates(user, candidates),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--n-users", type=int, default=100000)
+    parser.add_argument("--n-items", type=int, default=50000)
+    parser.add_argument("--n-factors", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--candidates", type=int, default=100)
+    args = parser.parse_args(args)
+
+    results = {}
+    for name, fn in cases(
+        args.n_users, args.n_items, args.n_factors, args.batch_size, args.candidates
+    ).items():
+        results[name] = dict(count_ops(fn), time_us=time_call(fn))
+
+    print(
+        f"{'case':<30}{'ops':>6}{'kernels':>9}{'allocs':>8}{'MB':>8}{'time (us)':>12}"
+    )
+    for name, result in results.items():
+        print(
+            f"{name:<30}{result['ops']:>6}{result['kernels']:>9}"
+            f"{result['allocations']:>8}{result['allocated_mb']:>8.1f}"
+            f"{result['time_us']:>12.0f}"
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Measure the accuracy, memory, and speed of the lower precision embeddings.
+
+The nn recommender is trained on synthetic instacart data with its embeddings
+stored in each dtype, reporting the memory of the parameters and the optimizer
+state, the training time, and the held out ranking metrics. The float32 model is
+then served from tables in each inference dtype, reporting the memory of the
+tables, the time to recommend the top k of every user, the held out metrics of
+the served tables, and the overlap of their top k with the float32 top k.
+
+    python benchmarks/bench_precision.py --interactions 1000000 --factors 128
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from youchoose.data.example_datasets.synthetic_dataset import synthetic_instacart
+from youchoose.recommender.matrix_factorization import MatrixFactorization
+
+
+def model_bytes(model) -> int:
+    """
+    Memory of the parameters and the tensors of the optimizer state.
+    """
+    tensors = list(model.parameters()) + [
+        value
+        for state in model.optimizer.state.values()
+        for value in state.values()
+        if torch.is_tensor(value)
+    ]
+
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def table_bytes(tables) -> int:
+    """
+    Memory of the user and item tables used for scoring.
+    """
+    tensors = [
+        tensor
+        for table in tables
+        for tensor in (
+            table.buffers() if isinstance(table, torch.nn.Module) else [table]
+        )
+    ]
+
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def overlap(top: np.ndarray, reference: np.ndarray) -> float:
+    """
+    Mean fraction of the reference top k also in the top k of each user.
+    """
+    hits = sum(len(np.intersect1d(a, b)) for a, b in zip(top, reference))
+
+    return hits / reference.size
+
+
+def train(df, dtype: str, args) -> tuple:
+    np.random.seed(0)
+    torch.manual_seed(0)
+    recommender = MatrixFactorization(
+        "nn",
+        df,
+        item_col="product_id",
+        embedding_dimension=args.factors,
+        epochs=args.epochs,
+        optimizer=args.optimizer,
+        lr=args.lr,
+        dtype=dtype,
+    )
+    start = time.perf_counter()
+    recommender.train()
+    seconds = (time.perf_counter() - start) / args.epochs
+
+    return recommender, seconds
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--interactions", type=int, default=10**6)
+    parser.add_argument("--factors", type=int, default=64)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--optimizer", default="sgd")
+    parser.add_argument("--lr", type=float, default=5.0)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--dtypes", nargs="+", default=["float32", "bfloat16", "float16"]
+    )
+    parser.add_argument(
+        "--inference-dtypes",
+        nargs="+",
+        default=["float32", "bfloat16", "float16", "int8"],
+    )
+    args = parser.parse_args(args)
+
+    df = synthetic_instacart(args.interactions)
+    recall, ndcg = "recall@{}".format(args.k), "ndcg@{}".format(args.k)
+    results = {"training": {}, "inference": {}}
+
+    print(
+        f"{'storage':>10}{'model MB':>10}{'s/epoch':>9}{'auc':>8}{recall:>11}{ndcg:>9}"
+    )
+    reference = None
+    for dtype in args.dtypes:
+        recommender, seconds = train(df, dtype, args)
+        metrics = recommender.evaluate(k=args.k)
+        result = dict(
+            metrics, model_mb=model_bytes(recommender.model) / 2**20, seconds=seconds
+        )
+        results["training"][dtype] = result
+        print(
+            f"{dtype:>10}{result['model_mb']:>10.1f}{seconds:>9.2f}"
+            f"{result['auc']:>8.4f}{result[recall]:>11.4f}{result[ndcg]:>9.4f}"
+        )
+        if dtype == "float32":
+            reference = recommender
+
+    if reference is None:
+        return results
+
+    model = reference.model
+    print(
+        f"\n{'inference':>10}{'tables MB':>10}{'top k s':>9}{'auc':>8}{recall:>11}"
+        f"{ndcg:>9}{'overlap':>9}"
+    )
+    float_top = None
+    for dtype in args.inference_dtypes:
+        model.quantize(dtype)
+        tables = model.inference_tables
+
+        with torch.no_grad():
+            model.recommend_top(k=args.k, exclude=reference.train_items)
+            start = time.perf_counter()
+            top, _ = model.recommend_top(k=args.k, exclude=reference.train_items)
+            seconds = time.perf_counter() - start
+        top = top.numpy()
+        if float_top is None:
+            float_top = top
+
+        metrics = reference.evaluate(k=args.k)
+        result = dict(
+            metrics,
+            tables_mb=table_bytes(tables) / 2**20,
+            seconds=seconds,
+            overlap=overlap(top, float_top),
+        )
+        results["inference"][dtype] = result
+        print(
+            f"{dtype:>10}{result['tables_mb']:>10.1f}{seconds:>9.2f}"
+            f"{result['auc']:>8.4f}{result[recall]:>11.4f}{result[ndcg]:>9.4f}"
+            f"{result['overlap']:>9.3f}"
+        )
+    model.quantize(None)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Load test the micro batching inference server on localhost.
+
+Concurrent clients send top k requests over keep-alive connections for each
+batching configuration, and the latency percentiles and requests per second
+seen by the clients are reported with the server's mean batch size. A max wait
+of 0 with a max batch size of 1 scores every request on its own.
+
+    python benchmarks/bench_server.py --checkpoint model_dir --clients 64
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from youchoose.data.example_datasets.synthetic_dataset import synthetic_instacart
+from youchoose.recommender.deploy import InferenceServer
+from youchoose.recommender.matrix_factorization import MatrixFactorization
+
+
+def build_recommender(checkpoint: str = None, n_interactions: int = 10**6):
+    """
+    Load a saved recommender, or train ALS on synthetic instacart data.
+    """
+    if checkpoint:
+        return MatrixFactorization.load(checkpoint, mmap_mode="r")
+
+    recommender = MatrixFactorization(
+        "als",
+        synthetic_instacart(n_interactions),
+        item_col="product_id",
+        embedding_dimension=32,
+        epochs=2,
+    )
+    recommender.train()
+
+    return recommender
+
+
+async def _request(reader, writer, path: str):
+    writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode())
+    await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b"\r\n":
+            break
+        if line.lower().startswith(b"content-length"):
+            length = int(line.split(b":")[1])
+    await reader.readexactly(length)
+
+
+async def load_test(server, users, clients: int, duration: float, k: int) -> dict:
+    """
+    Send requests from concurrent clients for the duration, in seconds.
+    """
+    await server.start()
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    async def client(seed):
+        rng = np.random.default_rng(seed)
+        reader, writer = await asyncio.open_connection(server.host, server.port)
+        while time.perf_counter() < deadline:
+            path = "/recommend?user={}&k={}".format(rng.choice(users), k)
+            start = time.perf_counter()
+            await _request(reader, writer, path)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(seed) for seed in range(clients)))
+    elapsed = time.perf_counter() - start
+    stats = server.stats()
+    await server.stop()
+
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "qps": len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_batch_size": stats["mean_batch_size"],
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--checkpoint", help="A recommender saved with save.")
+    parser.add_argument("--interactions", type=int, default=10**6)
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--max-batch-size", type=int, nargs="+", default=[1, 256])
+    parser.add_argument("--max-wait-ms", type=float, nargs="+", default=[0.0, 2.0])
+    args = parser.parse_args(args)
+
+    recommender = build_recommender(args.checkpoint, args.interactions)
+    users = recommender.user_vocab.ids
+
+    print(
+        f"{'max batch':>10}{'max wait':>10}{'qps':>10}{'p50 ms':>9}{'p99 ms':>9}"
+        f"{'batch':>8}"
+    )
+    results = {}
+    for max_batch_size in args.max_batch_size:
+        for max_wait_ms in args.max_wait_ms:
+            server = InferenceServer(
+                recommender,
+                port=0,
+                max_batch_size=max_batch_size,
+                max_wait_ms=max_wait_ms,
+            )
+            result = asyncio.run(
+                load_test(server, users, args.clients, args.duration, args.k)
+            )
+            results[(max_batch_size, max_wait_ms)] = result
+            print(
+                f"{max_batch_size:>10}{max_wait_ms:>10.1f}{result['qps']:>10.0f}"
+                f"{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+                f"{result['mean_batch_size']:>8.1f}"
+            )
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Benchmark the data -> train -> recommend pipeline.
+
+Every benchmark runs on each dataset in a forked process, so the peak memory of
+one benchmark is not hidden by another. The setup of a benchmark is not timed.
+The timed call is repeated and the minimum and median wall times, the
+throughput in rows per second, and the peak resident memory above the level
+before the run are recorded.
+
+Results are written as json, and comparing against an earlier results file
+flags every benchmark that got slower or used more memory than the threshold
+allows, exiting with status 1 so regressions fail CI.
+
+    python benchmarks/run_benchmarks.py --datasets movielens synthetic-1m \\
+        --output results.json --compare baseline.json
+"""
+import argparse
+import json
+import multiprocessing as mp
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+
+from youchoose.data.data_loading import InteractionsDataset
+from youchoose.data.data_processing import (
+    dataframe_split,
+    item_sets,
+    transform_data_ids,
+)
+from youchoose.data.example_datasets.synthetic_dataset import synthetic_instacart
+from youchoose.extraction.nn_latent_matrix_factorization import NNMatrixFactorization
+
+ROOT = Path(__file__).resolve().parents[1]
+MOVIELENS = ROOT / "data" / "ml-latest-small" / "ratings.csv"
+BATCH_SIZE = 1024
+# Set with --num-workers, the DataLoader workers of the loading benchmarks.
+NUM_WORKERS = 0
+DENSE_LIMIT = 2 * 10**8
+RECOMMEND_USERS = 10000
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str, setup=None):
+    """
+    Register a benchmark. The setup receives the dataset and returns the state
+    passed to the timed function, which returns the number of rows processed.
+    The setup may return None to skip the benchmark for that dataset.
+    """
+
+    def register(fn):
+        BENCHMARKS[name] = (setup or (lambda dataset: dataset), fn)
+        return fn
+
+    return register
+
+
+def load_dataset(name: str) -> dict:
+    """
+    Load a benchmark dataset as a dataframe with its column names.
+    """
+    if name == "movielens":
+        df = pd.read_csv(MOVIELENS, usecols=["userId", "movieId", "timestamp"])
+        df["interaction"] = np.float32(1.0)
+        df = df.rename(columns={"timestamp": "order_number"})
+        return {"df": df, "user_col": "userId", "item_col": "movieId"}
+
+    if name.startswith("synthetic-"):
+        size = name.split("-", 1)[1].lower()
+        n_interactions = int(
+            float(size.rstrip("mk")) * (10**6 if "m" in size else 10**3)
+        )
+        return {
+            "df": synthetic_instacart(n_interactions),
+            "user_col": "user_id",
+            "item_col": "product_id",
+        }
+
+    raise ValueError("Unknown dataset {}.".format(name))
+
+
+def _columns(dataset: dict) -> dict:
+    return {
+        "user_col": dataset["user_col"],
+        "item_col": dataset["item_col"],
+        "weight_col": "interaction",
+    }
+
+
+def _indexed(dataset: dict) -> dict:
+    df, user_dict, item_dict = transform_data_ids(
+        dataset["df"].copy(), **_columns(dataset)
+    )
+    return dict(dataset, df=df, n_users=len(user_dict), n_items=len(item_dict))
+
+
+def _train_loader(dataset: dict) -> dict:
+    dataset = _indexed(dataset)
+    loader_list, n_users, n_items = InteractionsDataset.ratings_dataloader(
+        dataset["df"],
+        batch_size=BATCH_SIZE,
+        num_negs=1,
+        num_workers=NUM_WORKERS,
+        **_columns(dataset)
+    )
+    return dict(dataset, loader=loader_list[0])
+
+
+def _model(dataset: dict) -> dict:
+    dataset = _train_loader(dataset)
+    torch.manual_seed(23)
+    model = NNMatrixFactorization(dataset["n_users"], dataset["n_items"], lr=1.0)
+    return dict(dataset, model=model)
+
+
+def _dense_model(dataset: dict) -> dict:
+    dataset = _indexed(dataset)
+    if dataset["n_users"] * dataset["n_items"] > DENSE_LIMIT:
+        return None
+    model = NNMatrixFactorization(dataset["n_users"], dataset["n_items"])
+    return dict(dataset, model=model)
+
+
+def _recommend_model(dataset: dict) -> dict:
+    dataset = _indexed(dataset)
+    model = NNMatrixFactorization(dataset["n_users"], dataset["n_items"])
+    return dict(dataset, model=model)
+
+
+@benchmark("transform_data_ids", setup=lambda dataset: dict(dataset))
+def bench_transform_data_ids(dataset):
+    transform_data_ids(dataset["df"].copy(), **_columns(dataset))
+    return len(dataset["df"])
+
+
+@benchmark("item_sets", setup=_indexed)
+def bench_item_sets(dataset):
+    item_sets(dataset["df"], dataset["user_col"], dataset["item_col"], compact=True)
+    return len(dataset["df"])
+
+
+@benchmark("dataframe_split", setup=_indexed)
+def bench_dataframe_split(dataset):
+    dataframe_split(dataset["df"], 0.8, 0.1, user_col=dataset["user_col"])
+    return len(dataset["df"])
+
+
+@benchmark("dataloader_epoch", setup=_train_loader)
+def bench_dataloader_epoch(dataset):
+    rows = 0
+    for user, item, rating in dataset["loader"]:
+        rows += len(user)
+    return rows
+
+
+@benchmark("train_model_epoch", setup=_model)
+def bench_train_model_epoch(dataset):
+    dataset["model"].train_model(dataset["loader"])
+    return dataset["model"].train_stats["samples"]
+
+
+@benchmark("create_user_item_array", setup=_dense_model)
+def bench_create_user_item_array(dataset):
+    dataset["model"].create_user_item_array()
+    return dataset["n_users"] * dataset["n_items"]
+
+
+@benchmark("recommend_top", setup=_recommend_model)
+def bench_recommend_top(dataset):
+    users = np.arange(min(dataset["n_users"], RECOMMEND_USERS))
+    dataset["model"].recommend_top(k=10, users=users)
+    return len(users)
+
+
+def _memory_mb(field: str) -> float:
+    """
+    Resident memory of this process in MB, VmRSS for the current level or VmHWM
+    for the peak. Outside Linux only the peak is available, from getrusage.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f)
+        return float(status[field].split()[0]) / 1024
+    except OSError:
+        if field == "VmRSS":
+            return 0.0
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale / 1024
+
+
+def _reset_peak():
+    """
+    Reset the peak resident memory to the current level where Linux allows it.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _run_child(name, dataset, repeat, conn):
+    try:
+        setup, fn = BENCHMARKS[name]
+        state = setup(dataset)
+        if state is None:
+            conn.send({"skipped": True})
+            return
+
+        _reset_peak()
+        baseline = _memory_mb("VmRSS")
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = fn(state)
+            times.append(time.perf_counter() - start)
+
+        conn.send(
+            {
+                "times": times,
+                "min": min(times),
+                "median": statistics.median(times),
+                "rows": rows,
+                "throughput": rows / min(times) if min(times) else float("inf"),
+                "peak_mb": max(_memory_mb("VmHWM") - baseline, 0.0),
+            }
+        )
+    except Exception as error:  # reported in the results rather than raised
+        conn.send({"error": repr(error)})
+    finally:
+        conn.close()
+
+
+def run(datasets, names=None, repeat: int = 3) -> dict:
+    """
+    Run the benchmarks on each dataset.
+
+    Args:
+        datasets (Sequence[str]): Dataset names, movielens or synthetic-<size>
+            such as synthetic-1m or synthetic-10m.
+        names (Sequence[str], optional): Benchmarks to run. Defaults to all.
+        repeat (int, optional): Number of timed calls. Defaults to 3.
+
+    Returns:
+        dict: The results keyed by "<dataset>/<benchmark>".
+    """
+    ctx = mp.get_context("fork")
+    results = {}
+
+    for dataset_name in datasets:
+        dataset = load_dataset(dataset_name)
+        for name in names or BENCHMARKS:
+            receiver, sender = ctx.Pipe(duplex=False)
+            process = ctx.Process(
+                target=_run_child, args=(name, dataset, repeat, sender)
+            )
+            process.start()
+            sender.close()
+            result = receiver.recv()
+            process.join()
+
+            key = "{}/{}".format(dataset_name, name)
+            results[key] = result
+            print(_format(key, result), flush=True)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float = 1.25) -> list:
+    """
+    Find the benchmarks that are slower, or use more memory, than the baseline
+    by more than the threshold ratio.
+
+    Returns:
+        list: A description of each regression.
+    """
+    regressions = []
+    for key, result in results.items():
+        before = baseline.get(key)
+        if not before or "min" not in before or "min" not in result:
+            continue
+
+        ratio = result["min"] / before["min"] if before["min"] else 1.0
+        if ratio > threshold:
+            regressions.append(
+                "{}: time {:.3f}s -> {:.3f}s ({:.2f}x)".format(
+                    key, before["min"], result["min"], ratio
+                )
+            )
+
+        # Ignore memory changes within the noise of a few MB.
+        growth = result["peak_mb"] - before["peak_mb"]
+        if growth > 16 and result["peak_mb"] > threshold * before["peak_mb"]:
+            regressions.append(
+                "{}: peak memory {:.0f}MB -> {:.0f}MB".format(
+                    key, before["peak_mb"], result["peak_mb"]
+                )
+            )
+
+    return regressions
+
+
+def _format(key: str, result: dict) -> str:
+    if result.get("skipped"):
+        return "{:<45} skipped".format(key)
+    if "error" in result:
+        return "{:<45} error {}".format(key, result["error"])
+
+    return "{:<45} {:>9.3f}s {:>14,.0f} rows/s {:>9.1f}MB".format(
+        key, result["min"], result["throughput"], result["peak_mb"]
+    )
+
+
+def _metadata() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "machine": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--datasets", nargs="+", default=["movielens", "synthetic-1m"])
+    parser.add_argument("--benchmarks", nargs="+", choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="Write the results to this json file.")
+    parser.add_argument("--compare", help="Compare against this results file.")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument(
+        "--num-workers", default=0, help='DataLoader workers, a number or "auto".'
+    )
+    args = parser.parse_args(args)
+
+    global NUM_WORKERS
+    NUM_WORKERS = (
+        args.num_workers if args.num_workers == "auto" else int(args.num_workers)
+    )
+
+    results = run(args.datasets, args.benchmarks, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": _metadata(), "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
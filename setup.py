@@ -5,11 +5,11 @@ with open("README.md", "r") as fh:
 
 install_requires = [
     "matplotlib",
-    "numpy",
-    "pandas>=0.24.2",
+    "numpy>=1.17.0",
+    "pandas>=1.3.5",
     "scikit-learn",
     "sklearn",
-    "torch>=1.1.0",
+    "torch>=1.13.0",
     "torchvision",
     "tqdm",
 ]
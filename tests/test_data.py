@@ -0,0 +1,276 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Testing of the `data` module.
+"""
+import pickle
+from multiprocessing.reduction import ForkingPickler
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from youchoose.data.data_loading import InteractionsDataset, batch_dataloader
+from youchoose.data.data_processing import (
+    IdVocabulary,
+    ItemSetIndex,
+    item_sets,
+    list_to_indexed_dict,
+    split_indices,
+    transform_data_ids,
+)
+from youchoose.data.example_datasets.synthetic_dataset import synthetic_instacart
+from youchoose.data.ingestion.csv import iter_interaction_chunks, read_interactions
+from youchoose.data.interaction_store import InteractionStore
+from youchoose.data.negative_sampling import NegativeSampler
+
+
+@pytest.fixture
+def interactions():
+    """
+    A small dataframe of user-item interactions with already indexed ids.
+    """
+    rng = np.random.RandomState(23)
+    df = pd.DataFrame(
+        {
+            "user_id": rng.randint(0, 50, size=2000),
+            "item_id": rng.randint(0, 40, size=2000),
+            "interaction": np.ones(2000),
+        }
+    )
+
+    return df.drop_duplicates(["user_id", "item_id"]).reset_index(drop=True)
+
+
+def test_negative_sampler(interactions):
+    users = interactions["user_id"].to_numpy()
+    items = interactions["item_id"].to_numpy()
+    sampler = NegativeSampler.from_interactions(users, items, 40, random_state=23)
+
+    batch_users = np.arange(50)
+    negs = sampler.sample(batch_users, 5)
+    positives = set(zip(users, items))
+
+    if not negs.shape == (50, 5):
+        raise AssertionError()
+    if any((u, i) in positives for u, row in zip(batch_users, negs) for i in row):
+        raise AssertionError()
+
+
+def test_negative_sampler_full_user():
+    sampler = NegativeSampler.from_interactions([0, 0, 0], [0, 1, 2], 3)
+
+    with pytest.raises(ValueError):
+        sampler.sample([0], 1)
+
+
+def test_batch_gather_shapes(interactions):
+    dataset = InteractionsDataset(
+        interactions, 40, weight_col="interaction", num_negs=3
+    )
+    user, item, weight = dataset[[0, 1, 2, 3]]
+
+    if not (user.shape == item.shape == weight.shape == (4, 4)):
+        raise AssertionError()
+    if not (user[:, 0] == dataset.users[:4]).all():
+        raise AssertionError()
+    if not (weight[:, 1:] == 0).all():
+        raise AssertionError()
+
+
+def test_compact_item_sets(interactions):
+    set_dict = item_sets(interactions)
+    index = item_sets(interactions, compact=True)
+
+    if not index.to_dict() == set_dict:
+        raise AssertionError()
+
+    users = interactions["user_id"].to_numpy()
+    items = (interactions["item_id"].to_numpy() + 7) % 45
+    expected = [item in set_dict[user] for user, item in zip(users, items)]
+    if not (index.contains(users, items) == expected).all():
+        raise AssertionError()
+
+
+def test_vocabulary_matches_indexed_dict():
+    ids = np.array([30, 10, 20, 10, 50])
+    vocab, codes = IdVocabulary.fit_transform(ids)
+    expected = {value: key for key, value in list_to_indexed_dict(ids).items()}
+
+    if not dict(vocab) == expected:
+        raise AssertionError()
+    if not (codes == [expected[i] for i in ids]).all():
+        raise AssertionError()
+
+
+def test_vocabulary_grow():
+    vocab = IdVocabulary.fit([10, 20])
+    codes = vocab.encode([20, 5, 10], grow=True)
+
+    if not (codes == [1, 2, 0]).all() or len(vocab) != 3:
+        raise AssertionError()
+    if not (vocab.decode(codes) == [20, 5, 10]).all():
+        raise AssertionError()
+
+    # An empty vocabulary takes the type of its first IDs.
+    vocab = IdVocabulary()
+    vocab.update([2**60 + 1, 2**60 + 3])
+    if not (vocab.ids.dtype == np.int64 and (vocab.decode([1]) == [2**60 + 3])):
+        raise AssertionError()
+    if not (vocab.encode([2**60 + 1, 2**60]) == [0, -1]).all():
+        raise AssertionError()
+
+
+def test_interaction_store(interactions, tmp_path):
+    InteractionStore.from_dataframe(str(tmp_path), interactions)
+    store = InteractionStore(str(tmp_path))
+    dataset = InteractionsDataset.from_store(store, num_negs=2)
+
+    if not (len(dataset) == len(interactions) and store.n_items == 40):
+        raise AssertionError()
+    if not (dataset.users.numpy() == interactions["user_id"].to_numpy()).all():
+        raise AssertionError()
+    if not dataset.item_sets.to_dict() == item_sets(interactions):
+        raise AssertionError()
+
+
+def test_store_index_in_chunks(interactions, tmp_path):
+    df = pd.concat([interactions, interactions.iloc[::3]])
+    store = InteractionStore.from_dataframe(str(tmp_path), df, build_index=False)
+    store.build_index(chunk_size=7)
+    index = InteractionStore(str(tmp_path)).item_sets()
+    expected = ItemSetIndex.from_arrays(
+        df["user_id"].to_numpy(), df["item_id"].to_numpy(), n_users=store.n_users
+    )
+
+    if not (
+        np.array_equal(index.indptr, expected.indptr)
+        and np.array_equal(index.indices, expected.indices)
+    ):
+        raise AssertionError()
+
+
+def test_read_interactions_csv(interactions, tmp_path):
+    filename = str(tmp_path / "ratings.csv")
+    interactions.assign(user_id=interactions["user_id"] * 3).to_csv(
+        filename, index=False
+    )
+
+    users, items, weights, user_vocab, _ = read_interactions(
+        filename, weight_col="interaction", chunksize=20, n_jobs=2
+    )
+    expected, _, _ = transform_data_ids(pd.read_csv(filename))
+
+    if not (users == expected["user_id"]).all() or users.dtype != np.int32:
+        raise AssertionError()
+    if not ((items == expected["item_id"]).all() and len(weights) == len(users)):
+        raise AssertionError()
+    if not user_vocab[interactions["user_id"].max() * 3] == len(user_vocab) - 1:
+        raise AssertionError()
+
+    interactions.assign(user_id="u" + interactions["user_id"].astype(str)).to_csv(
+        filename, index=False
+    )
+    raw_users, raw_items, _ = next(iter_interaction_chunks(filename))
+    if not (raw_users[0].startswith("u") and raw_items.dtype == np.int32):
+        raise AssertionError()
+
+
+@pytest.mark.parametrize("method", ["random", "temporal", "leave_last_out"])
+def test_split_indices_partition(interactions, method):
+    df = interactions.assign(order_number=np.arange(len(interactions)) % 6)
+    split_idx = split_indices(df, method=method)
+
+    all_idx = np.sort(np.concatenate(split_idx))
+    if not (all_idx == np.arange(len(df))).all():
+        raise AssertionError()
+
+
+def test_leave_last_out_split():
+    df = pd.DataFrame(
+        {"user_id": [0, 0, 0, 1, 1, 2], "order_number": [1, 3, 2, 1, 2, 1]}
+    )
+    train_idx, val_idx, test_idx = split_indices(df, method="leave_last_out")
+
+    if not (list(train_idx) == [0, 3, 5] and list(val_idx) == [2]):
+        raise AssertionError()
+    if not list(test_idx) == [1, 4]:
+        raise AssertionError()
+
+
+def test_synthetic_instacart():
+    df = synthetic_instacart(20000, n_products=500)
+    reordered = df[df["reordered"] == 1]
+    first = df.groupby(["user_id", "product_id"])["order_number"].transform("min")
+
+    if not (len(df) == 20000 and df["product_id"].max() < 500):
+        raise AssertionError()
+    if not (first[reordered.index] < reordered["order_number"]).all():
+        raise AssertionError()
+
+
+def test_multi_worker_loading(interactions):
+    dataset = InteractionsDataset.from_arrays(
+        interactions["user_id"].to_numpy(),
+        interactions["item_id"].to_numpy(),
+        interactions["interaction"].to_numpy(),
+        40,
+        num_negs=2,
+    )
+    loader = batch_dataloader(
+        dataset, 100, num_workers=2, multiprocessing_context="fork"
+    )
+    batches = list(loader)
+    users, items, _ = (torch.cat(column) for column in zip(*batches))
+
+    if not (dataset.users.is_shared() and len(users) == len(dataset)):
+        raise AssertionError()
+    if dataset.item_sets.contains(users[:, 1:].ravel(), items[:, 1:].ravel()).any():
+        raise AssertionError()
+    # Each worker draws different negatives for the same user.
+    same_user = InteractionsDataset.from_arrays(
+        np.zeros(200, dtype=np.int64), np.zeros(200, dtype=np.int64), np.ones(200), 1000
+    )
+    same_user.num_negs = 5
+    first, second = batch_dataloader(
+        same_user, 100, num_workers=2, multiprocessing_context="fork"
+    )
+    if torch.equal(first[1], second[1]):
+        raise AssertionError()
+
+    pickled = ForkingPickler.dumps(dataset.item_sets)
+    if not len(pickled) < dataset.item_sets.nbytes:
+        raise AssertionError()
+
+
+def test_auto_workers_without_batch_gather(interactions):
+    (train, _, _), _, _ = InteractionsDataset.ratings_dataloader(
+        interactions.copy(), batch_size=50, batch_gather=False, num_workers="auto"
+    )
+
+    if not (isinstance(train.num_workers, int) and len(list(train)) == len(train)):
+        raise AssertionError()
+
+
+def test_store_dataset_stays_on_disk(interactions, tmp_path):
+    InteractionStore.from_dataframe(str(tmp_path), interactions)
+    dataset = InteractionsDataset.from_store(
+        InteractionStore(str(tmp_path)), num_negs=2
+    )
+    pointer = dataset.users.data_ptr()
+    dataset.share_memory()
+    if not (dataset.users.data_ptr() == pointer and not dataset.users.is_shared()):
+        raise AssertionError()
+
+    # Spawned workers receive the files to map rather than the interactions.
+    pickled = ForkingPickler.dumps(dataset)
+    loaded = pickle.loads(pickled)
+    if not len(pickled) < dataset.users.numpy().nbytes:
+        raise AssertionError()
+    if not (
+        torch.equal(loaded.items, dataset.items)
+        and (loaded.item_sets.indices == dataset.item_sets.indices).all()
+    ):
+        raise AssertionError()
@@ -9,13 +9,17 @@ import os
 
 # from pathlib import Path
 
-# import numpy as np
+import numpy as np
+import pandas as pd
 
 # import paramiko
 import pytest
 import sqlalchemy
 
-from youchoose.data.ingestion.sql import SQLDatabase  # , psql_engine, ssh_tunnel
+from youchoose.data.ingestion.sql import (  # , psql_engine, ssh_tunnel
+    QueryCache,
+    SQLDatabase,
+)
 
 test_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data/")
 
@@ -55,6 +59,88 @@ def test_sqlite_table(sqlite_db):
 #         raise AssertionError()
 
 
+@pytest.fixture
+def ratings_db(tmp_path):
+    """
+    A sqlite database with a small table of user-item interactions.
+    """
+    db = SQLDatabase(db_type="sqlite", db_name=str(tmp_path / "ratings.db"))
+    db.conn.execute("CREATE TABLE ratings (user_id INTEGER, item_id INTEGER);")
+    db.conn.execute(
+        "INSERT INTO ratings VALUES "
+        + ",".join("({}, {})".format(i % 7, i) for i in range(25))
+    )
+
+    return db
+
+
+def test_chunked_query(ratings_db):
+    query_str = "SELECT * FROM ratings;"
+    chunks = list(ratings_db.iter_dataframes(query_str, chunksize=10))
+    df = ratings_db.get_dataframe(query_str, chunksize=10, dtypes={"user_id": "int32"})
+    ratings_db.close()
+
+    if not [len(chunk) for chunk in chunks] == [10, 10, 5]:
+        raise AssertionError()
+    if not (len(df) == 25 and df["user_id"].dtype == "int32"):
+        raise AssertionError()
+
+
+def test_query_cache(tmp_path):
+    db = SQLDatabase(
+        db_type="sqlite",
+        db_name=str(tmp_path / "ratings.db"),
+        cache_dir=str(tmp_path / "cache"),
+    )
+    db.conn.execute("CREATE TABLE ratings (user_id INTEGER, item_id INTEGER);")
+    db.conn.execute("INSERT INTO ratings VALUES (1, 2), (3, 4);")
+
+    query_str = "SELECT * FROM ratings;"
+    queried_df = db.get_dataframe(query_str)
+    cached_df = db.get_dataframe("SELECT *\n  FROM ratings")
+    db.conn.execute("INSERT INTO ratings VALUES (5, 6);")
+    updated_df = db.get_dataframe(query_str)
+    db.close()
+
+    if not (queried_df.equals(cached_df) and len(updated_df) == 3):
+        raise AssertionError()
+    if not len(list((tmp_path / "cache").iterdir())) == 2:
+        raise AssertionError()
+
+
+def test_query_cache_pickles_only_object_columns(tmp_path):
+    cache = QueryCache(str(tmp_path))
+    df = pd.DataFrame({"user": ["a", "b"], "item": [1, 2]})
+    cache.save("key", df)
+    if not cache.load("key").equals(df):
+        raise AssertionError()
+
+    np.save(tmp_path / "key" / "1.npy", np.array([len, len], dtype=object))
+    with pytest.raises(ValueError):
+        cache.load("key")
+
+
+def test_query_cache_detects_updates(tmp_path):
+    db = SQLDatabase(
+        db_type="sqlite",
+        db_name=str(tmp_path / "ratings.db"),
+        cache_dir=str(tmp_path / "cache"),
+    )
+    db.conn.execute("CREATE TABLE Ratings (user_id INTEGER, item_id INTEGER);")
+    db.conn.execute("INSERT INTO Ratings VALUES (1, 2), (3, 4);")
+
+    query_str = "SELECT * FROM Ratings;"
+    if not list(db.table_fingerprints(query_str)) == ["Ratings"]:
+        raise AssertionError()
+    db.get_dataframe(query_str)
+    db.conn.execute("UPDATE Ratings SET item_id = 5 WHERE user_id = 1;")
+    updated_df = db.get_dataframe(query_str)
+    db.close()
+
+    if not updated_df["item_id"].tolist() == [5, 4]:
+        raise AssertionError()
+
+
 def test_incorrect_db_type():
     with pytest.raises(ValueError):
         SQLDatabase(db_type="mysql")
@@ -6,3 +6,483 @@ Testing of the `model` module.
 """
 # To look at testing the data classes, want to incorporate some of the tests from the official documentation.
 # https://github.com/pytorch/pytorch/blob/master/test/test_dataloader.py
+import asyncio
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from youchoose.data.data_loading import InteractionsDataset, batch_dataloader
+from youchoose.data.data_processing import ItemSetIndex
+from youchoose.evaluate.auc import ranking_metrics
+from youchoose.extraction.implicit_als import ImplicitALS
+from youchoose.extraction.nn_latent_matrix_factorization import NNMatrixFactorization
+from youchoose.interaction.pairwise import BPRLoss, TripletBatches
+from youchoose.interaction.pointwise import FoldedScorer
+from youchoose.recommender.ann_index import MIPSIndex
+from youchoose.recommender.cache import RecommendationCache
+from youchoose.recommender.deploy import InferenceServer
+from youchoose.recommender.matrix_factorization import MatrixFactorization
+from youchoose.recommender.nn_layers import QuantizedEmbedding
+from youchoose.utils.checkpoint import load_checkpoint
+from youchoose.utils.logging import TrainingProfiler
+
+
+@pytest.fixture
+def dataset():
+    """
+    A dataset of random user-item interactions with negative samples.
+    """
+    rng = np.random.RandomState(23)
+    users = rng.randint(0, 30, size=500)
+    items = rng.randint(0, 20, size=500)
+
+    return InteractionsDataset.from_arrays(
+        users, items, np.ones(500, dtype=np.float32), 20, num_negs=2
+    )
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(23)
+
+    return NNMatrixFactorization(30, 20, n_factors=8, lr=1.0)
+
+
+def test_train_model(model, dataset):
+    loader = batch_dataloader(dataset, 64, shuffle=True)
+    mean_loss, accuracy = model.train_model(loader)
+
+    if not model.train_stats["samples"] == 3 * len(dataset):
+        raise AssertionError()
+    if not (mean_loss > 0 and 0 <= float(accuracy) <= 100):
+        raise AssertionError()
+
+
+def test_evaluate_mean_loss(model, dataset):
+    batches = list(batch_dataloader(dataset, 64))
+    user, item, rating = (torch.cat(tensors) for tensors in zip(*batches))
+    with torch.no_grad():
+        expected, _ = model._forward_loss(user, item, rating)
+
+    for loader in (batches, [(user, item, rating)]):
+        mean_loss, _ = model.evaluate(loader)
+        if not np.isclose(mean_loss, float(expected), rtol=1e-5):
+            raise AssertionError()
+
+
+@pytest.mark.parametrize("compile_step", [False, True])
+def test_hogwild_and_compiled_training(model, dataset, compile_step):
+    before = model.user_factors.weight.detach().clone()
+    if compile_step:
+        model.train_model(batch_dataloader(dataset, 64), compile_step=True)
+    else:
+        model.train_hogwild(dataset, num_processes=2, batch_size=64)
+
+    if not model.train_stats["samples"] == 3 * len(dataset):
+        raise AssertionError()
+    if torch.equal(model.user_factors.weight, before):
+        raise AssertionError()
+
+
+def test_hogwild_worker_error(dataset):
+    # Items of the dataset beyond the 5 embedding rows fail in the workers.
+    model = NNMatrixFactorization(30, 5, n_factors=8)
+    with pytest.raises(RuntimeError):
+        model.train_hogwild(dataset, num_processes=2, batch_size=64)
+
+
+def test_profiled_training(model, dataset):
+    loader = batch_dataloader(dataset, 64, shuffle=True)
+    profiler = TrainingProfiler()
+    model.train_model(loader, profiler=profiler)
+    model.evaluate(loader, profiler=profiler)
+    train = profiler.summary()["train"]
+
+    if not set(train["phases"]) == {"data", "forward", "backward", "optimizer"}:
+        raise AssertionError()
+    if not (train["samples"] == model.train_stats["samples"] and train["runs"] == 1):
+        raise AssertionError()
+    if not sum(train["phases"].values()) <= train["seconds"]:
+        raise AssertionError()
+    if not profiler.summary()["evaluate"]["samples"] == 3 * len(dataset):
+        raise AssertionError()
+
+
+def test_profiler_without_resource(model, dataset, monkeypatch):
+    monkeypatch.setitem(sys.modules, "resource", None)
+    profiler = TrainingProfiler()
+    model.evaluate(batch_dataloader(dataset, 64), profiler=profiler)
+
+    if "peak_rss_mb" in profiler.summary()["evaluate"]:
+        raise AssertionError()
+    if "peak rss" in profiler.report():
+        raise AssertionError()
+
+
+def test_sparse_training():
+    model = NNMatrixFactorization(
+        30,
+        20,
+        n_factors=8,
+        lr=0.1,
+        l2=0.01,
+        sparse=True,
+        optimizer=torch.optim.SparseAdam,
+    )
+    untouched = model.user_factors.weight[29].clone()
+    dataset = InteractionsDataset.from_arrays(
+        np.zeros(10, dtype=np.int64), np.arange(10), np.ones(10, dtype=np.float32), 20
+    )
+    model.train_model(batch_dataloader(dataset, 5))
+
+    if not torch.equal(model.user_factors.weight[29], untouched):
+        raise AssertionError()
+    if not model.user_factors.weight.grad.is_sparse:
+        raise AssertionError()
+
+
+@pytest.mark.parametrize("item_block_size", [6, 3])
+def test_recommend_top(model, item_block_size):
+    seen = ItemSetIndex.from_arrays([0, 0, 1, 5], [3, 7, 2, 19])
+    top_items, top_scores = model.recommend_top(
+        k=5, exclude=seen, user_block_size=7, item_block_size=item_block_size
+    )
+
+    user_table, item_table = model.folded_factors()
+    scores = user_table @ item_table.t()
+    scores[[0, 0, 1, 5], [3, 7, 2, 19]] = -float("inf")
+    expected_scores, expected_items = torch.topk(scores, 5, dim=1)
+
+    if not top_items.shape == (30, 5):
+        raise AssertionError()
+    if not (
+        torch.equal(top_items, expected_items)
+        and torch.allclose(top_scores, expected_scores)
+    ):
+        raise AssertionError()
+
+
+def test_mips_index_exhaustive_search(model):
+    index = MIPSIndex.from_model(model, n_lists=4)
+    queries = model.folded_factors()[0].numpy()
+    approx_ids, _ = index.search(queries, k=5, n_probe=4)
+    exact_ids, _ = index.exact_search(queries, k=5)
+
+    if not (approx_ids == exact_ids).all():
+        raise AssertionError()
+    if not index.recall_report(queries, k=5, n_probes=[4])[0]["recall"] == 1.0:
+        raise AssertionError()
+
+
+def test_als_conjugate_gradient_matches_cholesky():
+    rng = np.random.RandomState(23)
+    users = rng.randint(0, 30, size=500)
+    items = rng.randint(0, 20, size=500)
+
+    exact = ImplicitALS(30, 20, n_factors=4, iterations=1, solver="cholesky")
+    approx = ImplicitALS(30, 20, n_factors=4, iterations=1, cg_steps=4, n_jobs=2)
+    num_threads = torch.get_num_threads()
+    exact.fit(users, items)
+    approx.fit(users, items)
+
+    if not (exact.n_jobs is None and torch.get_num_threads() == num_threads):
+        raise AssertionError()
+
+    if not torch.allclose(exact.user_factors, approx.user_factors, atol=1e-3):
+        raise AssertionError()
+    if not approx.recommend_top(k=5)[0].shape == (30, 5):
+        raise AssertionError()
+
+
+def test_ranking_metrics():
+    user_table = torch.ones(1, 1)
+    item_table = torch.tensor([[4.0], [3.0], [2.0], [1.0]])
+    train = ItemSetIndex.from_arrays([0], [0])
+    test = ItemSetIndex.from_arrays([0], [2])
+    metrics = ranking_metrics(user_table, item_table, test, train=train, k=2)
+    expected = {
+        "auc": 0.5,
+        "precision@2": 0.5,
+        "recall@2": 1.0,
+        "ndcg@2": 1 / np.log2(3),
+        "map@2": 0.5,
+    }
+
+    for name, value in expected.items():
+        if not np.isclose(metrics[name], value):
+            raise AssertionError()
+
+
+def test_pairwise_training(dataset):
+    torch.manual_seed(23)
+    model = NNMatrixFactorization(
+        30, 20, n_factors=8, lr=0.05, optimizer=torch.optim.Adam, loss_fn=BPRLoss
+    )
+    batches = TripletBatches(dataset, 64, num_negs=3)
+    user, item, _ = next(iter(batches))
+
+    if not (user.shape == (64,) and item.shape == (64, 4)):
+        raise AssertionError()
+    if dataset.item_sets.contains(user.repeat_interleave(3), item[:, 1:]).any():
+        raise AssertionError()
+
+    model.train_model(batches)
+
+    if not model.train_stats["samples"] == 3 * len(dataset):
+        raise AssertionError()
+
+
+def test_folded_scorer_matches_forward(model):
+    scorer = FoldedScorer.from_model(model)
+    user = torch.tensor([0, 4, 29])
+    items = torch.tensor([[1, 2, 3], [0, 19, 5], [7, 7, 8]])
+
+    with torch.no_grad():
+        expected = model(user.repeat_interleave(3), items.view(-1)).view(3, 3)
+
+        if not torch.allclose(scorer.candidates(user, items), expected, atol=1e-6):
+            raise AssertionError()
+        if not torch.allclose(model.score_candidates(user, items), expected):
+            raise AssertionError()
+        if not torch.allclose(scorer.pairs(user, items[:, 0]), expected[:, 0]):
+            raise AssertionError()
+
+
+def test_lower_precision_embeddings(model, dataset):
+    loader = batch_dataloader(dataset, 64)
+    half = NNMatrixFactorization(30, 20, n_factors=8, lr=1.0, dtype=torch.bfloat16)
+    mean_loss, _ = half.train_model(loader)
+    if not (
+        half.user_factors.weight.dtype == torch.bfloat16 and np.isfinite(mean_loss)
+    ):
+        raise AssertionError()
+    with pytest.raises(ValueError):
+        NNMatrixFactorization(30, 20, optimizer=torch.optim.Adam, dtype=torch.float16)
+
+    weight = torch.randn(10, 8)
+    quantized = QuantizedEmbedding.from_float(weight)
+    if not (quantized.dequantize() - weight).abs().le(quantized.scale / 2 + 1e-6).all():
+        raise AssertionError()
+
+    # One user takes the integer matmul, all users the dequantized item table.
+    items, scores = model.recommend_top(k=5)
+    model.quantize("int8")
+    for users in ([3], None):
+        q_items, q_scores = model.recommend_top(k=5, users=users)
+        expected = scores[users] if users else scores
+        if not torch.allclose(q_scores, expected, atol=1e-3):
+            raise AssertionError()
+    model.train_model(loader)
+    if model.inference_tables is not None:
+        raise AssertionError()
+
+
+def test_checkpoint_resumes_training(dataset, tmp_path):
+    model = NNMatrixFactorization(30, 20, n_factors=8, optimizer=torch.optim.Adam)
+    loader = batch_dataloader(dataset, 64)
+    model.train_model(loader)
+    model.save(str(tmp_path / "model"))
+    loaded = NNMatrixFactorization.load(str(tmp_path / "model"))
+
+    for trained in (model, loaded):
+        np.random.seed(23)
+        trained.train_model(loader)
+    for name, param in model.state_dict().items():
+        if not torch.allclose(param, loaded.state_dict()[name]):
+            raise AssertionError()
+    if not (loaded.user_vocab is None and loaded.optimizer.state):
+        raise AssertionError()
+
+
+def test_checkpoint_rejects_code(tmp_path):
+    model = NNMatrixFactorization(30, 20, n_factors=8)
+    model.save(str(tmp_path / "model"))
+    model.save(str(tmp_path / "model"))
+    if not [path.name for path in tmp_path.iterdir()] == ["model"]:
+        raise AssertionError()
+    meta_file = tmp_path / "model" / "meta.json"
+    saved = json.loads(meta_file.read_text())
+
+    saved["meta"]["optimizer"] = "os.system"
+    meta_file.write_text(json.dumps(saved))
+    with pytest.raises(ValueError):
+        NNMatrixFactorization.load(str(tmp_path / "model"))
+
+    np.save(tmp_path / "model" / "user_factors.weight.npy", np.array([len], object))
+    with pytest.raises(ValueError):
+        load_checkpoint(str(tmp_path / "model"))
+
+
+@pytest.mark.parametrize("method", ["nn", "als"])
+def test_recommender_checkpoint(method, tmp_path):
+    rng = np.random.RandomState(23)
+    data = pd.DataFrame(
+        {
+            "user_id": rng.choice(["a", "b", "c", "d"], size=200),
+            "item_id": rng.randint(100, 130, size=200),
+            "interaction": np.ones(200),
+        }
+    ).drop_duplicates(["user_id", "item_id"])
+    with pytest.raises(ValueError):
+        MatrixFactorization("nn", data, neg_samples=0)
+
+    recommender = MatrixFactorization(method, data, epochs=2)
+    recommender.train()
+    recommender.save(str(tmp_path / "recommender"))
+    loaded = MatrixFactorization.load(str(tmp_path / "recommender"), mmap_mode="r")
+
+    items, scores = recommender.recommend_top(k=3, users=["a", "c"])
+    loaded_items, loaded_scores = loaded.recommend_top(k=3, users=["a", "c"])
+    if not (np.array_equal(items, loaded_items) and np.allclose(scores, loaded_scores)):
+        raise AssertionError()
+    with pytest.raises(ValueError):
+        loaded.evaluate(k=3)
+
+    reloaded = MatrixFactorization.load(str(tmp_path / "recommender"), data=data)
+    if not reloaded.evaluate(k=3) == recommender.evaluate(k=3):
+        raise AssertionError()
+
+
+async def _get(reader, writer, path: str) -> tuple:
+    writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode())
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b"\r\n":
+            break
+        if line.lower().startswith(b"content-length"):
+            length = int(line.split(b":")[1])
+
+    return status, json.loads(await reader.readexactly(length))
+
+
+def test_inference_server_batches_requests():
+    rng = np.random.RandomState(23)
+    data = pd.DataFrame(
+        {
+            "user_id": rng.randint(0, 40, size=400),
+            "item_id": rng.randint(0, 30, size=400),
+            "interaction": np.ones(400),
+        }
+    ).drop_duplicates(["user_id", "item_id"])
+    recommender = MatrixFactorization("als", data, epochs=2)
+    recommender.train()
+    server = InferenceServer(recommender, port=0, max_wait_ms=50)
+
+    async def client(user):
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        response = await _get(reader, writer, "/recommend?user={}&k=3".format(user))
+        writer.close()
+        return response
+
+    async def run():
+        await server.start()
+        responses = await asyncio.gather(*(client(user) for user in range(40)))
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        missing = await _get(reader, writer, "/recommend?user=1000")
+        stats = await _get(reader, writer, "/stats")
+        writer.close()
+        await server.stop()
+        return responses, missing, stats
+
+    responses, missing, (_, stats) = asyncio.run(run())
+    items, _ = recommender.recommend_top(k=3, users=np.arange(40))
+
+    if not all(status == 200 for status, _ in responses):
+        raise AssertionError()
+    if not [body["items"] for _, body in responses] == items.tolist():
+        raise AssertionError()
+    if not (missing[0] == 404 and stats["requests"] == 40):
+        raise AssertionError()
+    if not stats["batches"] < 40:
+        raise AssertionError()
+
+
+def test_recommendation_cache(tmp_path):
+    rng = np.random.RandomState(23)
+    data = pd.DataFrame(
+        {
+            "user_id": rng.randint(0, 40, size=400),
+            "item_id": rng.randint(0, 30, size=400),
+            "interaction": np.ones(400),
+        }
+    ).drop_duplicates(["user_id", "item_id"])
+    recommender = MatrixFactorization("als", data, epochs=2)
+    recommender.train()
+    expected = recommender.recommend_top(k=3, users=np.arange(40))
+
+    # Room for about 10 entries in memory, the rest spill to disk.
+    cache = RecommendationCache(max_bytes=2500, disk_dir=str(tmp_path / "cache"))
+    recommender.set_cache(cache)
+    recommender.warm_cache(recommender.most_active_users(40), k=3)
+    cached = recommender.recommend_top(k=3, users=np.arange(40))
+
+    if not (np.array_equal(cached[0], expected[0]) and len(cache) == 40):
+        raise AssertionError()
+    if not (cache.stats["hits"] > 0 and cache.stats["disk_hits"] > 0):
+        raise AssertionError()
+
+    recommender.save(str(tmp_path / "recommender"))
+    recommender.train()
+    if not len(cache) == 0:
+        raise AssertionError()
+
+    loaded = MatrixFactorization.load(str(tmp_path / "recommender"), cache=cache)
+    loaded.recommend_top(k=3, users=[0, 1])
+    if not cache.key(loaded.model_version, 0, 3, exclude_seen=True) in cache:
+        raise AssertionError()
+
+
+def test_shared_disk_cache(tmp_path):
+    first, second = (
+        RecommendationCache(max_bytes=0, disk_dir=str(tmp_path)) for _ in range(2)
+    )
+    items, scores = np.arange(3), np.ones(3)
+    for cache, version in ((first, "a"), (second, "b")):
+        for user in range(3):
+            cache.put(cache.key(version, user, 3), items, scores)
+
+    first.invalidate(keep="c")
+    if not (len(first) == 0 and len(list(tmp_path.glob("*/*.npz"))) == 2):
+        raise AssertionError()
+
+
+def test_incremental_update(tmp_path):
+    rng = np.random.RandomState(23)
+    data = pd.DataFrame(
+        {
+            "user_id": rng.randint(0, 40, size=400),
+            "item_id": rng.randint(0, 30, size=400),
+            "interaction": np.ones(400),
+        }
+    ).drop_duplicates(["user_id", "item_id"])
+    recommender = MatrixFactorization("nn", data, epochs=1, optimizer="adam")
+    recommender.train()
+    untouched = recommender.model.user_factors.weight[:5].detach().clone()
+
+    new = pd.DataFrame(
+        {"user_id": [50, 50, 51, 7], "item_id": [3, 30, 31, 31], "interaction": 1.0}
+    )
+    recommender.update(new, epochs=2)
+    model = recommender.model
+
+    if not model.user_factors.weight.shape[0] == model.user_bias.weight.shape[0] == 42:
+        raise AssertionError()
+    if not torch.equal(model.user_factors.weight[:5], untouched):
+        raise AssertionError()
+    state = model.optimizer.state[model.user_factors.weight]["exp_avg"]
+    if not state.shape == model.user_factors.weight.shape:
+        raise AssertionError()
+
+    recommender.save(str(tmp_path / "recommender"))
+    loaded = MatrixFactorization.load(str(tmp_path / "recommender"))
+    items, _ = loaded.recommend_top(k=2, users=[50, 51])
+    if not (
+        items.shape == (2, 2) and 31 not in items[1] and len(loaded.item_vocab) == 32
+    ):
+        raise AssertionError()
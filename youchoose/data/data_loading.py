@@ -4,15 +4,36 @@
 """
 Data loading library.
 
-
+Datasets gather whole batches, with their negative samples, in a single call,
+so with ``num_workers`` set the DataLoader workers produce fully formed batches.
+The interaction tensors and the positive item index are then moved to shared
+memory, each worker draws negatives from its own seeded random state, and the
+batches are moved to the model's device in the training loop.
 """
+import os
+
 import numpy as np
 import torch
 import pandas as pd
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import (
+    Dataset,
+    DataLoader,
+    BatchSampler,
+    RandomSampler,
+    SequentialSampler,
+)
 from typing import Tuple, List
 
-from .data_processing import item_sets, dataframe_split, transform_data_ids
+from .data_processing import (
+    ItemSetIndex,
+    file_source,
+    item_sets,
+    open_source,
+    split_indices,
+    transform_data_ids,
+)
+from .interaction_store import InteractionStore
+from .negative_sampling import NegativeSampler
 
 
 class InteractionsDataset(Dataset):
@@ -50,17 +71,161 @@ class InteractionsDataset(Dataset):
         """
         super(InteractionsDataset, self).__init__()
 
+        self.dev = dev
+        self._set_interactions(
+            self.transform(df[user_col]),
+            self.transform(df[item_col]),
+            self.transform(df[weight_col]).float(),
+            item_sets(df, users=user_col, items=item_col, compact=True),
+            num_items,
+            dev,
+            num_negs,
+        )
+
+    def _set_interactions(self, users, items, weights, index, num_items, dev, num_negs):
         if num_negs < 0:
             raise ValueError("The number of negative samples must be positive.")
 
-        self.item_sets = item_sets(df, users=user_col, items=item_col)
+        self.item_sets = index
         self.dev = dev
         self.num_negs = num_negs
-        self.items = self.transform(df[item_col])
-        self.users = self.transform(df[user_col])
-        self.weights = self.transform(df[weight_col]).float()
-        self.size = len(df)
+        self.items = items
+        self.users = users
+        self.weights = weights
+        self.size = len(users)
         self.n_items = num_items
+        self.sampler = NegativeSampler(self.item_sets, num_items)
+
+    @classmethod
+    def from_arrays(
+        cls,
+        users: np.ndarray,
+        items: np.ndarray,
+        weights: np.ndarray,
+        num_items: int,
+        dev=torch.device("cpu"),
+        num_negs: int = 0,
+        index: ItemSetIndex = None,
+    ) -> "InteractionsDataset":
+        """
+        Create the dataset from arrays of indexed users, items, and interactions.
+
+        The arrays are wrapped with `torch.from_numpy`, so no copy is made when
+        the data stays on the cpu.
+
+        Args:
+            users (np.ndarray): User index of each interaction.
+            items (np.ndarray): Item index of each interaction.
+            weights (np.ndarray): Interaction metric, stored as float32.
+            num_items (int): The number of items contained in the dataset.
+            dev (torch.device, optional): Choose location to run the model.
+                Defaults to torch.device("cpu").
+            num_negs (int, optional): Number of negative interactions to sample
+                for each positive interaction by a user. Defaults to 0.
+            index (ItemSetIndex, optional): The items each user has interacted
+                with. Built from the users and items if not given.
+
+        Returns:
+            InteractionsDataset: The dataset of interactions.
+        """
+        dataset = cls.__new__(cls)
+        Dataset.__init__(dataset)
+
+        if index is None:
+            index = ItemSetIndex.from_arrays(users, items)
+        weights = weights.astype(np.float32, copy=False)
+
+        dataset._set_interactions(
+            torch.from_numpy(users).to(dev),
+            torch.from_numpy(items).to(dev),
+            torch.from_numpy(weights).to(dev),
+            index,
+            num_items,
+            dev,
+            num_negs,
+        )
+        if dev.type == "cpu":
+            dataset._sources = {
+                name: file_source(array)
+                for name, array in (
+                    ("users", users),
+                    ("items", items),
+                    ("weights", weights),
+                )
+                if file_source(array)
+            }
+
+        return dataset
+
+    @classmethod
+    def from_store(
+        cls, store: InteractionStore, dev=torch.device("cpu"), num_negs: int = 0
+    ) -> "InteractionsDataset":
+        """
+        Create the dataset from a memory-mapped interaction store without copying
+        the interactions into memory.
+
+        Args:
+            store (InteractionStore): An opened interaction store.
+            dev (torch.device, optional): Choose location to run the model.
+                Defaults to torch.device("cpu").
+            num_negs (int, optional): Number of negative interactions to sample
+                for each positive interaction by a user. Defaults to 0.
+
+        Returns:
+            InteractionsDataset: The dataset of interactions.
+        """
+        return cls.from_arrays(
+            store.users,
+            store.items,
+            store.weights,
+            store.n_items,
+            dev=dev,
+            num_negs=num_negs,
+            index=store.item_sets(),
+        )
+
+    def share_memory(self) -> "InteractionsDataset":
+        """
+        Move the interactions and the index of positive items to shared memory,
+        for loading batches in DataLoader worker processes.
+
+        Interactions memory mapped from files, e.g. by `from_store`, are not
+        copied, so a dataset larger than memory stays on disk. Forked workers
+        inherit the mapping, and spawned workers map the same file again.
+
+        Raises:
+            ValueError: If the interactions are not on the cpu.
+
+        Returns:
+            InteractionsDataset: This dataset.
+        """
+        if self.users.device.type != "cpu":
+            raise ValueError(
+                "Worker processes need the dataset on the cpu, batches are moved "
+                "to the device in the training loop."
+            )
+
+        sources = getattr(self, "_sources", {})
+        for name in ("users", "items", "weights"):
+            if name not in sources:
+                getattr(self, name).share_memory_()
+        self.item_sets.share_memory()
+
+        return self
+
+    def __getstate__(self):
+        # Memory mapped interactions are pickled as their file, not their data.
+        state = dict(self.__dict__)
+        for name in getattr(self, "_sources", {}):
+            state[name] = None
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, source in state.get("_sources", {}).items():
+            setattr(self, name, torch.from_numpy(open_source(source)))
 
     def __len__(self):
         return self.size
@@ -68,9 +233,18 @@ class InteractionsDataset(Dataset):
     def __getitem__(self, idx):
         """
         Get and return Tensor for item, user, interaction triplet.
+
+        If ``idx`` is a sequence of indices the whole batch is gathered at once,
+        returning tensors with the same shapes the default collate function
+        would have stacked from individual rows.
         """
-        user = self.users[idx]
-        item = self.items[idx]
+        if not isinstance(idx, (int, np.integer)) and not (
+            torch.is_tensor(idx) and idx.dim() == 0
+        ):
+            return self.get_batch(idx)
+
+        user = self.users[idx].long()
+        item = self.items[idx].long()
         weight = self.weights[idx]
 
         if self.num_negs:
@@ -81,6 +255,31 @@ class InteractionsDataset(Dataset):
 
         return (user, item, weight)
 
+    def get_batch(self, idx):
+        """
+        Gather the item, user, interaction triplets for a batch of indices.
+
+        Args:
+            idx (Sequence[int]): The indices of the interactions in the batch.
+
+        Returns:
+            tuple(torch.tensor): The users, items, and interactions for the batch.
+                With negative sampling each tensor has shape (len(idx), 1 + num_negs)
+                and the positive interaction is in the first column.
+        """
+        idx = torch.as_tensor(idx, dtype=torch.long, device=self.users.device)
+        user = self.users[idx].long()
+        item = self.items[idx].long()
+        weight = self.weights[idx]
+
+        if self.num_negs:
+            users, neg_i, neg_r = self.batch_negative_sampling(user)
+            item = torch.cat((item.unsqueeze(1), neg_i), dim=1)
+            user = torch.cat((user.unsqueeze(1), users), dim=1)
+            weight = torch.cat((weight.unsqueeze(1), neg_r), dim=1)
+
+        return (user, item, weight)
+
     def transform(self, df_rows):
         """
         Convert pandas dataframe to a torch tensor and sent to computation device.
@@ -99,19 +298,34 @@ class InteractionsDataset(Dataset):
             tuple(torch.tensor): A tuple of torch tensors for the users, items, negative
                 interactions.
         """
-        u_list = []
-        i_list = []
-        w_list = self.num_negs * [0.0]
         u_id = int(user_ids)
+        neg_i = self.sampler.sample([u_id], self.num_negs)[0]
+
+        return (
+            torch.full((self.num_negs,), u_id, dtype=torch.long),
+            torch.from_numpy(neg_i),
+            torch.zeros(self.num_negs),
+        )
+
+    def batch_negative_sampling(self, user_ids):
+        """
+        Sample negative items for a whole batch of users with a single draw.
 
-        neg_set = set(range(self.n_items)) - self.item_sets[u_id]
-        neg_v = np.random.choice(tuple(neg_set), self.num_negs)
+        Args:
+            user_ids (torch.tensor): A 1d tensor of user ids.
 
-        for i_id in neg_v:
-            u_list.append(u_id)
-            i_list.append(i_id)
+        Returns:
+            tuple(torch.tensor): The users, items, and interactions of the negative
+                samples, each of shape (len(user_ids), num_negs).
+        """
+        neg_i = self.sampler.sample(user_ids.cpu().numpy(), self.num_negs)
+        users = user_ids.unsqueeze(1).expand(-1, self.num_negs)
 
-        return (torch.tensor(u_list), torch.tensor(i_list), torch.tensor(w_list))
+        return (
+            users,
+            torch.from_numpy(neg_i).to(self.dev),
+            torch.zeros(neg_i.shape, device=self.dev),
+        )
 
     @classmethod
     def ratings_dataloader(
@@ -127,6 +341,9 @@ class InteractionsDataset(Dataset):
         reweight: bool = True,
         train_frac: float = 0.80,
         test_frac: float = 0.10,
+        batch_gather: bool = True,
+        split: str = "random",
+        order_col: str = "order_number",
         **kwargs
     ) -> Tuple[List[DataLoader], int, int]:
         """
@@ -155,8 +372,16 @@ class InteractionsDataset(Dataset):
                 training the recommender. Defaults to 0.80.
             test_frac (float, optional): The proportion of data to test and evaluate the
                 recommenders performance on. Defaults to 0.10.
+            batch_gather (bool, optional): Have the dataset gather each batch with a
+                single index operation instead of collating one row at a time.
+                Defaults to True.
+            split (str, optional): The split method, one of random, temporal, or
+                leave_last_out. See `split_indices`. Defaults to "random".
+            order_col (str, optional): Column ordering the interactions in time, used
+                by the temporal and leave_last_out splits. Defaults to "order_number".
             **kargs (dict, optional): Additional arguments to pass to the
-                torch.utils.data.DataLoading class.
+                torch.utils.data.DataLoading class, e.g. num_workers, which keeps
+                the datasets on the cpu. See `batch_dataloader`.
 
         Returns:
             Tuple[Tuple[DataLoader], int, int]: A tuple containing a list of DataLoaders for the
@@ -170,27 +395,129 @@ class InteractionsDataset(Dataset):
             weight_col=weight_col,
             reweight=reweight,
         )
-        split_dfs = dataframe_split(
-            df_transformed, train_frac=train_frac, test_frac=test_frac
+        split_idx = split_indices(
+            df_transformed,
+            train_frac=train_frac,
+            test_frac=test_frac,
+            method=split,
+            user_col=user_col,
+            order_col=order_col,
         )
+        users = df_transformed[user_col].to_numpy()
+        items = df_transformed[item_col].to_numpy()
+        weights = df_transformed[weight_col].to_numpy(dtype=np.float32)
 
         n_users, n_items = len(user_dict), len(item_dict)
+        if kwargs.get("num_workers") == "auto":
+            kwargs["num_workers"] = default_num_workers()
+        if kwargs.get("num_workers"):
+            # Workers build batches on the cpu for the training loop to move.
+            dev = torch.device("cpu")
 
         shuffle_list = [shuffle_train, False, False]
         loader_list = []
 
-        for df, shuffle in zip(split_dfs, shuffle_list):
-            data_set = cls(
-                df,
+        for idx, shuffle in zip(split_idx, shuffle_list):
+            data_set = cls.from_arrays(
+                users[idx],
+                items[idx],
+                weights[idx],
                 n_items,
-                user_col=user_col,
-                item_col=item_col,
-                weight_col=weight_col,
                 dev=dev,
                 num_negs=num_negs,
             )
-            loader_list.append(
-                DataLoader(data_set, batch_size=batch_size, shuffle=shuffle, **kwargs)
-            )
+            if batch_gather:
+                loader = batch_dataloader(data_set, batch_size, shuffle, **kwargs)
+            else:
+                if kwargs.get("num_workers"):
+                    kwargs.setdefault("worker_init_fn", seed_worker)
+                loader = DataLoader(
+                    data_set, batch_size=batch_size, shuffle=shuffle, **kwargs
+                )
+            loader_list.append(loader)
 
         return (loader_list, n_users, n_items)
+
+
+def batch_dataloader(
+    dataset: Dataset,
+    batch_size: int,
+    shuffle: bool = False,
+    drop_last: bool = False,
+    num_workers=0,
+    **kwargs
+) -> DataLoader:
+    """
+    Create a DataLoader that passes whole batches of indices to the dataset.
+
+    The dataset must accept a list of indices in ``__getitem__`` and return the
+    already batched tensors, so automatic batching of the DataLoader is disabled.
+
+    With worker processes the dataset is moved to shared memory, and unless given
+    in kwargs, each worker seeds numpy with `seed_worker`, the workers persist
+    between epochs, prefetch 4 batches each, and batches are pinned when a gpu is
+    available.
+
+    Args:
+        dataset (Dataset): A dataset supporting batched indexing.
+        batch_size (int): Number of samples in each batch.
+        shuffle (bool, optional): Reshuffle the data every epoch. Defaults to False.
+        drop_last (bool, optional): Drop the last incomplete batch. Defaults to False.
+        num_workers (Union[int, str], optional): Number of worker processes
+            loading batches, or "auto" for `default_num_workers`. Defaults to 0,
+            loading in the main process.
+        **kargs (dict, optional): Additional arguments to pass to the
+            torch.utils.data.DataLoading class.
+
+    Returns:
+        DataLoader: A DataLoader yielding one batch per index list.
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+
+    if num_workers == "auto":
+        num_workers = default_num_workers()
+    if num_workers:
+        if hasattr(dataset, "share_memory"):
+            dataset.share_memory()
+        kwargs.setdefault("worker_init_fn", seed_worker)
+        kwargs.setdefault("persistent_workers", True)
+        kwargs.setdefault("prefetch_factor", 4)
+        kwargs.setdefault("pin_memory", torch.cuda.is_available())
+
+    return DataLoader(
+        dataset,
+        batch_size=None,
+        sampler=BatchSampler(sampler, batch_size, drop_last),
+        num_workers=num_workers,
+        **kwargs
+    )
+
+
+def default_num_workers() -> int:
+    """
+    Number of loader workers for the cpus available to this process, leaving one
+    for the training loop, and at most 8.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+
+    return max(0, min(8, cpus - 1))
+
+
+def seed_worker(worker_id: int):
+    """
+    Seed numpy in a DataLoader worker from the worker's torch seed.
+
+    Forked workers would otherwise inherit the same numpy random state and draw
+    the same negative samples. Negative samplers with their own random state are
+    reseeded as well.
+    """
+    info = torch.utils.data.get_worker_info()
+    seed = info.seed % 2**32
+    np.random.seed(seed)
+
+    sampler = getattr(info.dataset, "sampler", None)
+    if sampler is not None and getattr(sampler, "rng", np.random) is not np.random:
+        sampler.rng = np.random.RandomState(seed)
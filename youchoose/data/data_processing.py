@@ -4,12 +4,24 @@
 """
 Data processing library.
 """
+import mmap
+
+import numpy as np
 import pandas as pd
-from typing import Tuple
+import torch
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Tuple, Union
 
 
 def dataframe_split(
-    df: pd.DataFrame, train_frac: float = 0.80, test_frac: float = 0.10
+    df: pd.DataFrame,
+    train_frac: float = 0.80,
+    test_frac: float = 0.10,
+    method: str = "random",
+    user_col: str = "user_id",
+    order_col: str = "order_number",
+    random_state: int = 23,
 ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
     Split dataframe into training, testing, and validation sets.
@@ -20,6 +32,12 @@ def dataframe_split(
             to 0.80.
         test_frac (float, optional): Fraction of the data to use for testing. Defaults
             to 0.10.
+        method (str, optional): How to split the rows, see `split_indices`. Defaults
+            to "random".
+        user_col (str, optional): Column name for the users. Defaults to "user_id".
+        order_col (str, optional): Column ordering each user's interactions in time.
+            Defaults to "order_number".
+        random_state (int, optional): Seed for the random split. Defaults to 23.
     Raises:
         ValueError: The testing and training fractions must both be less than 1
             and their sum to be less than 1.
@@ -27,32 +45,144 @@ def dataframe_split(
         Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]: A tuple of the training,
             validation, and testing dataframes.
     """
+    split_idx = split_indices(
+        df,
+        train_frac=train_frac,
+        test_frac=test_frac,
+        method=method,
+        user_col=user_col,
+        order_col=order_col,
+        random_state=random_state,
+    )
+
+    return tuple(df.take(idx) for idx in split_idx)
+
+
+def split_indices(
+    df: pd.DataFrame,
+    train_frac: float = 0.80,
+    test_frac: float = 0.10,
+    method: str = "random",
+    user_col: str = "user_id",
+    order_col: str = "order_number",
+    random_state: int = 23,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split the row positions of a dataframe into training, validation, and testing.
+
+    Only the columns needed for the split are read and the frame is never copied.
+
+    The split methods are:
+
+    * random: A single random permutation of the rows.
+    * temporal: The rows are ordered by order_col, training on the earliest and
+      testing on the latest.
+    * leave_last_out: For each user, the interactions of their last order are used
+      for testing and of their second to last order for validation. Users need at
+      least two orders to be tested and three to be validated. The fractions are
+      not used.
+
+    Args:
+        df (pd.DataFrame): A pandas dataframe with examples as rows.
+        train_frac (float, optional): Fraction of the data to use for training. Defaults
+            to 0.80.
+        test_frac (float, optional): Fraction of the data to use for testing. Defaults
+            to 0.10.
+        method (str, optional): One of random, temporal, or leave_last_out. Defaults
+            to "random".
+        user_col (str, optional): Column name for the users. Defaults to "user_id".
+        order_col (str, optional): Column ordering each user's interactions in time.
+            Defaults to "order_number".
+        random_state (int, optional): Seed for the random split. Defaults to 23.
+    Raises:
+        ValueError: If the fractions are invalid or the method is unknown.
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The row positions of the training,
+            validation, and testing sets.
+    """
     if not (train_frac <= 1 and test_frac <= 1 and (train_frac + test_frac) <= 1):
         raise ValueError(
             "The testing and training fractions must both be less "
             "than 1 and sum to be less than 1."
         )
-    train_df = df.sample(frac=train_frac, random_state=23)
-    test_df = df.drop(train_df.index).sample(int(test_frac * len(df)), random_state=23)
-    val_df = df.drop(pd.concat([train_df, test_df], axis=0).index)
 
-    return train_df, val_df, test_df
+    n_rows = len(df)
+    n_train = int(round(train_frac * n_rows))
+    n_test = int(test_frac * n_rows)
+
+    if method == "random":
+        order = np.random.RandomState(random_state).permutation(n_rows)
+    elif method == "temporal":
+        order = np.argsort(df[order_col].to_numpy(), kind="stable")
+    elif method == "leave_last_out":
+        return _leave_last_out(df[user_col].to_numpy(), df[order_col].to_numpy())
+    else:
+        raise ValueError("Split method must be random, temporal, or leave_last_out.")
+
+    if method == "temporal":
+        return (
+            order[:n_train],
+            order[n_train : n_rows - n_test],
+            order[n_rows - n_test :],
+        )
+
+    return (
+        order[:n_train],
+        order[n_train + n_test :],
+        order[n_train : n_train + n_test],
+    )
+
+
+def _leave_last_out(
+    users: np.ndarray, orders: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split off each user's last and second to last orders.
+    """
+    rows = np.lexsort((orders, users))
+    users, orders = users[rows], orders[rows]
+
+    new_user = np.ones(len(rows), dtype=bool)
+    new_user[1:] = users[1:] != users[:-1]
+    new_order = new_user.copy()
+    new_order[1:] |= orders[1:] != orders[:-1]
+
+    order_id = np.cumsum(new_order) - 1
+    user_id = np.cumsum(new_user) - 1
+    user_first = order_id[new_user][user_id]
+    user_last = np.append(order_id[new_user][1:] - 1, order_id[-1:])[user_id]
+
+    n_orders = user_last - user_first + 1
+    from_last = user_last - order_id
+
+    test = (from_last == 0) & (n_orders >= 2)
+    val = (from_last == 1) & (n_orders >= 3)
+
+    return (rows[~(test | val)], rows[val], rows[test])
 
 
-def item_sets(df: pd.DataFrame, users: str = "user_id", items: str = "item_id") -> dict:
+def item_sets(
+    df: pd.DataFrame, users: str = "user_id", items: str = "item_id", compact=False
+) -> Union[dict, "ItemSetIndex"]:
     """
     Generate sets for each user containing items that they have previously interacted
     with.
 
     Args:
         df (pd.DataFrame): Dataframe containing user_id and item_id columns.
-        users (str, optional): [description]. Defaults to "user_id".
-        items (str, optional): [description]. Defaults to "item_id".
+        users (str, optional): Column name for the users. Defaults to "user_id".
+        items (str, optional): Column name for the items. Defaults to "item_id".
+        compact (bool, optional): Return an ItemSetIndex backed by integer arrays
+            instead of a dict of python sets. Requires integer indexed users and
+            items. Defaults to False.
 
     Returns:
-        dict: Dictionary of users and a set of items that they have previously
-            interacted with.
+        Union[dict, ItemSetIndex]: Dictionary of users and a set of items that they
+            have previously interacted with, or the equivalent compact index.
     """
+    if compact:
+        return ItemSetIndex.from_dataframe(df, users=users, items=items)
+
     df_g = df[[users, items]].groupby([users])[items].agg(lambda x: {val for val in x})
     df_g = df_g.reset_index()
     df_g.columns = [users, "item_list"]
@@ -61,6 +191,267 @@ def item_sets(df: pd.DataFrame, users: str = "user_id", items: str = "item_id")
     return prior_dict
 
 
+class ItemSetIndex:
+    """
+    Compressed sparse row index of the items each user has interacted with.
+
+    The items of user ``u`` are stored sorted in ``indices[indptr[u]:indptr[u + 1]]``,
+    which takes 4 bytes per interaction compared to the python sets returned by
+    `item_sets`. Indexing with a user returns that user's items so it can be used in
+    place of the dict of sets.
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray):
+        """
+        Args:
+            indptr (np.ndarray): Row pointer with one more entry than users.
+            indices (np.ndarray): Item indices, sorted and unique within each user.
+        """
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_arrays(cls, users, items, n_users: int = None) -> "ItemSetIndex":
+        """
+        Build the index from the user and item index of each interaction.
+
+        Args:
+            users (np.ndarray): User index for each interaction.
+            items (np.ndarray): Item index for each interaction.
+            n_users (int, optional): Number of users in the index. Defaults to the
+                largest user index plus one.
+
+        Returns:
+            ItemSetIndex: The index of each user's distinct items.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+
+        if n_users is None:
+            n_users = int(users.max()) + 1 if len(users) else 0
+
+        order = np.lexsort((items, users))
+        users, items = users[order], items[order]
+
+        keep = np.ones(len(users), dtype=bool)
+        keep[1:] = (users[1:] != users[:-1]) | (items[1:] != items[:-1])
+        users, items = users[keep], items[keep]
+
+        ptr_type = np.int32 if len(items) < np.iinfo(np.int32).max else np.int64
+        indptr = np.zeros(n_users + 1, dtype=ptr_type)
+        np.cumsum(np.bincount(users, minlength=n_users), out=indptr[1:])
+
+        return cls(indptr, items.astype(np.int32))
+
+    @classmethod
+    def from_dataframe(
+        cls, df: pd.DataFrame, users: str = "user_id", items: str = "item_id"
+    ) -> "ItemSetIndex":
+        """
+        Build the index from the user and item columns of a dataframe.
+        """
+        return cls.from_arrays(df[users].to_numpy(), df[items].to_numpy())
+
+    def extend(self, users, items, n_users: int = None) -> "ItemSetIndex":
+        """
+        A new index with the interactions added to those of this index.
+
+        Args:
+            users (np.ndarray): User index for each new interaction.
+            items (np.ndarray): Item index for each new interaction.
+            n_users (int, optional): Number of users in the new index. Defaults to
+                enough for this index and the new users.
+
+        Returns:
+            ItemSetIndex: The index of each user's distinct items.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        if n_users is None:
+            n_users = max(self.n_users, int(users.max()) + 1 if len(users) else 0)
+
+        return self.from_arrays(
+            np.concatenate((np.repeat(np.arange(self.n_users), self.counts()), users)),
+            np.concatenate((self.indices, np.asarray(items, dtype=np.int64))),
+            n_users=n_users,
+        )
+
+    def share_memory(self) -> "ItemSetIndex":
+        """
+        Move the arrays to shared memory, so DataLoader workers started with
+        spawn or forkserver map the same pages instead of each receiving a copy
+        when the index is pickled.
+
+        Arrays memory mapped from files, e.g. the index of an
+        `InteractionStore`, are left in place, as every worker can map the
+        same file, and are pickled as their file.
+
+        Returns:
+            ItemSetIndex: This index.
+        """
+        if getattr(self, "_shared", None) is None and not all(
+            file_source(array) for array in (self.indptr, self.indices)
+        ):
+            self._shared = tuple(
+                torch.from_numpy(np.ascontiguousarray(array)).share_memory_()
+                for array in (self.indptr, self.indices)
+            )
+            self.indptr, self.indices = (tensor.numpy() for tensor in self._shared)
+
+        return self
+
+    def __getstate__(self):
+        # Shared tensors are pickled by torch.multiprocessing as handles to the
+        # shared memory rather than as their data, and memory mapped arrays as
+        # their file.
+        if getattr(self, "_shared", None) is not None:
+            return {"_shared": self._shared}
+
+        sources = [file_source(array) for array in (self.indptr, self.indices)]
+        if all(sources):
+            return {"_sources": sources}
+
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "_shared" in state:
+            self.indptr, self.indices = (tensor.numpy() for tensor in self._shared)
+        if "_sources" in state:
+            self.indptr, self.indices = (
+                open_source(source) for source in self.__dict__.pop("_sources")
+            )
+
+    @property
+    def n_users(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes
+
+    def __len__(self):
+        return self.n_users
+
+    def __contains__(self, user):
+        return 0 <= user < self.n_users and self.indptr[user] < self.indptr[user + 1]
+
+    def __iter__(self):
+        return iter(np.flatnonzero(np.diff(self.indptr)).tolist())
+
+    def __getitem__(self, user) -> np.ndarray:
+        """
+        Get the sorted items of a user, empty for users not in the index.
+        """
+        user = int(user)
+        if not 0 <= user < self.n_users:
+            return self.indices[:0]
+
+        return self.indices[self.indptr[user] : self.indptr[user + 1]]
+
+    def counts(self) -> np.ndarray:
+        """
+        Number of distinct items for every user.
+        """
+        return np.diff(self.indptr)
+
+    def contains(self, users, items) -> np.ndarray:
+        """
+        Vectorized test of whether each user has interacted with the paired item.
+
+        Args:
+            users (np.ndarray): User index for each query.
+            items (np.ndarray): Item index for each query.
+
+        Returns:
+            np.ndarray: Boolean array, True where the pair is a positive interaction.
+        """
+        users = np.asarray(users, dtype=np.int64).reshape(-1)
+        items = np.asarray(items).reshape(-1)
+
+        known = (users >= 0) & (users < self.n_users)
+        found = np.zeros(len(users), dtype=bool)
+        found[known] = segment_contains(
+            self.indptr, self.indices, users[known], items[known]
+        )
+
+        return found
+
+    def pairs(self, users) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gather the items of a batch of users as (position, item) pairs.
+
+        Args:
+            users (np.ndarray): User indices.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The position in ``users`` and the item of
+                every positive interaction of the batch.
+        """
+        users = np.asarray(users, dtype=np.int64).reshape(-1)
+        known = (users >= 0) & (users < self.n_users)
+
+        starts = np.zeros(len(users), dtype=np.int64)
+        counts = np.zeros(len(users), dtype=np.int64)
+        starts[known] = self.indptr[users[known]]
+        counts[known] = self.indptr[users[known] + 1] - starts[known]
+
+        positions = np.repeat(np.arange(len(users)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts
+        )
+        items = self.indices[np.repeat(starts, counts) + offsets]
+
+        return positions, items
+
+    def to_dict(self) -> dict:
+        """
+        Convert to the dict of sets returned by `item_sets`.
+        """
+        return {user: set(self[user].tolist()) for user in self}
+
+
+def segment_contains(
+    indptr: np.ndarray, indices: np.ndarray, rows: np.ndarray, values: np.ndarray
+) -> np.ndarray:
+    """
+    Vectorized membership test of ``values[i]`` in the sorted segment of ``rows[i]``.
+
+    A binary search is run over every segment in lockstep, so the cost is
+    ``O(len(values) * log(max segment length))`` with no python loop over the
+    queries.
+
+    Args:
+        indptr (np.ndarray): CSR row pointer.
+        indices (np.ndarray): CSR column indices, sorted within each row.
+        rows (np.ndarray): Row to search for each query value.
+        values (np.ndarray): Query values.
+
+    Returns:
+        np.ndarray: Boolean array, True where the value is found in its row.
+    """
+    lo = indptr[rows].astype(np.int64)
+    end = indptr[rows + 1].astype(np.int64)
+    hi = end.copy()
+    found = np.zeros(len(values), dtype=bool)
+
+    if not len(indices):
+        return found
+
+    active = lo < hi
+    while active.any():
+        mid = lo + (hi - lo) // 2
+        mid_val = indices[np.minimum(mid, len(indices) - 1)]
+        go_right = active & (mid_val < values)
+        lo = np.where(go_right, mid + 1, lo)
+        hi = np.where(active & ~go_right, mid, hi)
+        active = lo < hi
+
+    in_range = lo < end
+    found[in_range] = indices[lo[in_range]] == values[in_range]
+
+    return found
+
+
 def list_to_indexed_dict(list_: list) -> dict:
     """
     Map a list of objects to a sorted dict of indexes.
@@ -77,16 +468,196 @@ def list_to_indexed_dict(list_: list) -> dict:
     return dict(enumerate(sorted(set(list_))))
 
 
+def file_source(array: np.ndarray) -> dict:
+    """
+    The file, dtype, shape, offset, and mode of an array memory mapped from a
+    file, to map the same file in another process, or None for other arrays.
+    """
+    if not (
+        isinstance(array, np.memmap)
+        and isinstance(array.base, mmap.mmap)
+        and array.filename is not None
+    ):
+        return None
+
+    return {
+        "filename": array.filename,
+        "dtype": array.dtype.str,
+        "shape": array.shape,
+        "offset": array.offset,
+        "mode": array.mode,
+    }
+
+
+def open_source(source: dict) -> np.ndarray:
+    """
+    Memory map an array described by `file_source`.
+    """
+    return np.memmap(
+        source["filename"],
+        dtype=np.dtype(source["dtype"]),
+        mode=source["mode"],
+        shape=tuple(source["shape"]),
+        offset=source["offset"],
+    )
+
+
+class IdVocabulary(Mapping):
+    """
+    Mapping between raw IDs and the contiguous indices used by the embeddings.
+
+    The vocabulary is stored as a single array of IDs where the position of an ID
+    is its index. Lookups are vectorized with a binary search over a sorted view of
+    the IDs. New IDs can be appended without changing the indices of the IDs
+    already in the vocabulary. Behaves as a read only dict of ID to index.
+    """
+
+    def __init__(self, ids=None):
+        """
+        Args:
+            ids (np.ndarray, optional): The unique IDs, ordered by index.
+                Defaults to an empty vocabulary, which takes the type of the
+                first IDs added to it.
+        """
+        self._typed = ids is not None
+        self.ids = np.asarray([] if ids is None else ids)
+        self._reindex()
+
+    @classmethod
+    def fit_transform(cls, values) -> Tuple["IdVocabulary", np.ndarray]:
+        """
+        Create a vocabulary of the sorted unique values and encode the values.
+
+        The indices are the same as those given by `list_to_indexed_dict`.
+
+        Args:
+            values (array_like): Raw IDs, e.g. a column of a dataframe.
+
+        Returns:
+            Tuple[IdVocabulary, np.ndarray]: The vocabulary and the index of
+                every value.
+        """
+        codes, uniques = pd.factorize(np.asarray(values), sort=True)
+
+        return cls(uniques), codes.astype(np.int64)
+
+    @classmethod
+    def fit(cls, values) -> "IdVocabulary":
+        """
+        Create a vocabulary of the sorted unique values.
+        """
+        return cls.fit_transform(values)[0]
+
+    def encode(self, values, grow: bool = False) -> np.ndarray:
+        """
+        Translate raw IDs into indices.
+
+        Args:
+            values (array_like): Raw IDs to encode.
+            grow (bool, optional): Append IDs that are not in the vocabulary
+                instead of encoding them as -1. Defaults to False.
+
+        Returns:
+            np.ndarray: The index of each value, -1 for unknown values.
+        """
+        values = np.asarray(values)
+        if grow:
+            self.update(values)
+
+        codes = np.full(len(values), -1, dtype=np.int64)
+        if not len(self.ids):
+            return codes
+
+        pos = np.searchsorted(self._sorted, values)
+        pos = np.minimum(pos, len(self._sorted) - 1)
+        known = self._sorted[pos] == values
+        codes[known] = self._order[pos[known]]
+
+        return codes
+
+    def decode(self, codes) -> np.ndarray:
+        """
+        Translate indices back into raw IDs.
+        """
+        return self.ids[np.asarray(codes)]
+
+    def update(self, values) -> int:
+        """
+        Append the values that are not yet in the vocabulary.
+
+        Args:
+            values (array_like): Raw IDs, possibly including known IDs.
+
+        Returns:
+            int: The number of IDs added.
+        """
+        uniques = pd.unique(np.asarray(values))
+        if len(self.ids):
+            pos = np.minimum(
+                np.searchsorted(self._sorted, uniques), len(self._sorted) - 1
+            )
+            uniques = uniques[self._sorted[pos] != uniques]
+
+        if len(uniques) and not self._typed:
+            self.ids = np.sort(uniques)
+            self._typed = True
+            self._reindex()
+        elif len(uniques):
+            self.ids = np.concatenate((self.ids, np.sort(uniques)))
+            self._reindex()
+
+        return len(uniques)
+
+    def save(self, filename: str):
+        """
+        Save the vocabulary to a .npy file.
+        """
+        np.save(filename, self.ids, allow_pickle=self.ids.dtype == object)
+
+    @classmethod
+    def load(cls, filename: str, mmap_mode: str = None) -> "IdVocabulary":
+        """
+        Load a vocabulary saved with `IdVocabulary.save`.
+        """
+        if not Path(filename).exists():
+            raise ValueError("Filename does not exist.")
+
+        return cls(np.load(filename, mmap_mode=mmap_mode, allow_pickle=True))
+
+    def _reindex(self):
+        self._order = np.argsort(self.ids, kind="stable")
+        self._sorted = self.ids[self._order]
+
+    def __getitem__(self, key) -> int:
+        code = self.encode([key])[0]
+        if code < 0:
+            raise KeyError(key)
+
+        return int(code)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return self.encode([key])[0] >= 0
+
+
 def transform_data_ids(
     df: pd.DataFrame,
     user_col: str = "user_id",
     item_col: str = "item_id",
     weight_col: str = "interaction",
     reweight: bool = True,
-) -> Tuple[pd.DataFrame, dict, dict]:
+) -> Tuple[pd.DataFrame, "IdVocabulary", "IdVocabulary"]:
     """
     Transform the item and user IDs into the indicies needed during embedding.
 
+    IDs are indexed in sorted order. The returned vocabularies map each ID to its
+    index like a dict and can encode new batches of IDs without being refit.
+
     Args:
         df (pd.DataFrame): Dataframe containing user_id and item_id columns.
         user_col (str, optional): Column name for the users. Defaults to "user_id".
@@ -97,22 +668,14 @@ def transform_data_ids(
         reweight (bool, optional): Transform the interactions to binary yes or no
             interactions. Defaults to True.
     Return:
-        Tuple[pd.DataFrame, dict, dict]: The transformed dataframe along with the
-            lookup dicts used to translate between ID and index.
+        Tuple[pd.DataFrame, IdVocabulary, IdVocabulary]: The transformed dataframe
+            along with the user and item vocabularies used to translate between ID
+            and index.
     """
-    id_item_dict = list_to_indexed_dict(df[item_col])
-    id_user_dict = list_to_indexed_dict(df[user_col])
-
-    item_dict = {key: value for value, key in id_item_dict.items()}
-    user_dict = {key: value for value, key in id_user_dict.items()}
+    user_dict, df[user_col] = IdVocabulary.fit_transform(df[user_col])
+    item_dict, df[item_col] = IdVocabulary.fit_transform(df[item_col])
 
     if reweight:
-        weight_dict = {val: 1.0 for val in df[weight_col].unique()}
-    else:
-        weight_dict = {val: val for val in df[weight_col].unique()}
-
-    df[user_col] = df[user_col].map(user_dict)
-    df[item_col] = df[item_col].map(item_dict)
-    df[weight_col] = df[weight_col].map(weight_dict)
+        df[weight_col] = 1.0
 
     return (df, user_dict, item_dict)
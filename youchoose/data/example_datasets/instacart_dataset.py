@@ -18,6 +18,9 @@ def create_adjancency_matrix(db, save_folder="../../data/interim/", num_orders=1
     """
     Create and save a weighted adjacency matrix of the instacart database.
 
+    If the database was created with a cache_dir, repeated calls load the query
+    results from the columnar cache instead of re-running the joins.
+
     Args:
         db (Database): The connected instacart database.
         save_folder (str, optional): File location to save the data to. Defaults
@@ -0,0 +1,88 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Generate synthetic interactions shaped like the instacart data.
+
+The instacart prior orders hold about 32M order-product rows from 206k users
+and 50k products. Product popularity is heavily skewed, users differ widely in
+how much they order, and most products in an order are reorders. The generator
+reproduces these marginals at any size, for benchmarking without the database.
+"""
+import numpy as np
+import pandas as pd
+
+INSTACART_ROWS_PER_USER = 157
+INSTACART_PRODUCTS = 49688
+INSTACART_BASKET_SIZE = 10
+INSTACART_REORDER_RATE = 0.59
+
+
+def synthetic_instacart(
+    n_interactions: int,
+    n_users: int = None,
+    n_products: int = INSTACART_PRODUCTS,
+    reorder_rate: float = INSTACART_REORDER_RATE,
+    popularity_exponent: float = 0.75,
+    random_state: int = 23,
+) -> pd.DataFrame:
+    """
+    Generate order-product rows with instacart's shape.
+
+    Args:
+        n_interactions (int): Number of rows to generate.
+        n_users (int, optional): Number of users. Defaults to the instacart ratio
+            of about 157 rows per user.
+        n_products (int, optional): Number of products. Defaults to 49688.
+        reorder_rate (float, optional): Probability a row repeats a product the
+            user bought earlier. Defaults to 0.59.
+        popularity_exponent (float, optional): Exponent of the Zipf distribution
+            of product popularity. Defaults to 0.75.
+        random_state (int, optional): Seed of the generator. Defaults to 23.
+
+    Returns:
+        pd.DataFrame: The user_id, product_id, order_number, reordered, and
+            interaction columns, sorted by user and order.
+    """
+    rng = np.random.default_rng(random_state)
+    if n_users is None:
+        n_users = max(1, n_interactions // INSTACART_ROWS_PER_USER)
+
+    activity = rng.lognormal(sigma=1.0, size=n_users)
+    users = np.sort(rng.choice(n_users, n_interactions, p=activity / activity.sum()))
+
+    popularity = np.arange(1, n_products + 1, dtype=np.float64) ** -popularity_exponent
+    products = rng.permutation(n_products)[
+        rng.choice(n_products, n_interactions, p=popularity / popularity.sum())
+    ]
+
+    counts = np.bincount(users, minlength=n_users)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    position = np.arange(n_interactions) - starts
+
+    order = position // INSTACART_BASKET_SIZE
+    earlier_rows = order * INSTACART_BASKET_SIZE
+
+    # A reorder repeats the product of a random row from an earlier order.
+    reordered = (rng.random(n_interactions) < reorder_rate) & (order > 0)
+    earlier = starts + np.floor(rng.random(n_interactions) * earlier_rows).astype(
+        np.int64
+    )
+    # Follow chains of reorders back to the first purchase by pointer jumping.
+    source = np.where(reordered, earlier, np.arange(n_interactions))
+    while True:
+        jumped = source[source]
+        if np.array_equal(jumped, source):
+            break
+        source = jumped
+    products = products[source]
+
+    return pd.DataFrame(
+        {
+            "user_id": users.astype(np.int32),
+            "product_id": products.astype(np.int32),
+            "order_number": (order + 1).astype(np.int32),
+            "reordered": reordered.astype(np.int8),
+            "interaction": np.ones(n_interactions, dtype=np.float32),
+        }
+    )
@@ -3,4 +3,286 @@
 # See LICENCE file in root directory for full terms.
 """
  Library for extracting data from csv files.
+
+ Interaction files are read in chunks with only the user, item, and weight
+ columns parsed into compact dtypes. Large files can be parsed by several
+ processes at once, each reading a range of lines. The result is the encoded
+ arrays expected by `InteractionsDataset.from_arrays` rather than a dataframe.
 """
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ..data_processing import IdVocabulary
+from ..interaction_store import InteractionStore, InteractionStoreWriter
+
+SAMPLE_ROWS = 1000
+
+
+def iter_interaction_chunks(
+    filename: str,
+    user_col: str = "user_id",
+    item_col: str = "item_id",
+    weight_col: str = None,
+    dtypes: dict = None,
+    chunksize: int = 1000000,
+    n_jobs: int = 1,
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Read the user, item, and weight columns of an interaction csv file in chunks.
+
+    With n_jobs greater than one the file is split into byte ranges of about
+    chunksize lines, on line boundaries, which are parsed in separate processes.
+    At most two ranges per process are parsed ahead of the chunk being yielded,
+    so memory is bounded as in a single process. This assumes no quoted field
+    contains a newline.
+
+    Unless given in dtypes, the ID columns are parsed by the type of their first
+    rows: string IDs as categories, and integer IDs as int64, yielded as int32
+    when every ID of the chunk fits.
+
+    Args:
+        filename (str): Path to the csv file, with a header row.
+        user_col (str, optional): Column name for the users. Defaults to "user_id".
+        item_col (str, optional): Column name for the items. Defaults to "item_id".
+        weight_col (str, optional): Column name for the interaction metric. If None,
+            every interaction has a weight of 1. Defaults to None.
+        dtypes (dict, optional): Column name to dtype for parsing, overriding
+            the dtypes of the ID columns and the float32 weights. Defaults to
+            None.
+        chunksize (int, optional): Number of rows per chunk. Defaults to 1000000.
+        n_jobs (int, optional): Number of processes used to parse the file.
+            Defaults to 1.
+
+    Yields:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The raw user IDs, raw item IDs,
+            and float32 weights of the next chunk.
+    """
+    usecols = [user_col, item_col] + ([weight_col] if weight_col else [])
+    dtypes = dict(
+        _id_dtypes(filename, [user_col, item_col]),
+        **({weight_col: "float32"} if weight_col else {}),
+        **(dtypes or {})
+    )
+
+    if n_jobs > 1:
+        n_parts = -(-os.path.getsize(filename) // (chunksize * _line_bytes(filename)))
+        header, ranges = _line_ranges(filename, max(4 * n_jobs, n_parts))
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = deque()
+            for lo, hi in ranges:
+                futures.append(
+                    pool.submit(_read_range, filename, header, lo, hi, usecols, dtypes)
+                )
+                if len(futures) >= 2 * n_jobs:
+                    chunk = futures.popleft().result()
+                    yield _chunk_arrays(chunk, user_col, item_col, weight_col)
+            while futures:
+                chunk = futures.popleft().result()
+                yield _chunk_arrays(chunk, user_col, item_col, weight_col)
+        return
+
+    reader = pd.read_csv(filename, usecols=usecols, dtype=dtypes, chunksize=chunksize)
+    for chunk in reader:
+        yield _chunk_arrays(chunk, user_col, item_col, weight_col)
+
+
+def read_interactions(
+    filename: str,
+    user_col: str = "user_id",
+    item_col: str = "item_id",
+    weight_col: str = None,
+    reweight: bool = False,
+    **kwargs
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, IdVocabulary, IdVocabulary]:
+    """
+    Read an interaction csv file into encoded user, item, and weight arrays.
+
+    Users and items are indexed in sorted ID order, the same as
+    `transform_data_ids`, so the arrays can be passed straight to
+    `InteractionsDataset.from_arrays`.
+
+    Args:
+        filename (str): Path to the csv file, with a header row.
+        user_col (str, optional): Column name for the users. Defaults to "user_id".
+        item_col (str, optional): Column name for the items. Defaults to "item_id".
+        weight_col (str, optional): Column name for the interaction metric. If None,
+            every interaction has a weight of 1. Defaults to None.
+        reweight (bool, optional): Transform the interactions to binary yes or no
+            interactions. Defaults to False.
+        **kwargs (dict, optional): Additional arguments to pass to
+            `iter_interaction_chunks`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray, IdVocabulary, IdVocabulary]: The
+            int32 user and item indices, float32 weights, and the user and item
+            vocabularies.
+    """
+    chunks = list(
+        iter_interaction_chunks(
+            filename,
+            user_col=user_col,
+            item_col=item_col,
+            weight_col=weight_col,
+            **kwargs
+        )
+    )
+    raw_users, raw_items, weights = (_concat([c[i] for c in chunks]) for i in range(3))
+    del chunks
+
+    user_vocab, users = IdVocabulary.fit_transform(raw_users)
+    item_vocab, items = IdVocabulary.fit_transform(raw_items)
+
+    if reweight:
+        weights = np.ones(len(weights), dtype=np.float32)
+
+    return (
+        users.astype(np.int32),
+        items.astype(np.int32),
+        weights,
+        user_vocab,
+        item_vocab,
+    )
+
+
+def csv_to_store(
+    filename: str,
+    path: str,
+    user_col: str = "user_id",
+    item_col: str = "item_id",
+    weight_col: str = None,
+    user_vocab: IdVocabulary = None,
+    item_vocab: IdVocabulary = None,
+    reweight: bool = False,
+    **kwargs
+) -> Tuple[InteractionStore, IdVocabulary, IdVocabulary]:
+    """
+    Stream an interaction csv file into a memory-mapped interaction store.
+
+    Only one chunk is held in memory at a time. IDs are encoded with the given
+    vocabularies, which grow to include any new IDs, so new IDs are indexed in
+    the order they are first seen rather than sorted.
+
+    Args:
+        filename (str): Path to the csv file, with a header row.
+        path (str): Directory to write the interaction store to.
+        user_col (str, optional): Column name for the users. Defaults to "user_id".
+        item_col (str, optional): Column name for the items. Defaults to "item_id".
+        weight_col (str, optional): Column name for the interaction metric. If None,
+            every interaction has a weight of 1. Defaults to None.
+        user_vocab (IdVocabulary, optional): Existing user vocabulary to extend.
+            Defaults to a new vocabulary.
+        item_vocab (IdVocabulary, optional): Existing item vocabulary to extend.
+            Defaults to a new vocabulary.
+        reweight (bool, optional): Transform the interactions to binary yes or no
+            interactions. Defaults to False.
+        **kwargs (dict, optional): Additional arguments to pass to
+            `iter_interaction_chunks`.
+
+    Returns:
+        Tuple[InteractionStore, IdVocabulary, IdVocabulary]: The opened store and
+            the user and item vocabularies.
+    """
+    user_vocab = IdVocabulary() if user_vocab is None else user_vocab
+    item_vocab = IdVocabulary() if item_vocab is None else item_vocab
+    writer = InteractionStoreWriter(path)
+
+    for raw_users, raw_items, weights in iter_interaction_chunks(
+        filename, user_col=user_col, item_col=item_col, weight_col=weight_col, **kwargs
+    ):
+        if reweight:
+            weights = np.ones(len(weights), dtype=np.float32)
+        writer.append(
+            user_vocab.encode(raw_users, grow=True),
+            item_vocab.encode(raw_items, grow=True),
+            weights,
+        )
+
+    store = writer.close(n_users=len(user_vocab), n_items=len(item_vocab))
+
+    return store, user_vocab, item_vocab
+
+
+def _chunk_arrays(
+    chunk: pd.DataFrame, user_col: str, item_col: str, weight_col: str
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if weight_col:
+        weights = chunk[weight_col].to_numpy(dtype=np.float32)
+    else:
+        weights = np.ones(len(chunk), dtype=np.float32)
+
+    return (_compact_ids(chunk[user_col]), _compact_ids(chunk[item_col]), weights)
+
+
+def _compact_ids(column: pd.Series) -> np.ndarray:
+    ids = column.to_numpy()
+    if ids.dtype.kind in "iu" and len(ids):
+        int32 = np.iinfo(np.int32)
+        if int32.min <= ids.min() and ids.max() <= int32.max:
+            return ids.astype(np.int32)
+
+    return ids
+
+
+def _id_dtypes(filename: str, columns: List[str]) -> dict:
+    """
+    Parse integer ID columns as int64 and the others as categories, by the type
+    of their first rows.
+    """
+    sample = pd.read_csv(filename, usecols=columns, nrows=SAMPLE_ROWS)
+
+    return {
+        col: "int64" if sample[col].dtype.kind in "iu" else "category"
+        for col in columns
+    }
+
+
+def _line_bytes(filename: str) -> int:
+    """
+    Mean length of the first lines of a file in bytes.
+    """
+    with open(filename, "rb") as f:
+        block = f.read(2**16)
+
+    return max(1, len(block) // max(block.count(b"\n"), 1))
+
+
+def _concat(arrays: List[np.ndarray]) -> np.ndarray:
+    return np.concatenate(arrays) if arrays else np.zeros(0)
+
+
+def _line_ranges(filename: str, n_parts: int) -> Tuple[bytes, List[Tuple[int, int]]]:
+    """
+    Split the body of a csv file into byte ranges that start on new lines.
+    """
+    size = os.path.getsize(filename)
+
+    with open(filename, "rb") as f:
+        header = f.readline()
+        bounds = [f.tell()]
+        body = size - bounds[0]
+
+        for part in range(1, n_parts):
+            f.seek(max(bounds[0] + body * part // n_parts, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+
+    bounds.append(size)
+    ranges = [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if lo < hi]
+
+    return header, ranges
+
+
+def _read_range(
+    filename: str, header: bytes, lo: int, hi: int, usecols: list, dtypes: dict
+) -> pd.DataFrame:
+    with open(filename, "rb") as f:
+        f.seek(lo)
+        data = f.read(hi - lo)
+
+    return pd.read_csv(io.BytesIO(header + data), usecols=usecols, dtype=dtypes)
@@ -6,8 +6,18 @@ Library of functions used to connect and query a SQL database. Connections can b
 either local or remote and are connected using using SQLAlchemy. A SSH tunnel can
 be set-up if the remote database is not directly accessable.
 """
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
 import pandas as pd
-from sqlalchemy import MetaData, create_engine
+from sqlalchemy import MetaData, create_engine, inspect
 
 # from sqlalchemy.engine.base import Engine
 
@@ -20,7 +30,15 @@ class SQLDatabase:
     Some more info about the class attributes and functions.
     """
 
-    def __init__(self, db_type="psql", db_name="", engine=None, tunnel=None):
+    def __init__(
+        self,
+        db_type="psql",
+        db_name="",
+        engine=None,
+        tunnel=None,
+        cache_dir=None,
+        cache_format="npy",
+    ):
         """
         Initialize the database class with the path to the env file containing
         the database credentials
@@ -35,6 +53,12 @@ class SQLDatabase:
                 Defaults to None.
             tunnel (sshtunnel.SSHTunnelForwarder, optional): The ssh tunnel
                 through which to connect to the database. Defaults to None.
+            cache_dir (str, optional): Directory to cache query results in. Results
+                are reused while the query text and the row fingerprints of the
+                tables it reads are unchanged. Defaults to None, no caching.
+            cache_format (str, optional): Format of the cached results, npy, or
+                parquet or feather, which require pyarrow. See `QueryCache`.
+                Defaults to "npy".
 
         Raises:
             ValueError: If the connection type provided is not a psql or sqlite
@@ -53,6 +77,11 @@ class SQLDatabase:
 
         self.tunnel = tunnel
         self.engine = engine
+        self.cache = (
+            QueryCache(cache_dir, format=cache_format)
+            if cache_dir is not None
+            else None
+        )
         self.conn = self.engine.connect()
 
         self.metadata = MetaData()
@@ -61,27 +90,145 @@ class SQLDatabase:
         self.tables = self.metadata.tables
         self.table_names = self.tables.keys()
 
-    def get_dataframe(self, query: str) -> pd.DataFrame:
+    def get_dataframe(
+        self,
+        query: str,
+        chunksize: int = 100000,
+        dtypes: dict = None,
+        use_cache: bool = True,
+    ) -> pd.DataFrame:
         """
         Execute the query on the connected database and return a pandas dataframe.
 
+        Rows are fetched and converted in chunks so only one chunk of python row
+        objects is held in memory alongside the result.
+
         Args:
             query (str): SQL query
+            chunksize (int, optional): Number of rows fetched at a time. Defaults
+                to 100000.
+            dtypes (dict, optional): Column name to dtype used to store the result
+                compactly, e.g. {"user_id": "int32"}. Defaults to None.
+            use_cache (bool, optional): Load and store the result in the query cache
+                if the database was created with a cache_dir. Defaults to True.
 
         Returns:
             queried_df (pd.DataFrame): Results of the sql query returned as a dataframe
                 with headings included.
         """
-        result_proxy = self.conn.execute(query)
-        headings = result_proxy.keys()
-        data = []
-        for row in result_proxy:
-            data.append(row.values())
+        if use_cache and self.cache is not None:
+            key = self.cache.key(query, self.table_fingerprints(query), dtypes)
+            queried_df = self.cache.load(key)
+            if queried_df is not None:
+                return queried_df
+
+        chunks = list(self.iter_dataframes(query, chunksize=chunksize, dtypes=dtypes))
+        queried_df = pd.concat(chunks, ignore_index=True)
 
-        queried_df = pd.DataFrame(data, columns=headings)
+        if use_cache and self.cache is not None:
+            self.cache.save(key, queried_df)
 
         return queried_df
 
+    def table_fingerprints(self, query: str) -> dict:
+        """
+        Fingerprint the tables a query reads from so cached results can be
+        invalidated when the tables change.
+
+        Table names are matched to the words of the query case-insensitively.
+        Postgres tables are fingerprinted by their insert, update, and delete
+        counters. Other databases are fingerprinted by the number of rows in the
+        table, plus the modification time and size of the database file for
+        sqlite, so any write to a sqlite file invalidates its cached results.
+        On other databases an UPDATE that keeps the number of rows is not
+        detected, so query with use_cache=False, or clear the cache, after one.
+
+        Args:
+            query (str): SQL query
+
+        Returns:
+            dict: Table name to fingerprint for every table named in the query.
+        """
+        words = set(re.findall(r"\w+", query.lower()))
+        tables = sorted(
+            t for t in inspect(self.engine).get_table_names() if t.lower() in words
+        )
+
+        fingerprints = {}
+        stamp = self._file_stamp()
+        for table in tables:
+            if self.engine.dialect.name == "postgresql":
+                stats_query = (
+                    "SELECT n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables "
+                    "WHERE relname = '{}';".format(table.replace("'", "''"))
+                )
+            else:
+                stats_query = "SELECT COUNT(*) FROM {};".format(
+                    self.engine.dialect.identifier_preparer.quote(table)
+                )
+            row = self.conn.execute(stats_query).fetchone()
+            fingerprints[table] = list(row or []) + stamp
+
+        return fingerprints
+
+    def _file_stamp(self) -> list:
+        """
+        The modification time and size of a sqlite database file and its write
+        ahead log, empty for other databases.
+        """
+        database = self.engine.url.database
+        if self.engine.dialect.name != "sqlite" or not database:
+            return []
+
+        stamp = []
+        for path in (Path(database), Path(database + "-wal")):
+            if path.exists():
+                stat = path.stat()
+                stamp += [stat.st_mtime_ns, stat.st_size]
+
+        return stamp
+
+    def iter_dataframes(
+        self, query: str, chunksize: int = 100000, dtypes: dict = None
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Execute the query and yield the results as dataframes of at most
+        chunksize rows.
+
+        The query is run with a server-side cursor where the database driver
+        supports it (e.g. psycopg2), so the full result is never held in memory.
+
+        Args:
+            query (str): SQL query
+            chunksize (int, optional): Number of rows in each dataframe. Defaults
+                to 100000.
+            dtypes (dict, optional): Column name to dtype to cast each chunk to.
+                Defaults to None.
+
+        Yields:
+            pd.DataFrame: The next chunk of the query results. A query without
+                rows yields a single empty dataframe with the result headings.
+        """
+        if chunksize < 1:
+            raise ValueError("The chunksize must be a positive integer.")
+
+        result_proxy = self.conn.execution_options(stream_results=True).execute(query)
+        headings = result_proxy.keys()
+
+        try:
+            empty = True
+            while True:
+                rows = result_proxy.fetchmany(chunksize)
+                if not rows:
+                    break
+                empty = False
+                yield _typed_dataframe(rows, headings, dtypes)
+
+            if empty:
+                yield _typed_dataframe([], headings, dtypes)
+        finally:
+            result_proxy.close()
+
     def save_layout(self, filename: str):
         """
         Save the layout of the database to file.
@@ -103,6 +250,150 @@ class SQLDatabase:
             self.tunnel.close()
 
 
+class QueryCache:
+    """
+    On-disk cache of query results stored column by column as .npy files.
+
+    Each result is saved in a directory named after the hash of the normalized
+    query text, the fingerprints of the tables it reads, and any dtype hints.
+    Loading a cached result reads the binary columns directly without any
+    parsing. With format="parquet" or "feather" the result is instead written
+    compressed with pandas, which requires pyarrow to be installed.
+    """
+
+    def __init__(self, cache_dir: str, format: str = "npy"):
+        """
+        Args:
+            cache_dir (str): Directory where cached results are written.
+            format (str, optional): One of npy, parquet, or feather. Defaults
+                to "npy".
+
+        Raises:
+            ValueError: If the format is not supported.
+        """
+        if format not in ["npy", "parquet", "feather"]:
+            raise ValueError("Cache format must be npy, parquet, or feather.")
+
+        self.cache_dir = Path(cache_dir)
+        self.format = format
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """
+        Collapse whitespace and drop the trailing semicolon of a query.
+        """
+        return " ".join(query.split()).rstrip("; ")
+
+    def key(self, query: str, fingerprints: dict = None, dtypes: dict = None) -> str:
+        """
+        Hash the query, table fingerprints, and dtypes into a cache key.
+        """
+        payload = json.dumps(
+            [self.normalize(query), fingerprints or {}, dtypes or {}],
+            sort_keys=True,
+            default=str,
+        )
+
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def path(self, key: str) -> Path:
+        if self.format == "npy":
+            return self.cache_dir / key
+
+        return self.cache_dir / "{}.{}".format(key, self.format)
+
+    def load(self, key: str) -> pd.DataFrame:
+        """
+        Load a cached result, returning None if the key is not in the cache.
+        """
+        path = self.path(key)
+        if not path.exists():
+            return None
+
+        if self.format == "parquet":
+            return pd.read_parquet(path)
+        if self.format == "feather":
+            return pd.read_feather(path)
+
+        # Only the columns the cache pickled are unpickled, so a tampered cache
+        # directory cannot run code when read.
+        with open(path / "columns.json", "r") as f:
+            meta = json.load(f)
+        if isinstance(meta, list):
+            # Written before the pickled columns were recorded.
+            meta = {"columns": meta, "pickled": []}
+        columns, pickled = meta["columns"], set(meta["pickled"])
+
+        return pd.DataFrame(
+            {
+                name: np.load(path / "{}.npy".format(idx), allow_pickle=idx in pickled)
+                for idx, name in enumerate(columns)
+            },
+            columns=columns,
+        )
+
+    def save(self, key: str, df: pd.DataFrame):
+        """
+        Write a result to the cache. The write is atomic so concurrent readers
+        never see a partially written result.
+        """
+        path = self.path(key)
+        tmp_path = Path(tempfile.mkdtemp(dir=self.cache_dir))
+
+        if self.format == "parquet":
+            df.to_parquet(tmp_path / "result")
+            os.replace(tmp_path / "result", path)
+            shutil.rmtree(tmp_path)
+            return
+        if self.format == "feather":
+            df.reset_index(drop=True).to_feather(tmp_path / "result")
+            os.replace(tmp_path / "result", path)
+            shutil.rmtree(tmp_path)
+            return
+
+        columns = [str(col) for col in df.columns]
+        pickled = []
+        for idx, col in enumerate(df.columns):
+            values = df[col].to_numpy()
+            if values.dtype == object:
+                pickled.append(idx)
+            np.save(
+                tmp_path / "{}.npy".format(idx),
+                values,
+                allow_pickle=values.dtype == object,
+            )
+        with open(tmp_path / "columns.json", "w") as f:
+            json.dump({"columns": columns, "pickled": pickled}, f)
+
+        if path.exists():
+            shutil.rmtree(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+
+    def clear(self):
+        """
+        Remove every cached result.
+        """
+        for path in self.cache_dir.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+
+def _typed_dataframe(rows: list, headings: list, dtypes: dict = None) -> pd.DataFrame:
+    """
+    Build a dataframe from fetched rows and cast columns to the requested dtypes.
+    """
+    df = pd.DataFrame.from_records(rows, columns=headings)
+
+    if dtypes:
+        df = df.astype({col: dtype for col, dtype in dtypes.items() if col in df})
+
+    return df
+
+
 def psql_engine(tunnel=None):
     """
     Create a sqlalchmey engine used for creating the database connection.
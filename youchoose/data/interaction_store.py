@@ -0,0 +1,301 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Binary, memory-mapped storage of user-item interactions.
+
+A store is a directory of raw little-endian arrays (int32 users and items,
+float32 weights) described by a metadata file. Opening a store memory maps the
+arrays so they can be wrapped as torch tensors without copying, and only the
+pages that are read are loaded from disk.
+"""
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .data_processing import ItemSetIndex
+
+STORE_DTYPES = {
+    "users": np.dtype("<i4"),
+    "items": np.dtype("<i4"),
+    "weights": np.dtype("<f4"),
+}
+INDEX_DTYPES = {"indptr": np.dtype("<i8"), "indices": np.dtype("<i4")}
+CHUNK_SIZE = 2**22
+
+
+class InteractionStore:
+    """
+    User-item interactions stored as memory-mapped arrays.
+    """
+
+    def __init__(self, path: str, mmap_mode: str = "c"):
+        """
+        Open an existing interaction store.
+
+        Args:
+            path (str): The directory of the store.
+            mmap_mode (str, optional): The numpy memmap mode. The default
+                copy-on-write mode gives writable arrays, which torch requires,
+                while never modifying the files. Defaults to "c".
+
+        Raises:
+            ValueError: If the directory does not contain an interaction store.
+        """
+        self.path = Path(path)
+        if not (self.path / "meta.json").exists():
+            raise ValueError("No interaction store found at {}.".format(path))
+
+        with open(self.path / "meta.json", "r") as f:
+            self.meta = json.load(f)
+
+        self.mmap_mode = mmap_mode
+        self.n_users = self.meta["n_users"]
+        self.n_items = self.meta["n_items"]
+        self.users = self._open("users", STORE_DTYPES["users"], len(self))
+        self.items = self._open("items", STORE_DTYPES["items"], len(self))
+        self.weights = self._open("weights", STORE_DTYPES["weights"], len(self))
+
+    def __len__(self):
+        return self.meta["size"]
+
+    @classmethod
+    def write(
+        cls,
+        path: str,
+        users: np.ndarray,
+        items: np.ndarray,
+        weights: np.ndarray,
+        n_users: int = None,
+        n_items: int = None,
+        build_index: bool = True,
+    ) -> "InteractionStore":
+        """
+        Write interactions to a new store and open it.
+
+        Args:
+            path (str): The directory to write the store to.
+            users (np.ndarray): User index of each interaction.
+            items (np.ndarray): Item index of each interaction.
+            weights (np.ndarray): Weight of each interaction.
+            n_users (int, optional): Number of users. Defaults to the largest user
+                index plus one.
+            n_items (int, optional): Number of items. Defaults to the largest item
+                index plus one.
+            build_index (bool, optional): Also store the per-user positive item
+                index used for negative sampling. Defaults to True.
+
+        Returns:
+            InteractionStore: The opened store.
+        """
+        writer = InteractionStoreWriter(path)
+        writer.append(users, items, weights)
+
+        return writer.close(n_users=n_users, n_items=n_items, build_index=build_index)
+
+    @classmethod
+    def from_dataframe(
+        cls,
+        path: str,
+        df: pd.DataFrame,
+        user_col: str = "user_id",
+        item_col: str = "item_id",
+        weight_col: str = "interaction",
+        **kwargs
+    ) -> "InteractionStore":
+        """
+        Write the interactions of an indexed dataframe to a new store.
+        """
+        return cls.write(
+            path,
+            df[user_col].to_numpy(),
+            df[item_col].to_numpy(),
+            df[weight_col].to_numpy(),
+            **kwargs
+        )
+
+    def item_sets(self) -> ItemSetIndex:
+        """
+        The items each user has interacted with, memory mapped from the stored
+        index, which is built first if the store does not have one.
+        """
+        if "index_size" not in self.meta:
+            self.build_index()
+
+        indptr = self._open("indptr", INDEX_DTYPES["indptr"], self.n_users + 1)
+        indices = self._open(
+            "indices", INDEX_DTYPES["indices"], self.meta["index_size"]
+        )
+
+        return ItemSetIndex(indptr, indices)
+
+    def build_index(self, chunk_size: int = CHUNK_SIZE):
+        """
+        Build and store the per-user positive item index.
+
+        The index is built in passes over chunks of the interactions, so memory
+        is bounded by the chunk size and the number of users rather than the
+        size of the store: the first pass counts the interactions of each user,
+        the second scatters the items of each chunk to their user's segment of
+        the memory mapped indices, and the last sorts and deduplicates the
+        segments of consecutive users, compacting them in place.
+
+        Args:
+            chunk_size (int, optional): Number of interactions read at a time.
+                Defaults to 2**22.
+        """
+        counts = np.zeros(self.n_users, dtype=np.int64)
+        for users, _ in self._chunks(chunk_size):
+            counts += np.bincount(users, minlength=self.n_users)
+
+        indptr = np.zeros(self.n_users + 1, dtype=INDEX_DTYPES["indptr"])
+        np.cumsum(counts, out=indptr[1:])
+        filename = self.path / "indices.bin"
+        if not len(self):
+            np.zeros(0, dtype=INDEX_DTYPES["indices"]).tofile(filename)
+            indptr.tofile(self.path / "indptr.bin")
+            self.meta["index_size"] = 0
+            _write_meta(self.path, self.meta)
+            return
+
+        indices = np.memmap(
+            filename, dtype=INDEX_DTYPES["indices"], mode="w+", shape=(len(self),)
+        )
+        cursor = indptr[:-1].copy()
+        for users, items in self._chunks(chunk_size):
+            order = np.argsort(users, kind="stable")
+            users, items = users[order], items[order]
+            starts = np.searchsorted(users, users, side="left")
+            indices[cursor[users] + np.arange(len(users)) - starts] = items
+            cursor += np.bincount(users, minlength=self.n_users)
+
+        size = 0
+        start = 0
+        while start < self.n_users:
+            stop = int(np.searchsorted(indptr, indptr[start] + chunk_size, "right"))
+            stop = min(max(stop - 1, start + 1), self.n_users)
+            block = np.repeat(np.arange(start, stop), counts[start:stop])
+            segment = np.array(indices[indptr[start] : indptr[stop]])
+
+            order = np.lexsort((segment, block))
+            block, segment = block[order], segment[order]
+            keep = np.ones(len(block), dtype=bool)
+            keep[1:] = (block[1:] != block[:-1]) | (segment[1:] != segment[:-1])
+
+            indices[size : size + keep.sum()] = segment[keep]
+            size += int(keep.sum())
+            counts[start:stop] = np.bincount(
+                block[keep] - start, minlength=stop - start
+            )
+            start = stop
+
+        indices.flush()
+        del indices
+        os.truncate(filename, size * INDEX_DTYPES["indices"].itemsize)
+        np.cumsum(counts, out=indptr[1:])
+        indptr.tofile(self.path / "indptr.bin")
+
+        self.meta["index_size"] = size
+        _write_meta(self.path, self.meta)
+
+    def _chunks(self, chunk_size: int):
+        for start in range(0, len(self), chunk_size):
+            stop = start + chunk_size
+            yield (
+                np.asarray(self.users[start:stop], dtype=np.int64),
+                np.asarray(self.items[start:stop], dtype=np.int64),
+            )
+
+    def _open(self, name: str, dtype: np.dtype, size: int) -> np.ndarray:
+        if not size:
+            return np.zeros(0, dtype=dtype)
+
+        return np.memmap(
+            self.path / "{}.bin".format(name),
+            dtype=dtype,
+            mode=self.mmap_mode,
+            shape=(size,),
+        )
+
+
+class InteractionStoreWriter:
+    """
+    Write interactions to a store in chunks, e.g. while streaming a query or a
+    csv file that does not fit in memory.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): The directory to write the store to. Any existing store in
+                the directory is overwritten.
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.size = 0
+        self.max_user = -1
+        self.max_item = -1
+        self.files = {
+            name: open(self.path / "{}.bin".format(name), "wb") for name in STORE_DTYPES
+        }
+        if (self.path / "meta.json").exists():
+            (self.path / "meta.json").unlink()
+
+    def append(self, users: np.ndarray, items: np.ndarray, weights: np.ndarray):
+        """
+        Append a chunk of interactions to the store.
+        """
+        chunk = {"users": users, "items": items, "weights": weights}
+        lengths = {len(values) for values in chunk.values()}
+        if len(lengths) != 1:
+            raise ValueError("Users, items, and weights must be the same length.")
+
+        for name, values in chunk.items():
+            np.asarray(values).astype(STORE_DTYPES[name]).tofile(self.files[name])
+
+        if len(users):
+            self.max_user = max(self.max_user, int(np.max(users)))
+            self.max_item = max(self.max_item, int(np.max(items)))
+        self.size += lengths.pop()
+
+    def close(
+        self, n_users: int = None, n_items: int = None, build_index: bool = True
+    ) -> InteractionStore:
+        """
+        Finish writing the store and open it.
+
+        Args:
+            n_users (int, optional): Number of users. Defaults to the largest user
+                index plus one.
+            n_items (int, optional): Number of items. Defaults to the largest item
+                index plus one.
+            build_index (bool, optional): Also store the per-user positive item
+                index used for negative sampling. Defaults to True.
+
+        Returns:
+            InteractionStore: The opened store.
+        """
+        for f in self.files.values():
+            f.close()
+
+        meta = {
+            "size": self.size,
+            "n_users": self.max_user + 1 if n_users is None else n_users,
+            "n_items": self.max_item + 1 if n_items is None else n_items,
+            "dtypes": {name: dtype.str for name, dtype in STORE_DTYPES.items()},
+        }
+        _write_meta(self.path, meta)
+
+        store = InteractionStore(self.path)
+        if build_index:
+            store.build_index()
+
+        return store
+
+
+def _write_meta(path: Path, meta: dict):
+    with open(path / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
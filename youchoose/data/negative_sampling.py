@@ -0,0 +1,109 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Negative sampling library.
+
+Negative items are drawn for a whole batch of users at once by rejection
+sampling against a sorted, per-user (CSR) index of positive interactions. The
+cost of sampling scales with the number of negatives requested rather than with
+the size of the item catalog.
+"""
+import numpy as np
+
+from .data_processing import ItemSetIndex
+
+
+class NegativeSampler:
+    """
+    Draw items a user has not interacted with, for a batch of users at once.
+    """
+
+    def __init__(
+        self,
+        positives: ItemSetIndex,
+        n_items: int,
+        max_rounds: int = 10,
+        random_state: int = None,
+    ):
+        """
+        Initialize the sampler with the index of positive interactions.
+
+        Args:
+            positives (ItemSetIndex): The items each user has interacted with.
+            n_items (int): Number of items to draw negatives from.
+            max_rounds (int, optional): Number of rejection rounds before the
+                remaining draws fall back to sampling from the exact complement
+                of the user's items. Defaults to 10.
+            random_state (int, optional): Seed for the random number generator.
+                Defaults to None, using the global numpy random state.
+        """
+        self.positives = positives
+        self.n_items = n_items
+        self.max_rounds = max_rounds
+        self.rng = (
+            np.random if random_state is None else np.random.RandomState(random_state)
+        )
+
+    def __getstate__(self):
+        # The global numpy random state is a module, which cannot be pickled, so
+        # a sampler sent to a spawned worker uses the worker's global state.
+        state = dict(self.__dict__)
+        if state["rng"] is np.random:
+            state["rng"] = None
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.rng is None:
+            self.rng = np.random
+
+    @classmethod
+    def from_interactions(cls, users, items, n_items: int, **kwargs):
+        """
+        Create a sampler from the user and item index of each positive interaction.
+        """
+        return cls(ItemSetIndex.from_arrays(users, items), n_items, **kwargs)
+
+    def sample(self, users, num_negs: int) -> np.ndarray:
+        """
+        Sample negative items for each user in a batch.
+
+        Args:
+            users (np.ndarray): User indices to sample negatives for.
+            num_negs (int): The number of negative items to draw per user.
+
+        Raises:
+            ValueError: If a user has interacted with every item.
+
+        Returns:
+            np.ndarray: Array of shape ``(len(users), num_negs)`` of item indices.
+        """
+        users = np.asarray(users, dtype=np.int64).reshape(-1)
+        rows = np.repeat(users, num_negs)
+        negs = self.rng.randint(0, self.n_items, size=len(rows))
+
+        pending = np.flatnonzero(self.positives.contains(rows, negs))
+        for _ in range(self.max_rounds):
+            if not len(pending):
+                break
+            negs[pending] = self.rng.randint(0, self.n_items, size=len(pending))
+            pending = pending[self.positives.contains(rows[pending], negs[pending])]
+
+        for pos in pending:
+            negs[pos] = self._sample_complement(rows[pos])
+
+        return negs.reshape(len(users), num_negs)
+
+    def _sample_complement(self, user: int) -> int:
+        """
+        Exact fallback for users who have interacted with most of the catalog.
+        """
+        seen = self.positives[user]
+        candidates = np.setdiff1d(np.arange(self.n_items), seen, assume_unique=True)
+
+        if not len(candidates):
+            raise ValueError(f"User {user} has interacted with every item.")
+
+        return self.rng.choice(candidates)
@@ -0,0 +1,198 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Ranking metrics for recommendations over the full item catalog.
+
+Every user is scored against every item, with the items seen in training
+excluded, and the held out items are treated as the relevant ones. Users are
+scored in blocks, and all the metrics of a block are computed with a few tensor
+operations, so memory is bounded by user_block_size x n_items scores.
+"""
+import numpy as np
+import torch
+
+from ..data.data_processing import ItemSetIndex
+from ..recommender.nn_layers import QuantizedEmbedding
+from ..utils.logging import NULL_PROFILER
+
+
+def ranking_metrics(
+    user_table: torch.Tensor,
+    item_table: torch.Tensor,
+    test: ItemSetIndex,
+    train: ItemSetIndex = None,
+    k: int = 10,
+    users=None,
+    user_block_size: int = 1024,
+    profiler=None,
+) -> dict:
+    """
+    Mean AUC, precision@k, recall@k, NDCG@k, and MAP@k over users.
+
+    Held out items the user also interacted with in training are not counted
+    as relevant. Tied scores count as misordered in the AUC.
+
+    Args:
+        user_table (torch.Tensor): The (n_users, n_factors) user vectors.
+        item_table (torch.Tensor): The (n_items, n_factors) item vectors.
+        test (ItemSetIndex): The relevant held out items of each user.
+        train (ItemSetIndex, optional): The items of each user seen in training,
+            which are never ranked. Defaults to None.
+        k (int, optional): The cutoff of the top k metrics. Defaults to 10.
+        users (Sequence[int], optional): The users to evaluate. Defaults to every
+            user with a held out item.
+        user_block_size (int, optional): Number of users scored at once.
+            Defaults to 1024.
+        profiler (TrainingProfiler, optional): Records the time of scoring, the
+            top k metrics, and the AUC in its "ranking" section. Defaults to None.
+
+    Returns:
+        dict: The mean of each metric over the users with a relevant item, and
+            the number of those users.
+    """
+    profiler = profiler or NULL_PROFILER
+    n_items = len(item_table)
+    k = min(k, n_items)
+    if users is None:
+        users = np.flatnonzero(test.counts())
+    users = np.asarray(users, dtype=np.int64).reshape(-1)
+
+    dev = item_table.device
+    discounts = 1 / torch.log2(torch.arange(2, k + 2, dtype=torch.float64))
+    ideal = torch.cumsum(discounts, 0)
+    cutoff_ranks = torch.arange(1, k + 1, dtype=torch.float64)
+
+    totals = torch.zeros(5, dtype=torch.float64)
+    n_evaluated = 0
+    n_auc = 0
+
+    profiler.start("ranking", dev)
+    with torch.no_grad():
+        for lo in range(0, len(users), user_block_size):
+            block = users[lo : lo + user_block_size]
+            with profiler.phase("score"):
+                scores = user_table[torch.from_numpy(block).to(dev)] @ item_table.t()
+
+                n_excluded = np.zeros(len(block), dtype=np.int64)
+                positions, items = test.pairs(block)
+                if train is not None:
+                    seen_positions, seen = train.pairs(block)
+                    scores[_on(seen_positions, dev), _on(seen, dev)] = -float("inf")
+                    n_excluded = np.bincount(seen_positions, minlength=len(block))
+
+                    keep = ~train.contains(block[positions], items)
+                    positions, items = positions[keep], items[keep]
+
+            n_relevant = np.bincount(positions, minlength=len(block))
+            rated = n_relevant > 0
+            profiler.step(len(block))
+            if not rated.any():
+                continue
+
+            # Top k metrics.
+            with profiler.phase("top_k"):
+                top_scores, top_items = torch.topk(scores, k, dim=1)
+                top_items = top_items.cpu().numpy()
+                hits = test.contains(np.repeat(block, k), top_items.ravel())
+                hits = torch.from_numpy(hits.reshape(-1, k)).double()
+                hits = hits * torch.isfinite(top_scores).cpu()
+
+                n_hits = hits.sum(1)
+                relevant = torch.from_numpy(n_relevant).double()
+                n_ideal = torch.from_numpy(np.minimum(n_relevant, k))
+
+                precision = n_hits / k
+                recall = n_hits / relevant.clamp(min=1)
+                ndcg = (hits * discounts).sum(1) / ideal[(n_ideal - 1).clamp(min=0)]
+                average_precision = (hits.cumsum(1) / cutoff_ranks * hits).sum(1) / (
+                    n_ideal.clamp(min=1)
+                )
+
+            # AUC from the number of items scored below each relevant item,
+            # compared in chunks of relevant pairs to bound the memory.
+            with profiler.phase("auc"):
+                rows, items = _on(positions, dev), _on(items, dev)
+                relevant_scores = scores[rows, items]
+                below = torch.zeros(len(block), dtype=torch.float64)
+                chunk = max(1, 2**24 // n_items)
+                for c_lo in range(0, len(rows), chunk):
+                    c_rows = rows[c_lo : c_lo + chunk]
+                    counts = _count_below(
+                        scores, c_rows, relevant_scores[c_lo : c_lo + chunk]
+                    )
+                    below.index_add_(0, c_rows.cpu(), counts)
+                below -= torch.from_numpy(n_excluded * n_relevant).double()
+
+            n_negative = torch.from_numpy(n_items - n_excluded - n_relevant).double()
+            auc = (below - relevant * (relevant - 1) / 2) / (
+                (relevant * n_negative).clamp(min=1)
+            )
+            has_auc = torch.from_numpy(rated) & (n_negative > 0)
+
+            mask = torch.from_numpy(rated).double()
+            totals += torch.stack(
+                (
+                    (auc * has_auc).sum(),
+                    (precision * mask).sum(),
+                    (recall * mask).sum(),
+                    (ndcg * mask).sum(),
+                    (average_precision * mask).sum(),
+                )
+            )
+            n_evaluated += int(rated.sum())
+            n_auc += int(has_auc.sum())
+
+    profiler.stop()
+
+    means = totals / max(n_evaluated, 1)
+    means[0] = totals[0] / max(n_auc, 1)
+
+    return {
+        "auc": float(means[0]),
+        "precision@{}".format(k): float(means[1]),
+        "recall@{}".format(k): float(means[2]),
+        "ndcg@{}".format(k): float(means[3]),
+        "map@{}".format(k): float(means[4]),
+        "users": n_evaluated,
+    }
+
+
+def evaluate_model(model, test: ItemSetIndex, train: ItemSetIndex = None, **kwargs):
+    """
+    Ranking metrics of a model with a ``folded_factors`` method, such as
+    `NNMatrixFactorization` or `ImplicitALS`. See `ranking_metrics`.
+
+    When the model has the lower precision tables of its ``quantize`` method,
+    they are the ones evaluated, so the metrics are those of the recommendations
+    it serves. Tables in a lower precision than float32 are scored in float32.
+    """
+    tables = getattr(model, "inference_tables", None) or model.folded_factors()
+    user_table, item_table = (_float_table(table) for table in tables)
+
+    return ranking_metrics(user_table, item_table, test, train=train, **kwargs)
+
+
+def _float_table(table) -> torch.Tensor:
+    if isinstance(table, QuantizedEmbedding):
+        return table.dequantize()
+    if table.element_size() < 4:
+        return table.float()
+
+    return table
+
+
+def _on(indices: np.ndarray, dev: torch.device) -> torch.Tensor:
+    return torch.from_numpy(indices.astype(np.int64)).to(dev)
+
+
+def _count_below(scores: torch.Tensor, rows: torch.Tensor, values: torch.Tensor):
+    """
+    Count the scores in each row that are below the paired value. Numpy's
+    comparison and count are several times faster than torch's on the cpu.
+    """
+    if scores.device.type == "cpu":
+        below = scores.numpy()[rows.numpy()] < values.numpy()[:, None]
+        return torch.from_numpy(np.count_nonzero(below, axis=1)).double()
+
+    return (scores[rows] < values[:, None]).sum(1).double().cpu()
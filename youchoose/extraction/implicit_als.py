@@ -0,0 +1,399 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Implicit feedback alternating least squares library.
+
+The interaction weights are treated as confidences ``c = 1 + alpha * w`` that
+each user prefers the items they interacted with, following Hu, Koren, and
+Volinsky (2008). Each half step fixes one factor matrix and solves the
+regularized least squares problem of every row of the other. Rows are solved
+in blocks with vectorized tensor operations over a CSR matrix of the
+interactions, and the blocks are spread across a thread pool, as torch
+releases the GIL while computing.
+"""
+import os
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from ..data.data_processing import IdVocabulary, ItemSetIndex
+from ..interaction.pointwise import quantize_tables, top_k_scores
+from ..utils.checkpoint import (
+    constructor_config,
+    load_checkpoint,
+    object_path,
+    save_checkpoint,
+)
+from ..utils.logging import NULL_PROFILER
+
+
+class ImplicitALS:
+    """Implicit feedback matrix factorization by alternating least squares."""
+
+    def __init__(
+        self,
+        n_users: int,
+        n_products: int,
+        n_factors: int = 20,
+        reg: float = 0.01,
+        alpha: float = 40.0,
+        iterations: int = 15,
+        solver: str = "cg",
+        cg_steps: int = 3,
+        n_jobs: int = None,
+        block_nnz: int = 2**16,
+        random_state: int = 23,
+    ):
+        """
+        Initalize the user and product factors in latent space.
+
+        Args:
+            n_users (int): Number of users with prior purchases.
+            n_products (int): Total number of products purchased.
+            n_factors (int, optional): Dimension of the latent embedding space.
+                Defaults to 20.
+            reg (float, optional): L2 regularization on the factors. Defaults to
+                0.01.
+            alpha (float, optional): Scale from interaction weight to confidence.
+                Defaults to 40.0.
+            iterations (int, optional): Number of alternating user and product
+                updates. Defaults to 15.
+            solver (str, optional): "cg" for a few conjugate gradient steps warm
+                started from the current factors, or "cholesky" for an exact solve
+                of every row. Defaults to "cg".
+            cg_steps (int, optional): Conjugate gradient steps per update.
+                Defaults to 3.
+            n_jobs (int, optional): Number of threads solving blocks of rows.
+                The cpus are divided between them, each running torch with its
+                share of the intra-op threads, so 1 solves one block at a time
+                with every intra-op thread. Defaults to None, the number of cpus
+                when fitting.
+            block_nnz (int, optional): Approximate number of interactions in each
+                block of rows. Defaults to 65536.
+            random_state (int, optional): Seed for the initial factors. Defaults
+                to 23.
+        """
+        if solver not in ("cg", "cholesky"):
+            raise ValueError("solver must be one of cg or cholesky.")
+
+        self.n_users = n_users
+        self.n_products = n_products
+        self.n_factors = n_factors
+        self.reg = reg
+        self.alpha = alpha
+        self.iterations = iterations
+        self.solver = solver
+        self.cg_steps = cg_steps
+        self.n_jobs = n_jobs
+        self.block_nnz = block_nnz
+
+        generator = torch.Generator().manual_seed(random_state)
+        self.user_factors = 0.01 * torch.randn(n_users, n_factors, generator=generator)
+        self.product_factors = 0.01 * torch.randn(
+            n_products, n_factors, generator=generator
+        )
+        self.train_stats = {}
+        self.inference_tables = None
+
+    def fit(self, users, items, weights=None, profiler=None) -> "ImplicitALS":
+        """
+        Fit the factors to the interactions. Repeated user-item pairs have their
+        weights summed.
+
+        Args:
+            users (np.ndarray): User index of each interaction.
+            items (np.ndarray): Item index of each interaction.
+            weights (np.ndarray, optional): Weight of each interaction. Defaults to
+                one for every interaction.
+            profiler (TrainingProfiler, optional): Records the time of building the
+                sparse blocks and of the user and product half steps in its "train"
+                section, with one step per iteration. Defaults to None.
+
+        Returns:
+            ImplicitALS: The fitted model.
+        """
+        profiler = profiler or NULL_PROFILER
+        self.inference_tables = None
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        if weights is None:
+            weights = np.ones(len(users), dtype=np.float32)
+
+        profiler.start("train")
+        with profiler.phase("build"):
+            by_user = _csr(users, items, weights, self.n_users, self.n_products)
+            by_item = _csr(
+                by_user[1],
+                np.repeat(np.arange(self.n_users), np.diff(by_user[0])),
+                by_user[2],
+                self.n_products,
+                self.n_users,
+            )
+
+            user_blocks = self._blocks(by_user, self.n_products)
+            item_blocks = self._blocks(by_item, self.n_users)
+
+        # Each thread of the pool runs its solves with a share of the intra-op
+        # threads, rather than all of them, so the cores are not oversubscribed.
+        n_jobs = self.n_jobs or os.cpu_count() or 1
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, num_threads // n_jobs))
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+                for _ in range(self.iterations):
+                    with profiler.phase("users"):
+                        self._half_step(
+                            pool, self.user_factors, self.product_factors, user_blocks
+                        )
+                    with profiler.phase("products"):
+                        self._half_step(
+                            pool, self.product_factors, self.user_factors, item_blocks
+                        )
+                    profiler.step(len(by_user[1]))
+        finally:
+            torch.set_num_threads(num_threads)
+        seconds = time.perf_counter() - start
+        profiler.stop()
+
+        self.train_stats = {
+            "interactions": len(by_user[1]),
+            "seconds": seconds,
+            "seconds_per_iteration": seconds / max(self.iterations, 1),
+        }
+
+        return self
+
+    def save(self, path, user_vocab=None, item_vocab=None):
+        """
+        Save the factors, settings, and vocabularies as a checkpoint directory of
+        raw arrays that `load` memory maps, see `youchoose.utils.checkpoint`.
+
+        Args:
+            path (str): The checkpoint directory, replaced if it exists.
+            user_vocab (IdVocabulary, optional): The user IDs of the factor rows.
+                Defaults to None.
+            item_vocab (IdVocabulary, optional): The product IDs of the factor
+                rows. Defaults to None.
+        """
+        arrays = {
+            "user_factors": self.user_factors,
+            "product_factors": self.product_factors,
+        }
+        for name, vocab in (("user_ids", user_vocab), ("item_ids", item_vocab)):
+            if vocab is not None:
+                arrays[name] = vocab.ids
+
+        save_checkpoint(
+            path,
+            arrays,
+            meta={
+                "model": object_path(self),
+                "config": constructor_config(self)["kwargs"],
+                "train_stats": self.train_stats,
+            },
+        )
+
+    @classmethod
+    def load(cls, path, mmap_mode: str = "c") -> "ImplicitALS":
+        """
+        Load a model saved with `save`, using the memory mapped arrays as the
+        factors. The vocabularies are set as ``user_vocab`` and ``item_vocab``,
+        None when they were not saved.
+
+        Args:
+            path (str): The checkpoint directory.
+            mmap_mode (str, optional): "c" to map the arrays copy-on-write, "r"
+                to map them read only for serving, or None to read them into
+                memory. Defaults to "c".
+
+        Returns:
+            ImplicitALS: The loaded model.
+        """
+        arrays, meta = load_checkpoint(path, mmap_mode=mmap_mode)
+        config = dict(meta["config"], n_users=0, n_products=0)
+
+        model = cls(**config)
+        model.user_factors = arrays["user_factors"]
+        model.product_factors = arrays["product_factors"]
+        model.n_users = len(model.user_factors)
+        model.n_products = len(model.product_factors)
+        model.user_vocab, model.item_vocab = (
+            IdVocabulary(arrays[name]) if name in arrays else None
+            for name in ("user_ids", "item_ids")
+        )
+        model.train_stats = meta["train_stats"]
+
+        return model
+
+    def _blocks(self, matrix: tuple, n_cols: int) -> list:
+        """
+        Split a CSR matrix into blocks of rows, each held as sparse tensors of the
+        confidence minus one (the weight in excess of the shared YtY term).
+        """
+        indptr, indices, weights = matrix
+
+        block_nnz = self.block_nnz
+        if self.solver == "cholesky":
+            # Bound the (nnz, n_factors, n_factors) outer products of a block.
+            block_nnz = min(block_nnz, 2**24 // self.n_factors**2)
+        bounds = _row_blocks(indptr, block_nnz)
+
+        blocks = []
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="Sparse")
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                start, stop = indptr[lo], indptr[hi]
+                extra = torch.sparse_csr_tensor(
+                    torch.from_numpy(indptr[lo : hi + 1] - start),
+                    torch.from_numpy(indices[start:stop]),
+                    self.alpha * torch.from_numpy(weights[start:stop]),
+                    (hi - lo, n_cols),
+                )
+                blocks.append((lo, hi, extra))
+
+        return blocks
+
+    def _half_step(self, pool, X: torch.Tensor, Y: torch.Tensor, blocks: list):
+        """
+        Solve for every row of X with Y fixed, writing the result in place.
+        """
+        YtY = Y.t() @ Y + self.reg * torch.eye(self.n_factors)
+
+        futures = [
+            pool.submit(self._solve_block, X, Y, YtY, *block) for block in blocks
+        ]
+        for future in futures:
+            future.result()
+
+    def _solve_block(self, X, Y, YtY, lo, hi, extra):
+        crow, col, values = extra.crow_indices(), extra.col_indices(), extra.values()
+        # The preference of every observed pair is one, so b = Y^T C_u 1.
+        b = extra @ Y + _row_sums(crow, col, Y)
+
+        if self.solver == "cholesky":
+            segment = torch.repeat_interleave(torch.arange(hi - lo), crow.diff())
+            Yu = Y[col]
+            A = YtY + torch.zeros(hi - lo, self.n_factors, self.n_factors).index_add_(
+                0, segment, (values[:, None] * Yu)[:, :, None] * Yu[:, None, :]
+            )
+            X[lo:hi] = torch.cholesky_solve(b[..., None], torch.linalg.cholesky(A))[
+                ..., 0
+            ]
+            return
+
+        pattern = torch.sparse_csr_tensor(
+            crow, col, torch.zeros_like(values), extra.shape
+        )
+
+        def matvec(v):
+            dots = torch.sparse.sampled_addmm(pattern, v, Y.t(), beta=0).values()
+            weighted = torch.sparse_csr_tensor(crow, col, values * dots, extra.shape)
+            return v @ YtY + weighted @ Y
+
+        x = X[lo:hi].clone()
+        r = b - matvec(x)
+        p = r.clone()
+        rs_old = (r * r).sum(1)
+        for _ in range(self.cg_steps):
+            Ap = matvec(p)
+            step = _safe_divide(rs_old, (p * Ap).sum(1))
+            x += step[:, None] * p
+            r -= step[:, None] * Ap
+            rs_new = (r * r).sum(1)
+            p = r + _safe_divide(rs_new, rs_old)[:, None] * p
+            rs_old = rs_new
+
+        X[lo:hi] = x
+
+    def folded_factors(self):
+        """
+        The user and product factors, matching `NNMatrixFactorization.folded_factors`
+        so both models share the scoring code. ALS has no bias terms to fold.
+        """
+        return self.user_factors, self.product_factors
+
+    def quantize(self, dtype="int8"):
+        """
+        Store a copy of the factors in a lower precision for `recommend_top`, see
+        `NNMatrixFactorization.quantize`.
+        """
+        self.inference_tables = (
+            quantize_tables(*self.folded_factors(), dtype) if dtype else None
+        )
+
+    def recommend_top(
+        self,
+        k: int = 10,
+        users=None,
+        exclude: ItemSetIndex = None,
+        user_block_size: int = 1024,
+        item_block_size: int = None,
+    ):
+        """
+        Find the k highest scoring products for each user, with the tables of
+        `quantize` when set. See `top_k_scores`.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: The (n_users, k) product indices and
+                scores, ordered from highest to lowest score.
+        """
+        user_table, item_table = self.inference_tables or self.folded_factors()
+
+        return top_k_scores(
+            user_table,
+            item_table,
+            k=k,
+            users=users,
+            exclude=exclude,
+            user_block_size=user_block_size,
+            item_block_size=item_block_size,
+        )
+
+
+def _csr(rows, cols, weights, n_rows: int, n_cols: int):
+    """
+    Sort the interactions into a CSR matrix, summing repeated entries.
+    """
+    keys = np.asarray(rows, dtype=np.int64) * n_cols + np.asarray(cols, dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])[: len(keys)]
+    weights = np.asarray(weights, dtype=np.float32)[order]
+    data = np.add.reduceat(weights, starts) if len(keys) else weights
+    keys = keys[starts]
+
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // n_cols, minlength=n_rows), out=indptr[1:])
+
+    return indptr, keys % n_cols, data.astype(np.float32)
+
+
+def _row_blocks(indptr: np.ndarray, block_nnz: int) -> np.ndarray:
+    """
+    Row boundaries splitting the matrix into blocks of about block_nnz entries.
+    """
+    targets = np.arange(0, indptr[-1], max(block_nnz, 1))
+    bounds = np.searchsorted(indptr, targets, side="right") - 1
+
+    return np.unique(np.r_[bounds, 0, len(indptr) - 1])
+
+
+def _row_sums(crow: torch.Tensor, col: torch.Tensor, Y: torch.Tensor):
+    """
+    Sum the rows of Y at the columns of each row of a CSR pattern.
+    """
+    ones = torch.sparse_csr_tensor(
+        crow, col, torch.ones(len(col), dtype=Y.dtype), (len(crow) - 1, len(Y))
+    )
+
+    return ones @ Y
+
+
+def _safe_divide(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    return torch.where(b != 0, a / torch.where(b != 0, b, torch.ones_like(b)), 0 * a)
@@ -5,12 +5,40 @@
 Neural network latent matrix factorization library.
 
 """
+import inspect
+import os
+import time
+import traceback
+import warnings
+from queue import Empty
+
+import numpy as np
 import torch
+import torch.multiprocessing as mp
 import torch.nn as nn
+from torch.utils.data import BatchSampler, DataLoader, SubsetRandomSampler
 
 # from tqdm import tqdm
 from pathlib import Path
+from ..data.data_processing import IdVocabulary, ItemSetIndex
+from ..interaction.pointwise import (
+    fold_bias,
+    quantize_tables,
+    score_all,
+    score_candidates,
+    score_pairs,
+    top_k_scores,
+)
 from ..recommender.nn_layers import ScaledEmbedding, ZeroEmbedding
+from ..utils.checkpoint import (
+    constructor_config,
+    from_config,
+    import_object,
+    load_checkpoint,
+    object_path,
+    save_checkpoint,
+)
+from ..utils.logging import NULL_PROFILER
 
 
 class NNMatrixFactorization(torch.nn.Module):
@@ -27,6 +55,8 @@ class NNMatrixFactorization(torch.nn.Module):
         momentum=0,
         loss_fn=nn.BCEWithLogitsLoss,
         activation=nn.Sigmoid,
+        sparse=False,
+        dtype=torch.float32,
     ):
         """
         Initalize the user and product embedding vectors in latent space.
@@ -35,45 +65,123 @@ class NNMatrixFactorization(torch.nn.Module):
             n_users (int): Number of users with prior purchases.
             n_products (int): Total number of products purchased.
             n_factors (integer, optional): Dimension of the latent embedding space.
+            sparse (bool, optional): Use sparse embedding gradients so each step
+                only updates the rows in the batch. The optimizer must support
+                sparse gradients (torch.optim.SGD or torch.optim.SparseAdam) and
+                the L2 penalty is applied lazily to the rows in each batch.
+                Defaults to False.
+            dtype (torch.dtype, optional): Storage type of the embeddings,
+                torch.bfloat16 or torch.float16 to halve the memory of the
+                parameters and the optimizer state. The rows of a batch are cast
+                to float32, so the scores, the loss, and the gradients are computed
+                in float32 and only the updated values are rounded to the storage
+                type. float16 is only trained with SGD, as the second moments of
+                adaptive optimizers underflow in float16. Defaults to
+                torch.float32.
         """
+        if dtype == torch.float16 and not issubclass(optimizer, torch.optim.SGD):
+            raise ValueError(
+                "float16 embeddings are only trained with SGD, use bfloat16."
+            )
+
         super(NNMatrixFactorization, self).__init__()
 
         self.l2 = l2
         self.lr = lr
         self.momentum = momentum
-        self.user_factors = ScaledEmbedding(n_users, n_factors)
-        self.product_factors = ScaledEmbedding(n_products, n_factors)
-        self.user_bias = ZeroEmbedding(n_users, 1)
-        self.product_bias = ZeroEmbedding(n_products, 1)
+        self.sparse = sparse
+        self.user_factors = ScaledEmbedding(
+            n_users, n_factors, sparse=sparse, dtype=dtype
+        )
+        self.product_factors = ScaledEmbedding(
+            n_products, n_factors, sparse=sparse, dtype=dtype
+        )
+        self.user_bias = ZeroEmbedding(n_users, 1, sparse=sparse, dtype=dtype)
+        self.product_bias = ZeroEmbedding(n_products, 1, sparse=sparse, dtype=dtype)
 
         self.activation = activation()
         self.loss_fn = loss_fn()
-        self.optimizer = optimizer(
-            self.parameters(), lr=self.lr, weight_decay=self.l2, momentum=self.momentum
-        )
+        self.optimizer = self._build_optimizer(optimizer)
+        self.train_stats = {}
+        self.inference_tables = None
+        self._compiled_step = None
 
     def forward(self, user, item):
         """
         Matrix multiplication between user and product
         embedding vectors.
         """
-        item_emb = self.product_factors(item.view(-1)) + self.product_bias(
-            item.view(-1)
+        item_emb = _lookup(self.product_factors, self.product_bias, item.view(-1))
+        user_emb = _lookup(self.user_factors, self.user_bias, user.view(-1))
+
+        return score_pairs(user_emb, item_emb)
+
+    def score_candidates(self, user, items):
+        """
+        Score several candidate items for each user, gathering every user
+        embedding once rather than once per candidate.
+
+        Args:
+            user (torch.tensor): The (B,) users.
+            items (torch.tensor): The (B, C) candidate items of each user.
+
+        Returns:
+            torch.tensor: The (B, C) scores, the same as the forward pass.
+        """
+        user_emb = _lookup(self.user_factors, self.user_bias, user)
+        item_emb = _lookup(self.product_factors, self.product_bias, items)
+
+        return score_candidates(user_emb, item_emb)
+
+    @property
+    def pairwise(self) -> bool:
+        """
+        Whether the loss compares the scores of positive and negative items, see
+        `youchoose.interaction.pairwise`.
+        """
+        return getattr(self.loss_fn, "pairwise", False)
+
+    def _build_optimizer(self, optimizer):
+        """
+        Create the optimizer over the model parameters.
+
+        Only the settings the optimizer accepts are given to it, e.g. momentum is
+        not given to Adam. With sparse gradients the weight decay is not given to
+        the optimizer, as it would densify every update.
+        """
+        kwargs = {"lr": self.lr, "momentum": self.momentum}
+        if not self.sparse:
+            kwargs["weight_decay"] = self.l2
+
+        accepted = inspect.signature(optimizer).parameters
+        kwargs = {key: value for key, value in kwargs.items() if key in accepted}
+
+        return optimizer(self.parameters(), **kwargs)
+
+    def _lazy_l2_penalty(self, user, item):
+        """
+        L2 penalty on only the user and product rows used in the batch.
+
+        Equivalent to weight decay applied to the rows that are updated, so the
+        cost is bounded by the batch rather than the size of the embeddings.
+        """
+        users = torch.unique(user.view(-1))
+        items = torch.unique(item.view(-1))
+        penalty = (
+            self.user_factors(users).float().pow(2).sum()
+            + self.user_bias(users).float().pow(2).sum()
+            + self.product_factors(items).float().pow(2).sum()
+            + self.product_bias(items).float().pow(2).sum()
         )
-        user_emb = self.user_factors(user.view(-1)) + self.user_bias(user.view(-1))
-        mat_mult = (item_emb * user_emb).sum(1)
 
-        return mat_mult
+        return 0.5 * self.l2 * penalty
 
     def _prob_to_class(self, forward):
         """
         Convert the probabilities from the final activation into a
         binary classification.
         """
-        predict_pos = self.activation(forward)
-        predict_neg = 1 - predict_pos
-
-        return torch.stack((predict_neg, predict_pos)).argmax(0).float()
+        return (self.activation(forward) > 0.5).float()
 
     def prediction(self, user, item):
         """
@@ -99,60 +207,379 @@ class NNMatrixFactorization(torch.nn.Module):
                 forward = self(user, item)
                 predicted = self._prob_to_class(forward)
                 total += predicted.numel()
-                correct += (predicted == true_rating.view(-1)).sum().item()
+                correct += (predicted == true_rating.view(-1)).sum()
+
+        return total, int(correct)
+
+    def _forward_loss(self, user, item, rating):
+        """
+        Compute the loss and the number of correct predictions for a batch.
+
+        With a pairwise loss the batch holds the positive item of each user in the
+        first column of ``item`` followed by the negatives, and a prediction is
+        correct when the positive is scored above the negative.
+        """
+        if self.pairwise:
+            if user.dim() > 1:
+                user = user[:, 0]
+            scores = self.score_candidates(user, item)
+            loss = self.loss_fn(scores[:, 0], scores[:, 1:])
+            correct = (scores[:, :1] > scores[:, 1:]).sum()
+        else:
+            forward = self(user, item)
+            loss = self.loss(forward, rating)
+            correct = (self._prob_to_class(forward) == rating.view(-1)).sum()
+
+        if self.sparse and self.l2 and self.training:
+            loss = loss + self._lazy_l2_penalty(user, item)
+
+        return loss, correct
+
+    def _n_predictions(self, item, rating) -> int:
+        """
+        Number of predictions in a batch, the number of positive and negative
+        pairs for a pairwise loss.
+        """
+        if self.pairwise:
+            return item.shape[0] * (item.shape[1] - 1)
+
+        return rating.numel()
+
+    def _step_function(self, compile_step: bool):
+        if not compile_step:
+            return self._forward_loss
 
-        return total, correct
+        if self._compiled_step is None:
+            if hasattr(torch, "compile"):
+                self._compiled_step = torch.compile(self._forward_loss)
+            else:
+                warnings.warn("torch.compile is not available, training eagerly.")
+                self._compiled_step = self._forward_loss
 
-    def train_model(self, data_loader):
+        return self._compiled_step
+
+    def train_model(self, data_loader, compile_step: bool = False, profiler=None):
         """
         Train the model on the data generated by the dataloader and compute
         the training loss and training accuracy.
+
+        The loss and accuracy are accumulated as tensors, so the only
+        synchronization with the computation device is at the end of the epoch.
+        The number of samples and samples per second of the epoch are stored in
+        `train_stats`.
+
+        Args:
+            data_loader (DataLoader): Batches of users, items, and ratings. With a
+                pairwise loss each batch holds the positive and negative items of
+                every user, e.g. from `TripletBatches`. Batches loaded on another
+                device, e.g. by DataLoader workers, are moved to the model's device.
+            compile_step (bool, optional): Compile the forward and loss computation
+                with torch.compile when available. Defaults to False.
+            profiler (TrainingProfiler, optional): Records the time of the data,
+                forward, backward, and optimizer phases in its "train" section.
+                Defaults to None.
+
+        Returns:
+            Tuple[float, str]: The mean training loss and the accuracy.
         """
-        train_squared_loss = 0
-        correct = 0
+        profiler = profiler or NULL_PROFILER
+        step = self._step_function(compile_step)
+        self.inference_tables = None
+        train_squared_loss = torch.zeros(())
+        correct = torch.zeros((), dtype=torch.long)
         total = 0
+        start = time.perf_counter()
 
+        dev = self.user_factors.weight.device
         self.train()
-        for user, item, rating in data_loader:
-            self.optimizer.zero_grad()
+        profiler.start("train", dev)
+        for user, item, rating in profiler.iterate(data_loader):
+            if user.device != dev:
+                user, item, rating = _to_device(dev, user, item, rating)
+            with profiler.phase("optimizer"):
+                self.optimizer.zero_grad()
+
+            with profiler.phase("forward"):
+                loss, batch_correct = step(user, item, rating)
+
+                n_predictions = self._n_predictions(item, rating)
+                train_squared_loss = train_squared_loss + loss.detach() * n_predictions
+                correct = correct + batch_correct
+                total += n_predictions
+
+            with profiler.phase("backward"):
+                loss.backward()
+            with profiler.phase("optimizer"):
+                self.optimizer.step()
+            profiler.step(n_predictions)
+        profiler.stop()
+
+        self._record_train_stats(total, time.perf_counter() - start)
+        mean_loss = float(train_squared_loss) / total
+
+        return mean_loss, f"{(100 * int(correct) / total):.2f}"
+
+    def train_hogwild(
+        self, dataset, num_processes: int = 2, batch_size: int = 1024, epochs: int = 1
+    ):
+        """
+        Train the model with several cpu processes updating the shared embeddings
+        without locks (Hogwild!).
 
-            forward = self(user, item)
-            predicted = self._prob_to_class(forward)
-            loss = self.loss(forward, rating)
+        Each process trains on its own shard of the dataset with its own optimizer
+        of the same type and settings as the model's optimizer. The samples per
+        second over all processes are stored in `train_stats`.
+
+        Args:
+            dataset (InteractionsDataset): A dataset supporting batched indexing.
+            num_processes (int, optional): Number of training processes. Defaults
+                to 2.
+            batch_size (int, optional): Batch size of each process. Defaults to 1024.
+            epochs (int, optional): Number of passes over the dataset. Defaults to 1.
+
+        Returns:
+            Tuple[float, str]: The mean training loss and the accuracy of the last
+                epoch.
+        """
+        self.share_memory()
+        self.train()
+        self.inference_tables = None
+
+        ctx = mp.get_context("fork")
+        queue = ctx.Queue()
+        shards = np.array_split(np.arange(len(dataset)), num_processes)
+        start = time.perf_counter()
+
+        processes = []
+        for rank, shard in enumerate(shards):
+            process = ctx.Process(
+                target=_hogwild_worker,
+                args=(self, dataset, shard, rank, num_processes, batch_size, epochs),
+                kwargs={"queue": queue},
+            )
+            process.start()
+            processes.append(process)
+
+        results = _gather_results(queue, processes)
+        for process in processes:
+            process.join()
+
+        squared_loss, correct, total = (sum(r[i] for r in results) for i in range(3))
+        self._record_train_stats(total * epochs, time.perf_counter() - start)
+
+        return squared_loss / total, f"{(100 * correct / total):.2f}"
+
+    def _record_train_stats(self, samples: int, seconds: float):
+        self.train_stats = {
+            "samples": samples,
+            "seconds": seconds,
+            "samples_per_sec": samples / seconds if seconds else float("inf"),
+        }
+
+    def grow(self, n_users: int, n_products: int):
+        """
+        Extend the embedding tables to at least n_users and n_products rows, for
+        users and products that are new since training.
+
+        The existing rows and their optimizer state are kept, and the new rows are
+        initialized as in a new model with an empty optimizer state.
+
+        Args:
+            n_users (int): The new number of users.
+            n_products (int): The new number of products.
+        """
+        grown = False
+        self.inference_tables = None
+        for embedding, n_rows in (
+            (self.user_factors, n_users),
+            (self.user_bias, n_users),
+            (self.product_factors, n_products),
+            (self.product_bias, n_products),
+        ):
+            weight = embedding.weight.detach()
+            extra = n_rows - len(weight)
+            if extra <= 0:
+                continue
+
+            new_rows = type(embedding)(extra, embedding.embedding_dim).weight.detach()
+            embedding.weight = nn.Parameter(
+                torch.cat((weight, new_rows.to(weight.device, weight.dtype)))
+            )
+            embedding.num_embeddings = n_rows
+            grown = True
+
+        if grown:
+            self._rebuild_optimizer()
+
+    def _rebuild_optimizer(self):
+        """
+        Build the optimizer over the current parameters, keeping the settings and
+        state of the old optimizer, with the state of new rows set to zero.
+        """
+        saved = self.optimizer.state_dict()
+        self.optimizer = self._build_optimizer(type(self.optimizer))
 
-            train_squared_loss += loss.item() * len(user)
-            total += predicted.numel()
-            correct += (predicted == rating.view(-1)).sum().item()
+        params = list(self.parameters())
+        for index, param_state in saved["state"].items():
+            rows = len(params[index])
+            for key, value in param_state.items():
+                if torch.is_tensor(value) and value.dim() and len(value) < rows:
+                    padding = value.new_zeros((rows - len(value),) + value.shape[1:])
+                    param_state[key] = torch.cat((value, padding))
 
-            loss.backward()
-            self.optimizer.step()
+        self.optimizer.load_state_dict(saved)
 
-        mean_loss = train_squared_loss / total
+    def fold_in(self, data_loader, epochs: int = 1, lr: float = None, products=True):
+        """
+        Fine-tune only the embedding rows of the users and products in a batch of
+        new interactions, e.g. after `grow` for new users and products.
+
+        Gradients are sparse during the fold-in and applied with plain SGD, so the
+        cost of an update is proportional to the rows in the batch rather than to
+        the size of the tables, and rows that are not in the interactions, nor
+        sampled as negatives, do not change. The L2 penalty is applied to the
+        rows in each batch, and the model's optimizer is left untouched.
 
-        return mean_loss, f"{(100 * correct / total):.2f}"
+        Args:
+            data_loader (DataLoader): Batches of the new users, items, and ratings.
+            epochs (int, optional): Number of passes over the new interactions.
+                Defaults to 1.
+            lr (float, optional): Learning rate of the fold-in. Defaults to the
+                model's learning rate.
+            products (bool, optional): Also update the product rows, otherwise
+                only the users are folded in against fixed products. Defaults to
+                True.
+
+        Returns:
+            float: The mean loss of the last epoch.
+        """
+        embeddings = [self.user_factors, self.user_bias]
+        if products:
+            embeddings += [self.product_factors, self.product_bias]
+        frozen = [self.product_factors, self.product_bias] if not products else []
+
+        modes = [(module, module.sparse) for module in embeddings] + [
+            (self, self.sparse)
+        ]
+        for module in embeddings:
+            module.sparse = True
+            module.weight.grad = None
+        for module in frozen:
+            module.weight.requires_grad_(False)
+        self.sparse = True
+        self.inference_tables = None
+        optimizer = torch.optim.SGD(
+            [module.weight for module in embeddings], lr=lr or self.lr
+        )
 
-    def evaluate(self, dataloader):
+        try:
+            self.train()
+            for _ in range(epochs):
+                total_loss = torch.zeros(())
+                total = 0
+                for user, item, rating in data_loader:
+                    optimizer.zero_grad()
+                    loss, _ = self._forward_loss(user, item, rating)
+                    loss.backward()
+                    optimizer.step()
+
+                    n_predictions = self._n_predictions(item, rating)
+                    total_loss = total_loss + loss.detach() * n_predictions
+                    total += n_predictions
+        finally:
+            for module, sparse in modes:
+                module.sparse = sparse
+            for module in embeddings:
+                module.weight.grad = None
+            for module in frozen:
+                module.weight.requires_grad_(True)
+
+        return float(total_loss) / max(total, 1)
+
+    def evaluate(self, dataloader, profiler=None):
         """
         Calculate the loss and accuracy of the model on the validation
         or test data set.
+
+        The time of the data and forward phases is recorded in the "evaluate"
+        section of the profiler, if given.
         """
-        squared_loss = 0
-        correct = 0
+        profiler = profiler or NULL_PROFILER
+        squared_loss = torch.zeros(())
+        correct = torch.zeros((), dtype=torch.long)
         total = 0
 
+        dev = self.user_factors.weight.device
         self.eval()
+        profiler.start("evaluate", dev)
         with torch.no_grad():
-            for user, item, rating in dataloader:
-                forward = self(user, item)
-                predicted = self._prob_to_class(forward)
+            for user, item, rating in profiler.iterate(dataloader):
+                if user.device != dev:
+                    user, item, rating = _to_device(dev, user, item, rating)
+                with profiler.phase("forward"):
+                    loss, batch_correct = self._forward_loss(user, item, rating)
 
-                squared_loss += self.loss(forward, rating).item() * len(user)
-                total += predicted.numel()
-                correct += (predicted == rating.view(-1)).sum().item()
+                    n_predictions = self._n_predictions(item, rating)
+                    squared_loss = squared_loss + loss * n_predictions
+                    total += n_predictions
+                    correct = correct + batch_correct
+                profiler.step(n_predictions)
+        profiler.stop()
+
+        mean_loss = float(squared_loss) / total
+
+        return mean_loss, f"{(100 * int(correct) / total):.2f}"
 
-        mean_loss = squared_loss / total
+    def save(self, path, user_vocab=None, item_vocab=None):
+        """
+        Save the model as a checkpoint directory of raw arrays that `load` memory
+        maps, see `youchoose.utils.checkpoint`.
+
+        The parameters, the optimizer state, the training settings, and the
+        vocabularies are stored, so training can resume from the checkpoint.
 
-        return mean_loss, f"{(100 * correct / total):.2f}"
+        Args:
+            path (str): The checkpoint directory, replaced if it exists.
+            user_vocab (IdVocabulary, optional): The user IDs of the embedding
+                rows. Defaults to None.
+            item_vocab (IdVocabulary, optional): The product IDs of the embedding
+                rows. Defaults to None.
+        """
+        arrays = dict(self.state_dict())
+
+        optimizer_state = self.optimizer.state_dict()
+        state = {}
+        for index, param_state in optimizer_state["state"].items():
+            state[index] = {}
+            for key, value in param_state.items():
+                if torch.is_tensor(value):
+                    arrays["optimizer.{}.{}".format(index, key)] = value
+                else:
+                    state[index][key] = value
+
+        for name, vocab in (("user_ids", user_vocab), ("item_ids", item_vocab)):
+            if vocab is not None:
+                arrays[name] = vocab.ids
+
+        save_checkpoint(
+            path,
+            arrays,
+            meta={
+                "model": object_path(self),
+                "lr": self.lr,
+                "l2": self.l2,
+                "momentum": self.momentum,
+                "sparse": self.sparse,
+                "optimizer": object_path(self.optimizer),
+                "loss_fn": constructor_config(self.loss_fn),
+                "activation": constructor_config(self.activation),
+                "optimizer_state": {
+                    "state": state,
+                    "param_groups": optimizer_state["param_groups"],
+                },
+                "train_stats": self.train_stats,
+            },
+        )
 
     @classmethod
     def load(
@@ -164,47 +591,282 @@ class NNMatrixFactorization(torch.nn.Module):
         momentum=0,
         loss_fn=nn.BCEWithLogitsLoss,
         activation=nn.Sigmoid,
+        mmap_mode="c",
     ):
         """
+        Load a model saved with `save`, or the state dict of a legacy .pth file.
+
+        The arrays of a checkpoint directory are memory mapped and used as the
+        parameters without a copy, so loading takes milliseconds whatever the
+        size of the model. The settings, optimizer state, and vocabularies are
+        restored from the checkpoint and the keyword arguments are only used for
+        .pth files, which hold just the parameters. The vocabularies are set as
+        ``user_vocab`` and ``item_vocab``, None when they were not saved.
+
+        Args:
+            saved_filename (str): A checkpoint directory or a .pth file.
+            mmap_mode (str, optional): "c" to map the arrays copy-on-write, so
+                processes share the pages until they train, "r" to map them read
+                only for serving, or None to read them into memory. Defaults to
+                "c".
+
+        Returns:
+            NNMatrixFactorization: The loaded model.
         """
-        if not Path(saved_filename).exists():
+        path = Path(saved_filename)
+        if not path.exists():
             raise ValueError("Filename does not exist.")
-        pass
-
-    #         model_save = torch.load(saved_filename)
-
-    #         # before training user-item interaction matrix
-    #         user_em = model_save["user_factors.weight"]
-    #         item_em = model_save["product_factors.weight"]
-    #         user_b = model_save["user_bias.weight"]
-    #         item_b = model_save["product_bias.weight"]
-
-    #         user_item_array = ((item_em + item_b) @ (user_em + user_b).transpose(0,1))
-    #         pre_probs = model.activation(user_item_array).numpy()
-    #         pre_preds = model._prob_to_class(user_item_array).numpy()
-
-    #         cls(
-    #             n_users,
-    #             n_products,
-    #             n_factors=20,
-    #             optimizer=torch.optim.SGD,
-    #             lr=0.001,
-    #             l2=0,
-    #             momentum=0,
-    #             loss_fn=nn.BCEWithLogitsLoss,
-    #             activation=nn.Sigmoid,
-    #         )
+
+        if path.is_file():
+            model = cls._from_state_dict(
+                torch.load(path, map_location="cpu"),
+                optimizer=optimizer,
+                lr=lr,
+                l2=l2,
+                momentum=momentum,
+                loss_fn=loss_fn,
+                activation=activation,
+            )
+            model.user_vocab, model.item_vocab = None, None
+            return model
+
+        arrays, meta = load_checkpoint(path, mmap_mode=mmap_mode)
+        model = cls._from_state_dict(
+            {
+                name: arrays.pop(name)
+                for name in list(arrays)
+                if name.endswith((".weight", ".bias"))
+            },
+            optimizer=import_object(meta["optimizer"]),
+            lr=meta["lr"],
+            l2=meta["l2"],
+            momentum=meta["momentum"],
+            loss_fn=from_config(meta["loss_fn"]),
+            activation=from_config(meta["activation"]),
+            sparse=meta["sparse"],
+        )
+
+        saved = meta["optimizer_state"]
+        state = {int(index): dict(value) for index, value in saved["state"].items()}
+        for name in [name for name in arrays if name.startswith("optimizer.")]:
+            _, index, key = name.split(".", 2)
+            state.setdefault(int(index), {})[key] = arrays.pop(name)
+        model.optimizer.load_state_dict(
+            {"state": state, "param_groups": saved["param_groups"]}
+        )
+
+        model.user_vocab, model.item_vocab = (
+            IdVocabulary(arrays[name]) if name in arrays else None
+            for name in ("user_ids", "item_ids")
+        )
+        model.train_stats = meta["train_stats"]
+
+        return model
+
+    @classmethod
+    def _from_state_dict(cls, state_dict: dict, optimizer=torch.optim.SGD, **kwargs):
+        """
+        Create a model using the tensors of a state dict as its parameters. The
+        model is built with empty embeddings, so no memory is allocated or
+        initialized for parameters that are immediately replaced.
+        """
+        model = cls(
+            0,
+            0,
+            n_factors=state_dict["user_factors.weight"].shape[1],
+            optimizer=optimizer,
+            dtype=state_dict["user_factors.weight"].dtype,
+            **kwargs,
+        )
+        for name, tensor in state_dict.items():
+            module_name, _, param_name = name.rpartition(".")
+            module = model.get_submodule(module_name)
+            setattr(module, param_name, nn.Parameter(tensor))
+            module.num_embeddings = tensor.shape[0]
+        model.optimizer = model._build_optimizer(optimizer)
+
+        return model
+
     def create_user_item_array(self):
         """
         Use the trained embedding vectors to compute the predicted
         interaction for all users.
+
+        This materializes the dense n_items x n_users array, use
+        `recommend_top` for large catalogs.
         """
-        user_em = self.user_factors.weight.detach()
-        item_em = self.product_factors.weight.detach()
-        user_b = self.user_bias.weight.detach()
-        item_b = self.product_bias.weight.detach()
+        user_table, item_table = self.folded_factors()
 
-        user_item_array = (item_em + item_b) @ (user_em + user_b).transpose(0, 1)
-        preds = self._prob_to_class(user_item_array).numpy()
+        user_item_array = score_all(item_table, user_table)
+        preds = self._prob_to_class(user_item_array.float()).numpy()
 
         return preds
+
+    def folded_factors(self):
+        """
+        The user and product embeddings with their biases added, as used in the
+        forward pass, in the storage type of the embeddings.
+
+        Returns:
+            Tuple[torch.tensor, torch.tensor]: The detached user and product tables.
+        """
+        user_table = fold_bias(
+            self.user_factors.weight.detach(), self.user_bias.weight.detach()
+        )
+        item_table = fold_bias(
+            self.product_factors.weight.detach(), self.product_bias.weight.detach()
+        )
+
+        return user_table, item_table
+
+    def quantize(self, dtype="int8"):
+        """
+        Store a copy of the folded tables in a lower precision for
+        `recommend_top`, e.g. int8 rows with a float scale each, a quarter of the
+        memory of float32. See `quantize_tables`.
+
+        The tables are a snapshot, dropped when the model is trained again.
+
+        Args:
+            dtype (Union[str, torch.dtype], optional): "int8", "bfloat16",
+                "float16", or None to score the model's own tables again.
+                Defaults to "int8".
+        """
+        self.inference_tables = (
+            quantize_tables(*self.folded_factors(), dtype) if dtype else None
+        )
+
+    def recommend_top(
+        self,
+        k: int = 10,
+        users=None,
+        exclude: ItemSetIndex = None,
+        user_block_size: int = 1024,
+        item_block_size: int = None,
+    ):
+        """
+        Find the k highest scoring products for each user.
+
+        Users are scored in blocks against blocks of the product table, keeping a
+        running top k for each user, so memory is bounded by
+        user_block_size x item_block_size scores rather than the full
+        n_users x n_products array. The tables of `quantize` are used when set.
+
+        Args:
+            k (int, optional): Number of products to recommend. Defaults to 10.
+            users (Sequence[int], optional): The users to recommend for. Defaults
+                to every user.
+            exclude (ItemSetIndex, optional): Products each user has already
+                interacted with, which are never recommended. Defaults to None.
+            user_block_size (int, optional): Number of users scored at once.
+                Defaults to 1024.
+            item_block_size (int, optional): Number of products scored at once.
+                Defaults to all products.
+
+        Returns:
+            Tuple[torch.tensor, torch.tensor]: The (n_users, k) product indices and
+                scores, ordered from highest to lowest score.
+        """
+        user_table, item_table = self.inference_tables or self.folded_factors()
+
+        return top_k_scores(
+            user_table,
+            item_table,
+            k=k,
+            users=users,
+            exclude=exclude,
+            user_block_size=user_block_size,
+            item_block_size=item_block_size,
+        )
+
+
+def _lookup(factors: nn.Embedding, bias: nn.Embedding, index: torch.Tensor):
+    """
+    The float32 vectors of the indices with their biases added, whatever the
+    storage type of the embeddings.
+    """
+    return factors(index).float() + bias(index).float()
+
+
+def _to_device(dev: torch.device, *tensors):
+    """
+    Move a batch loaded on the cpu, e.g. by DataLoader workers, to the model's
+    device. Copies from pinned memory do not block the host.
+    """
+    return tuple(tensor.to(dev, non_blocking=True) for tensor in tensors)
+
+
+def _hogwild_worker(
+    model, dataset, shard, rank, num_processes, batch_size, epochs, queue=None
+):
+    """
+    Train a shared model on a shard of the dataset in a forked process.
+    """
+    try:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_processes))
+        np.random.seed((np.random.randint(2**31) + rank) % 2**32)
+
+        optimizer = type(model.optimizer)(
+            model.parameters(), **model.optimizer.defaults
+        )
+        loader = DataLoader(
+            dataset,
+            batch_size=None,
+            sampler=BatchSampler(SubsetRandomSampler(shard), batch_size, False),
+        )
+
+        for _ in range(epochs):
+            squared_loss = torch.zeros(())
+            correct = torch.zeros((), dtype=torch.long)
+            total = 0
+
+            for user, item, rating in loader:
+                optimizer.zero_grad()
+
+                loss, batch_correct = model._forward_loss(user, item, rating)
+
+                n_predictions = model._n_predictions(item, rating)
+                squared_loss = squared_loss + loss.detach() * n_predictions
+                correct = correct + batch_correct
+                total += n_predictions
+
+                loss.backward()
+                optimizer.step()
+    except Exception:
+        queue.put(traceback.format_exc())
+        return
+
+    queue.put((float(squared_loss), int(correct), total))
+
+
+def _gather_results(queue, processes: list) -> list:
+    """
+    The result of every Hogwild worker, raising the traceback of a worker that
+    failed, or an error if a worker died without reporting, e.g. when killed.
+    """
+    results = []
+    while len(results) < len(processes):
+        try:
+            result = queue.get(timeout=1.0)
+        except Empty:
+            dead = [p.exitcode for p in processes if p.exitcode not in (None, 0)]
+            if dead and queue.empty():
+                _terminate(processes)
+                raise RuntimeError(
+                    "A Hogwild worker exited with code {}.".format(dead[0])
+                )
+            continue
+
+        if isinstance(result, str):
+            _terminate(processes)
+            raise RuntimeError("A Hogwild worker failed:\n{}".format(result))
+        results.append(result)
+
+    return results
+
+
+def _terminate(processes: list):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
@@ -5,3 +5,131 @@
  Calculate the pairwise interaction for a user and their positive and negative
  interactions.
 """
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class BPRLoss(nn.Module):
+    """
+    Bayesian personalized ranking loss, the negative log likelihood that each
+    user scores their positive item above the sampled negative items.
+    """
+
+    pairwise = True
+
+    def forward(self, positive: torch.Tensor, negative: torch.Tensor):
+        """
+        Args:
+            positive (torch.Tensor): The (B,) scores of the positive items.
+            negative (torch.Tensor): The (B, num_negs) scores of the negative items.
+        """
+        return -F.logsigmoid(positive.unsqueeze(1) - negative).mean()
+
+
+class WARPLoss(nn.Module):
+    """
+    Weighted approximate-rank pairwise loss.
+
+    The rank of the positive item is estimated from the fraction of the sampled
+    negatives that violate the margin, and the hinge loss of the hardest
+    violating negative is weighted by the log of that rank, so positives ranked
+    far down the catalog are pushed up hardest.
+    """
+
+    pairwise = True
+
+    def __init__(self, n_items: int, margin: float = 1.0):
+        """
+        Args:
+            n_items (int): Number of items in the catalog.
+            margin (float, optional): The margin a negative must be scored below
+                the positive by. Defaults to 1.0.
+        """
+        super(WARPLoss, self).__init__()
+
+        self.n_items = n_items
+        self.margin = margin
+
+    def forward(self, positive: torch.Tensor, negative: torch.Tensor):
+        """
+        Args:
+            positive (torch.Tensor): The (B,) scores of the positive items.
+            negative (torch.Tensor): The (B, num_negs) scores of the negative items.
+        """
+        violating = negative > positive.unsqueeze(1) - self.margin
+        rank = torch.floor(
+            violating.sum(1).float() * (self.n_items - 1) / negative.shape[1]
+        )
+
+        hardest = negative.masked_fill(~violating, -float("inf")).max(1).values
+        hinge = torch.clamp(self.margin - positive + hardest, min=0)
+
+        return (torch.log1p(rank) * hinge).mean()
+
+
+class TripletBatches:
+    """
+    Iterate over (user, item, weight) batches of a dataset with the negative
+    items of every positive sampled in one draw per batch.
+
+    The users are a (B,) tensor and the items a (B, 1 + num_negs) tensor with the
+    positive item in the first column, ready for the pairwise losses.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size: int,
+        num_negs: int = 1,
+        shuffle: bool = True,
+        drop_last: bool = False,
+    ):
+        """
+        Args:
+            dataset (InteractionsDataset): The positive interactions.
+            batch_size (int): Number of positive interactions in each batch.
+            num_negs (int, optional): Number of negative items sampled for each
+                positive. Defaults to 1.
+            shuffle (bool, optional): Reshuffle the interactions every epoch.
+                Defaults to True.
+            drop_last (bool, optional): Drop the last incomplete batch. Defaults
+                to False.
+        """
+        if num_negs < 1:
+            raise ValueError("Pairwise training needs at least one negative sample.")
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_negs = num_negs
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+
+        return -(-len(self.dataset) // self.batch_size)
+
+    def __iter__(self):
+        dataset = self.dataset
+        device = dataset.users.device
+        if self.shuffle:
+            order = torch.randperm(len(dataset), device=device)
+        else:
+            order = torch.arange(len(dataset), device=device)
+
+        for batch in range(len(self)):
+            idx = order[batch * self.batch_size : (batch + 1) * self.batch_size]
+            users = dataset.users[idx].long()
+            negatives = dataset.sampler.sample(users.cpu().numpy(), self.num_negs)
+
+            items = torch.cat(
+                (
+                    dataset.items[idx].long().unsqueeze(1),
+                    torch.from_numpy(negatives).to(device),
+                ),
+                dim=1,
+            )
+
+            yield users, items, dataset.weights[idx]
@@ -3,4 +3,276 @@
 # See LICENCE file in root directory for full terms.
 """
  Calculate the pointwise interaction for an item-user pair.
+
+ The matrix factorization models score a pair by the inner product of the user
+ and item vectors with their biases added. For scoring, the biases can be folded
+ into the tables once, so each side is a single embedding lookup, and one user
+ is scored against many candidates with a single batched matmul.
+
+ For inference the folded tables can be stored in bfloat16 or float16, half the
+ memory of float32, or as int8 with a scale per row, a quarter. The scale of a
+ user does not change the order of its items, so it is only applied to the top k
+ scores. The scales of the items are applied to whichever is smaller: the scores
+ of a few users, computed with an exact integer matmul, or the item vectors of
+ a block of many users, dequantized for a float matmul.
 """
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from ..data.data_processing import ItemSetIndex
+from ..recommender.nn_layers import QuantizedEmbedding
+
+INFERENCE_DTYPES = {
+    "int8": torch.int8,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+    "float32": torch.float32,
+}
+
+
+def fold_bias(factors: torch.Tensor, bias: torch.Tensor) -> torch.Tensor:
+    """
+    Add the (n, 1) bias to every dimension of the (n, n_factors) factors, giving
+    the vectors the models take inner products of.
+    """
+    return factors + bias
+
+
+def score_pairs(user_vecs: torch.Tensor, item_vecs: torch.Tensor) -> torch.Tensor:
+    """
+    Score each user with the paired item, (B, n_factors) x (B, n_factors) -> (B,).
+    """
+    return torch.einsum("bf,bf->b", user_vecs, item_vecs)
+
+
+def score_candidates(user_vecs: torch.Tensor, item_vecs: torch.Tensor) -> torch.Tensor:
+    """
+    Score each user against their candidate items with one batched matmul,
+    (B, n_factors) x (B, C, n_factors) -> (B, C).
+    """
+    return torch.bmm(item_vecs, user_vecs.unsqueeze(2)).squeeze(2)
+
+
+def score_all(
+    user_vecs: torch.Tensor, item_table: torch.Tensor, item_scale: torch.Tensor = None
+) -> torch.Tensor:
+    """
+    Score each user against every item, (B, n_factors) x (n, n_factors) -> (B, n).
+
+    With int8 vectors and the (n, 1) scales of the items, see
+    `QuantizedEmbedding`, the float32 scores are the integer inner products
+    times the item scales, without the user scales.
+    """
+    if item_scale is None:
+        return user_vecs @ item_table.t()
+    if len(user_vecs) < item_table.shape[1]:
+        return _int8_mm(user_vecs, item_table.t()).mul(item_scale.view(1, -1))
+
+    return user_vecs.float() @ (item_table.float() * item_scale).t()
+
+
+def quantize_tables(user_table: torch.Tensor, item_table: torch.Tensor, dtype):
+    """
+    Copy folded user and item tables to a lower precision for `top_k_scores`.
+
+    Args:
+        user_table (torch.Tensor): The (n_users, n_factors) user vectors.
+        item_table (torch.Tensor): The (n_items, n_factors) item vectors.
+        dtype (Union[str, torch.dtype]): "int8" for `QuantizedEmbedding` tables
+            with a scale per row, or "bfloat16", "float16", or "float32".
+
+    Returns:
+        Tuple: The user and item tables.
+    """
+    if isinstance(dtype, str):
+        if dtype not in INFERENCE_DTYPES:
+            raise ValueError(
+                "dtype must be one of {}.".format(", ".join(INFERENCE_DTYPES))
+            )
+        dtype = INFERENCE_DTYPES[dtype]
+    if dtype not in INFERENCE_DTYPES.values():
+        raise ValueError("Unsupported dtype {}.".format(dtype))
+
+    if dtype == torch.int8:
+        return (
+            QuantizedEmbedding.from_float(user_table),
+            QuantizedEmbedding.from_float(item_table),
+        )
+
+    return user_table.detach().to(dtype), item_table.detach().to(dtype)
+
+
+class FoldedScorer:
+    """
+    Score users and items from tables with the biases folded in, so each score
+    takes one embedding lookup per side instead of a factor and a bias lookup.
+
+    The tables are a snapshot, so the scorer must be rebuilt after training.
+    """
+
+    def __init__(self, user_table: torch.Tensor, item_table: torch.Tensor):
+        """
+        Args:
+            user_table (torch.Tensor): The (n_users, n_factors) folded user vectors.
+            item_table (torch.Tensor): The (n_items, n_factors) folded item vectors.
+        """
+        self.user_table = user_table
+        self.item_table = item_table
+
+    @classmethod
+    def from_model(cls, model) -> "FoldedScorer":
+        """
+        Build the scorer from a model with a ``folded_factors`` method, such as
+        `NNMatrixFactorization` or `ImplicitALS`.
+        """
+        return cls(*model.folded_factors())
+
+    def pairs(self, user: torch.Tensor, item: torch.Tensor) -> torch.Tensor:
+        """
+        Score each user with the paired item.
+        """
+        return score_pairs(
+            F.embedding(user, self.user_table), F.embedding(item, self.item_table)
+        )
+
+    def candidates(self, user: torch.Tensor, items: torch.Tensor) -> torch.Tensor:
+        """
+        Score the (B,) users against their (B, C) candidate items.
+        """
+        return score_candidates(
+            F.embedding(user, self.user_table), F.embedding(items, self.item_table)
+        )
+
+    def all(self, user: torch.Tensor) -> torch.Tensor:
+        """
+        Score the (B,) users against every item.
+        """
+        return score_all(F.embedding(user, self.user_table), self.item_table)
+
+    def top_k(self, k: int = 10, **kwargs):
+        """
+        The k highest scoring items for each user. See `top_k_scores`.
+        """
+        return top_k_scores(self.user_table, self.item_table, k=k, **kwargs)
+
+
+def top_k_scores(
+    user_table: torch.Tensor,
+    item_table: torch.Tensor,
+    k: int = 10,
+    users=None,
+    exclude: ItemSetIndex = None,
+    user_block_size: int = 1024,
+    item_block_size: int = None,
+):
+    """
+    Find the k items with the highest inner product with each user's vector.
+
+    Users are scored in blocks against blocks of the item table, keeping a
+    running top k for each user, so memory is bounded by
+    user_block_size x item_block_size scores rather than the full
+    n_users x n_items array. Tables from `quantize_tables` are scored in their
+    own precision, and the scores are returned as float32.
+
+    Args:
+        user_table (Union[torch.Tensor, QuantizedEmbedding]): The
+            (n_users, n_factors) user vectors.
+        item_table (Union[torch.Tensor, QuantizedEmbedding]): The
+            (n_items, n_factors) item vectors.
+        k (int, optional): Number of items to return. Defaults to 10.
+        users (Sequence[int], optional): The users to score. Defaults to every user.
+        exclude (ItemSetIndex, optional): Items each user has already interacted
+            with, which are never returned. Defaults to None.
+        user_block_size (int, optional): Number of users scored at once. Defaults
+            to 1024.
+        item_block_size (int, optional): Number of items scored at once. Defaults
+            to all items.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor]: The (n_users, k) item indices and
+            scores, ordered from highest to lowest score.
+    """
+    user_scale, item_scale = None, None
+    if isinstance(item_table, QuantizedEmbedding):
+        if not isinstance(user_table, QuantizedEmbedding):
+            raise ValueError("Quantize the user and item tables together.")
+        user_table, user_scale = user_table.weight, user_table.scale
+        item_table, item_scale = item_table.weight, item_table.scale
+
+    n_items = len(item_table)
+    k = min(k, n_items)
+    item_block_size = item_block_size or n_items
+
+    if users is None:
+        users = torch.arange(len(user_table))
+    users = torch.as_tensor(users, dtype=torch.long).view(-1).cpu()
+
+    top_items = torch.empty((len(users), k), dtype=torch.long)
+    top_scores = torch.empty(
+        (len(users), k),
+        dtype=torch.promote_types(user_table.dtype, torch.float32)
+        if user_table.is_floating_point()
+        else torch.float32,
+    )
+
+    for u_lo in range(0, len(users), user_block_size):
+        block_users = users[u_lo : u_lo + user_block_size]
+        user_vecs = user_table[block_users.to(user_table.device)]
+
+        if exclude is not None:
+            positions, seen = exclude.pairs(block_users.numpy())
+            positions = torch.from_numpy(positions).to(user_table.device)
+            seen = torch.from_numpy(seen.astype(np.int64)).to(user_table.device)
+
+        best_scores, best_items = None, None
+        for i_lo in range(0, n_items, item_block_size):
+            scores = score_all(
+                user_vecs,
+                item_table[i_lo : i_lo + item_block_size],
+                None
+                if item_scale is None
+                else item_scale[i_lo : i_lo + item_block_size],
+            )
+
+            if exclude is not None:
+                in_block = (seen >= i_lo) & (seen < i_lo + scores.shape[1])
+                scores[positions[in_block], seen[in_block] - i_lo] = -float("inf")
+
+            block_scores, block_items = torch.topk(
+                scores, min(k, scores.shape[1]), dim=1
+            )
+            block_items += i_lo
+
+            if best_scores is not None:
+                block_scores = torch.cat((best_scores, block_scores), dim=1)
+                block_items = torch.cat((best_items, block_items), dim=1)
+                block_scores, order = torch.topk(
+                    block_scores, min(k, block_scores.shape[1]), dim=1
+                )
+                block_items = block_items.gather(1, order)
+
+            best_scores, best_items = block_scores, block_items
+
+        if user_scale is not None:
+            best_scores = best_scores * user_scale[block_users.to(user_scale.device)]
+
+        top_items[u_lo : u_lo + len(block_users)] = best_items.cpu()
+        top_scores[u_lo : u_lo + len(block_users)] = best_scores.cpu()
+
+    return top_items, top_scores
+
+
+def _int8_mm(a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    """
+    Multiply int8 matrices with int32 accumulation, which is exact for inner
+    products of up to 2**17 factors, falling back to a float matmul when the
+    integer kernel is not available for the shapes or the device.
+    """
+    if hasattr(torch, "_int_mm"):
+        try:
+            return torch._int_mm(a, b)
+        except RuntimeError:
+            pass
+
+    return a.float() @ b.float()
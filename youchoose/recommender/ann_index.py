@@ -0,0 +1,221 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Approximate nearest neighbour index for serving recommendations.
+
+Recommending the top products for a user is a maximum inner product search
+(MIPS) over the product embeddings. Appending the extra coordinate
+``sqrt(M^2 - |x|^2)`` to every product vector, where ``M`` is the largest product
+norm, turns it into a nearest neighbour search, which is solved approximately
+with an inverted file (IVF) index: products are clustered with k-means and a
+query only scores the products in its ``n_probe`` closest clusters.
+"""
+import time
+
+import numpy as np
+
+
+class MIPSIndex:
+    """
+    Inverted file index for maximum inner product search over item vectors.
+    """
+
+    def __init__(
+        self,
+        n_lists: int = None,
+        n_probe: int = 8,
+        kmeans_iters: int = 10,
+        random_state: int = 23,
+    ):
+        """
+        Args:
+            n_lists (int, optional): Number of k-means clusters. Defaults to four
+                times the square root of the number of items.
+            n_probe (int, optional): Number of clusters scored per query. Higher
+                values trade latency for recall. Defaults to 8.
+            kmeans_iters (int, optional): Number of k-means iterations. Defaults
+                to 10.
+            random_state (int, optional): Seed for the k-means initialization.
+                Defaults to 23.
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.kmeans_iters = kmeans_iters
+        self.random_state = random_state
+
+    @classmethod
+    def from_model(cls, model, **kwargs) -> "MIPSIndex":
+        """
+        Build an index over the bias-folded product embeddings of a trained
+        NNMatrixFactorization model.
+        """
+        _, item_table = model.folded_factors()
+
+        return cls(**kwargs).fit(item_table.cpu().numpy())
+
+    def fit(self, item_vectors: np.ndarray) -> "MIPSIndex":
+        """
+        Cluster the items and build the inverted lists.
+
+        Args:
+            item_vectors (np.ndarray): The (n_items, n_factors) item vectors.
+
+        Returns:
+            MIPSIndex: The fitted index.
+        """
+        item_vectors = np.ascontiguousarray(item_vectors, dtype=np.float32)
+        n_items = len(item_vectors)
+        n_lists = self.n_lists or max(1, int(4 * np.sqrt(n_items)))
+        n_lists = min(n_lists, n_items)
+
+        norms = (item_vectors**2).sum(1)
+        extra = np.sqrt(np.maximum(norms.max() - norms, 0))
+        augmented = np.hstack((item_vectors, extra[:, None]))
+
+        self.centroids, assignment = _kmeans(
+            augmented, n_lists, self.kmeans_iters, self.random_state
+        )
+        self.centroid_norms = (self.centroids**2).sum(1)
+
+        order = np.argsort(assignment, kind="stable")
+        self.list_ptr = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=self.list_ptr[1:])
+        self.list_ids = order
+        self.list_vectors = item_vectors[order]
+        self.item_vectors = item_vectors
+
+        return self
+
+    def search(self, queries: np.ndarray, k: int = 10, n_probe: int = None):
+        """
+        Find the approximate top k items by inner product for each query.
+
+        Args:
+            queries (np.ndarray): The (n_queries, n_factors) user vectors.
+            k (int, optional): Number of items to return. Defaults to 10.
+            n_probe (int, optional): Number of clusters to score, overriding the
+                index setting. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The (n_queries, k) item indices and inner
+                products, ordered from highest to lowest. Rows are padded with -1
+                and -inf if the probed clusters hold fewer than k items.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+
+        # The augmented query has a zero final coordinate.
+        distances = self.centroid_norms - 2 * queries @ self.centroids[:, :-1].T
+        if n_probe < len(self.centroids):
+            probes = np.argpartition(distances, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.tile(np.arange(len(self.centroids)), (len(queries), 1))
+
+        top_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        top_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        for row, (query, lists) in enumerate(zip(queries, probes)):
+            rows = np.concatenate(
+                [np.arange(self.list_ptr[lst], self.list_ptr[lst + 1]) for lst in lists]
+            )
+            scores = self.list_vectors[rows] @ query
+            n_found = min(k, len(rows))
+            if not n_found:
+                continue
+
+            best = np.argpartition(-scores, n_found - 1)[:n_found]
+            best = best[np.argsort(-scores[best])]
+            top_ids[row, :n_found] = self.list_ids[rows[best]]
+            top_scores[row, :n_found] = scores[best]
+
+        return top_ids, top_scores
+
+    def exact_search(self, queries: np.ndarray, k: int = 10):
+        """
+        Brute force top k items by inner product, the ground truth for `search`.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, len(self.item_vectors))
+        scores = queries @ self.item_vectors.T
+
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, best, 1), axis=1)
+        best = np.take_along_axis(best, order, 1)
+
+        return best, np.take_along_axis(scores, best, 1)
+
+    def recall_report(
+        self, queries: np.ndarray, k: int = 10, n_probes=(1, 2, 4, 8, 16, 32)
+    ) -> list:
+        """
+        Measure recall@k against exact search and the per-query latency for a
+        range of n_probe settings.
+
+        Args:
+            queries (np.ndarray): The (n_queries, n_factors) user vectors.
+            k (int, optional): Number of items to retrieve. Defaults to 10.
+            n_probes (Sequence[int], optional): The n_probe values to measure.
+
+        Returns:
+            list: A dict of n_probe, recall, and mean latency in milliseconds for
+                each setting.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        exact_ids, _ = self.exact_search(queries, k)
+
+        report = []
+        for n_probe in n_probes:
+            start = time.perf_counter()
+            approx_ids = np.vstack(
+                [self.search(query, k, n_probe=n_probe)[0] for query in queries]
+            )
+            latency = (time.perf_counter() - start) / len(queries)
+
+            hits = sum(
+                len(np.intersect1d(exact, approx))
+                for exact, approx in zip(exact_ids, approx_ids)
+            )
+            report.append(
+                {
+                    "n_probe": n_probe,
+                    "recall": hits / exact_ids.size,
+                    "latency_ms": 1000 * latency,
+                }
+            )
+
+        return report
+
+
+def _kmeans(vectors: np.ndarray, n_clusters: int, n_iters: int, random_state: int):
+    """
+    Lloyd's k-means, returning the centroids and the cluster of each vector.
+    """
+    rng = np.random.RandomState(random_state)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iters):
+        assignment = _assign(vectors, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+
+        empty = np.flatnonzero(~filled)
+        centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+
+    return centroids, _assign(vectors, centroids)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray, chunk: int = 4096):
+    centroid_norms = (centroids**2).sum(1)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+
+    for lo in range(0, len(vectors), chunk):
+        block = vectors[lo : lo + chunk]
+        distances = centroid_norms - 2 * block @ centroids.T
+        assignment[lo : lo + chunk] = distances.argmin(1)
+
+    return assignment
@@ -0,0 +1,185 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Cache of top k recommendations.
+
+Entries are keyed by the model version, the user, k, and the options of the
+request, so a retrained or reloaded model never serves the recommendations of
+the previous one. The memory tier is an LRU bounded by the bytes of the cached
+arrays. With a disk directory, entries evicted from memory are written to disk,
+bounded by their own size limit, and promoted back to memory when requested
+again. The disk tier outlives the process, so a server restarted with the same
+checkpoint starts warm.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+# Approximate bytes of the key and bookkeeping of an entry.
+_ENTRY_OVERHEAD = 200
+
+
+class RecommendationCache:
+    """
+    Two tier LRU cache of the items and scores recommended to each user.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 2**28,
+        disk_dir: str = None,
+        max_disk_bytes: int = 2**32,
+    ):
+        """
+        Args:
+            max_bytes (int, optional): Memory used by the cached recommendations.
+                Defaults to 256MB.
+            disk_dir (str, optional): Directory of the disk tier. Defaults to
+                None, no disk tier.
+            max_disk_bytes (int, optional): Disk used by the disk tier. Defaults
+                to 4GB.
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        self.max_disk_bytes = max_disk_bytes
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            files = sorted(
+                self.disk_dir.glob("*/*.npz"), key=lambda f: f.stat().st_mtime
+            )
+            for filename in files:
+                self._disk[filename] = filename.stat().st_size
+                self._disk_bytes += self._disk[filename]
+
+    @staticmethod
+    def key(version, user, k: int, **options) -> tuple:
+        """
+        The key of the top k recommendations of a user by a model version.
+        """
+        if isinstance(user, np.generic):
+            user = user.item()
+
+        return (version, user, k, tuple(sorted(options.items())))
+
+    def get(self, key: tuple):
+        """
+        The cached items and scores of a key, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+
+            filename = self._disk_file(key)
+            if filename is not None and filename in self._disk:
+                with np.load(filename, allow_pickle=True) as saved:
+                    entry = (saved["items"], saved["scores"])
+                self._remove_disk(filename)
+                self._insert(key, entry)
+                self.stats["disk_hits"] += 1
+                return entry
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key: tuple, items: np.ndarray, scores: np.ndarray):
+        """
+        Cache the items and scores of a key, evicting the least recently used
+        entries over the memory limit.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= _nbytes(self._entries.pop(key))
+            self._insert(key, (np.asarray(items), np.asarray(scores)))
+
+    def invalidate(self, keep=None):
+        """
+        Drop the entries of every model version except ``keep``, or all entries
+        when ``keep`` is None.
+
+        Only the disk entries tracked by this cache are deleted, so caches of
+        other processes sharing the disk directory keep their entries. Version
+        directories left empty are removed.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] != keep]:
+                self._bytes -= _nbytes(self._entries.pop(key))
+
+            keep_dir = _version_dir(keep) if keep is not None else None
+            stale = [f for f in self._disk if f.parent.name != keep_dir]
+            for filename in stale:
+                self._disk_bytes -= self._disk.pop(filename)
+                try:
+                    filename.unlink()
+                except FileNotFoundError:
+                    pass
+            for directory in {filename.parent for filename in stale}:
+                try:
+                    directory.rmdir()
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return len(self._entries) + len(self._disk)
+
+    def __contains__(self, key):
+        return key in self._entries or self._disk_file(key) in self._disk
+
+    def _insert(self, key: tuple, entry: tuple):
+        self._entries[key] = entry
+        self._bytes += _nbytes(entry)
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            old_key, old_entry = self._entries.popitem(last=False)
+            self._bytes -= _nbytes(old_entry)
+            self.stats["evictions"] += 1
+            self._spill(old_key, old_entry)
+
+    def _spill(self, key: tuple, entry: tuple):
+        """
+        Write an entry evicted from memory to the disk tier.
+        """
+        filename = self._disk_file(key)
+        if filename is None:
+            return
+
+        filename.parent.mkdir(exist_ok=True)
+        if filename in self._disk:
+            self._disk_bytes -= self._disk.pop(filename)
+        np.savez(filename, items=entry[0], scores=entry[1])
+        self._disk[filename] = filename.stat().st_size
+        self._disk_bytes += self._disk[filename]
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            self._remove_disk(next(iter(self._disk)))
+
+    def _remove_disk(self, filename: Path):
+        self._disk_bytes -= self._disk.pop(filename)
+        filename.unlink()
+
+    def _disk_file(self, key: tuple):
+        if self.disk_dir is None:
+            return None
+
+        digest = hashlib.sha1(repr(key[1:]).encode()).hexdigest()
+        return self.disk_dir / _version_dir(key[0]) / "{}.npz".format(digest)
+
+
+def _version_dir(version) -> str:
+    return hashlib.sha1(repr(version).encode()).hexdigest()[:16]
+
+
+def _nbytes(entry: tuple) -> int:
+    return entry[0].nbytes + entry[1].nbytes + _ENTRY_OVERHEAD
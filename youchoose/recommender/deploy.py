@@ -3,9 +3,345 @@
 # See LICENCE file in root directory for full terms.
 """
  The deploy module can be used to deploy a trained model to be used for inferance.
+
+ `InferenceServer` serves the top k recommendations of a trained `Recommender`
+ over HTTP with asyncio. Concurrent requests are queued and coalesced into micro
+ batches, closed when they reach max_batch_size or when the first request has
+ waited max_wait_ms, and every batch is scored with a single `recommend_top`
+ call, i.e. one matrix multiply of the batch's users against the item table. The
+ scoring runs in a worker thread, so requests keep arriving and batches grow
+ while the previous batch is scored.
+
+    GET  /recommend?user=<id>&k=10   {"user": ..., "items": [...], "scores": [...]}
+    POST /recommend                  {"user": ..., "k": 10}
+    GET  /stats                      latency percentiles, QPS, and batch sizes
+    GET  /health                     {"status": "ok"}
 """
+import asyncio
+import json
+import time
+from collections import deque
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
 from .recommender import Recommender
 
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    """
+    An error answered with the given HTTP status.
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class InferenceServer:
+    """
+    Asyncio HTTP server answering top k requests with micro batched scoring.
+    """
+
+    def __init__(
+        self,
+        recommender: Recommender,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        max_batch_size: int = 256,
+        max_wait_ms: float = 2.0,
+        default_k: int = 10,
+        max_k: int = 100,
+        latency_window: int = 10000,
+    ):
+        """
+        Args:
+            recommender (Recommender): A trained recommender whose
+                ``recommend_top(k=k, users=users)`` returns the (n_users, k) items
+                and scores.
+            host (str, optional): Address to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on, 0 for any free port. Defaults
+                to 8000.
+            max_batch_size (int, optional): Most requests scored together.
+                Defaults to 256.
+            max_wait_ms (float, optional): Longest a request waits for others to
+                join its batch. Defaults to 2.0.
+            default_k (int, optional): Number of items when a request does not
+                give k. Defaults to 10.
+            max_k (int, optional): Largest k a request may ask for. Defaults to
+                100.
+            latency_window (int, optional): Number of recent requests the latency
+                percentiles are computed over. Defaults to 10000.
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        if not 1 <= default_k <= max_k:
+            raise ValueError("default_k must be between 1 and max_k.")
+
+        self.recommender = recommender
+        self.host = host
+        self.port = port
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.default_k = default_k
+        self.max_k = max_k
+
+        self._latencies = deque(maxlen=latency_window)
+        self._batch_sizes = deque(maxlen=latency_window)
+        self._requests = 0
+        self._started = None
+        self._queue = None
+        self._server = None
+        self._batcher = None
+
+    async def start(self):
+        """
+        Start listening and batching. The port is set to the bound port.
+        """
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started = time.perf_counter()
+
+    async def stop(self):
+        """
+        Stop listening and cancel the batching.
+        """
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+
+    def serve_forever(self):
+        """
+        Serve until interrupted.
+        """
+
+        async def serve():
+            await self.start()
+            async with self._server:
+                await self._server.serve_forever()
+
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def recommend(self, user, k: int = None):
+        """
+        Queue a request for the top k items of a user and wait for its batch.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The k items and their scores.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((user, k or self.default_k, future))
+
+        return await future
+
+    def stats(self) -> dict:
+        """
+        The latency percentiles in milliseconds over the recent requests, the
+        requests per second since the start, and the mean batch size.
+        """
+        latencies = np.asarray(self._latencies) * 1000
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+
+        return {
+            "requests": self._requests,
+            "qps": self._requests / elapsed if elapsed else 0.0,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+            "batches": len(self._batch_sizes),
+            "mean_batch_size": (
+                float(np.mean(self._batch_sizes)) if self._batch_sizes else 0.0
+            ),
+        }
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._score(loop, batch)
+
+    async def _score(self, loop, batch: list):
+        """
+        Score a batch with one `recommend_top` call, falling back to scoring the
+        requests one at a time so one bad request does not fail the others.
+        """
+        users = [user for user, _, _ in batch]
+        k = max(k for _, k, _ in batch)
+        self._batch_sizes.append(len(batch))
+
+        try:
+            items, scores = await loop.run_in_executor(None, self._top, users, k)
+        except Exception as error:
+            if len(batch) == 1:
+                _resolve(batch[0][2], error=error)
+                return
+            for request in batch:
+                await self._score(loop, [request])
+            return
+
+        for row, (_, request_k, future) in enumerate(batch):
+            _resolve(future, (items[row, :request_k], scores[row, :request_k]))
+
+    def _top(self, users: list, k: int):
+        items, scores = self.recommender.recommend_top(k=k, users=users)
+        return np.asarray(items), np.asarray(scores)
+
+    async def _handle(self, reader, writer):
+        """
+        Answer the requests of a connection until the client closes it.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+
+                start = time.perf_counter()
+                target = ""
+                try:
+                    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                    status, payload = 200, await self._route(method, target, body)
+                except HTTPError as error:
+                    status, payload = error.status, {"error": str(error)}
+                except ValueError as error:
+                    status, payload = 400, {"error": str(error)}
+                except Exception as error:
+                    status, payload = 500, {"error": repr(error)}
+
+                if urlsplit(target).path == "/recommend" and status == 200:
+                    self._latencies.append(time.perf_counter() - start)
+                    self._requests += 1
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, target: str, body: bytes) -> dict:
+        url = urlsplit(target)
+        if url.path == "/health":
+            return {"status": "ok"}
+        if url.path == "/stats":
+            return self.stats()
+        if url.path != "/recommend":
+            raise HTTPError(404, "Unknown path {}.".format(url.path))
+
+        if method == "GET":
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        elif method == "POST":
+            try:
+                query = json.loads(body or b"{}")
+            except ValueError:
+                raise HTTPError(400, "The body must be json.")
+        else:
+            raise HTTPError(405, "Use GET or POST.")
+
+        if "user" not in query:
+            raise HTTPError(400, "Give a user.")
+        try:
+            k = int(query.get("k", self.default_k))
+        except (TypeError, ValueError):
+            raise HTTPError(400, "k must be an integer.")
+        if not 1 <= k <= self.max_k:
+            raise HTTPError(400, "k must be between 1 and {}.".format(self.max_k))
+
+        user = self._parse_user(query["user"])
+        items, scores = await self.recommend(user, k)
+
+        return {
+            "user": query["user"],
+            "items": items.tolist(),
+            "scores": scores.tolist(),
+        }
+
+    def _parse_user(self, user):
+        """
+        Convert a user ID to the type of the recommender's vocabulary, if it has
+        one, and reject unknown users before they reach a batch.
+        """
+        vocab = getattr(self.recommender, "user_vocab", None)
+        if vocab is None:
+            return user
+
+        try:
+            if vocab.ids.dtype.kind in "iu":
+                user = int(user)
+            elif vocab.ids.dtype.kind == "f":
+                user = float(user)
+        except (TypeError, ValueError):
+            raise HTTPError(404, "Unknown user {}.".format(user))
+        if user not in vocab:
+            raise HTTPError(404, "Unknown user {}.".format(user))
+
+        return user
+
+
+def _resolve(future, result=None, error: Exception = None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def _response(status: int, payload: dict, keep_alive: bool = True) -> bytes:
+    body = json.dumps(payload).encode()
+    head = (
+        "HTTP/1.1 {} {}\r\n"
+        "Content-Type: application/json\r\n"
+        "Content-Length: {}\r\n"
+        "Connection: {}\r\n\r\n"
+    ).format(
+        status, _REASONS[status], len(body), "keep-alive" if keep_alive else "close"
+    )
+
+    return head.encode("latin-1") + body
+
 
 def aws_s3(model: Recommender):
     model.save()
@@ -5,10 +5,36 @@
 Matrix factorization recommender.
 
 """
-# import torch
-# import torch.nn as nn
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+
+from ..data.data_loading import InteractionsDataset, batch_dataloader
+from ..data.data_processing import ItemSetIndex, split_indices, transform_data_ids
+from ..evaluate.auc import evaluate_model
+from ..extraction.implicit_als import ImplicitALS
+from ..extraction.nn_latent_matrix_factorization import NNMatrixFactorization
+from ..interaction.pointwise import INFERENCE_DTYPES
+from ..utils.checkpoint import load_checkpoint, save_checkpoint
+from .cache import RecommendationCache
+from .deploy import InferenceServer
 from .recommender import Recommender
 
+OPTIMIZERS = {
+    "sgd": torch.optim.SGD,
+    "adam": torch.optim.Adam,
+    "sparse_adam": torch.optim.SparseAdam,
+    "adagrad": torch.optim.Adagrad,
+}
+
+STORAGE_DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
 
 class MatrixFactorization(Recommender):
     """
@@ -18,45 +44,508 @@ class MatrixFactorization(Recommender):
 
     def __init__(
         self,
-        method,
-        data,
-        use_cuda,
-        embedding_dimension,
-        train_frac,
-        test_frac,
-        epochs,
-        reg,
-        optimizer,
+        method: str,
+        data: pd.DataFrame,
+        use_cuda: bool = False,
+        embedding_dimension: int = 20,
+        train_frac: float = 0.80,
+        test_frac: float = 0.10,
+        epochs: int = 10,
+        reg: float = 0.0,
+        optimizer: str = "sgd",
+        lr: float = 0.01,
+        batch_size: int = 1024,
+        neg_samples: int = 1,
+        num_workers=0,
+        dtype: str = "float32",
+        inference_dtype: str = None,
+        user_col: str = "user_id",
+        item_col: str = "item_id",
+        weight_col: str = "interaction",
+        **kwargs
     ):
         """
         Initialize the latent matrices and optimization parameters.
 
         Args:
-            method (str): The type of matrix factorization to use.
+            method (str): The type of matrix factorization to use, "nn" for the
+                pytorch model trained with a DataLoader or "als" for implicit
+                feedback alternating least squares.
+            data (pd.DataFrame): Dataframe containing the user-item interactions.
+            use_cuda (bool, optional): Train the nn model on the gpu when available.
+                Defaults to False.
+            embedding_dimension (int, optional): Dimension of the latent space.
+                Defaults to 20.
+            train_frac (float, optional): The proportion of data used for training.
+                Defaults to 0.80.
+            test_frac (float, optional): The proportion of data used for testing.
+                Defaults to 0.10.
+            epochs (int, optional): Number of training epochs, or ALS iterations.
+                Defaults to 10.
             reg (float, optional): If reg is greater than 0, add L2 regularization on the latent dimensions.
-            optimizer (str, optional): sgd, adam, etc
-            loss (str): ranking, pointwise, mse
-            neg_samples (int, optional): for pairwise ranking, the number of negative samples to use.
+            optimizer (str, optional): sgd, adam, sparse_adam, or adagrad. Only used
+                by the nn method. Defaults to "sgd".
+            lr (float, optional): Learning rate of the nn method. Defaults to 0.01.
+            batch_size (int, optional): Batch size of the nn method. Defaults to 1024.
+            neg_samples (int, optional): Number of unobserved items sampled as
+                negatives for each positive by the nn method, at least 1, or
+                every training example would be a positive. Defaults to 1.
+            num_workers (Union[int, str], optional): Number of processes loading
+                the training batches of the nn method, or "auto". See
+                `batch_dataloader`. Defaults to 0.
+            dtype (str, optional): Storage type of the nn embeddings, "float32",
+                or "bfloat16" or "float16" to halve the memory of the model. See
+                `NNMatrixFactorization`. Defaults to "float32".
+            inference_dtype (str, optional): "int8", "bfloat16", or "float16" to
+                recommend from a copy of the tables in that precision, made after
+                training, updating, or loading. See `quantize_tables`. Defaults to
+                None, the model's own tables.
+            user_col (str, optional): Column name for the users. Defaults to "user_id".
+            item_col (str, optional): Column name for the items. Defaults to "item_id".
+            weight_col (str, optional): Column name for the interaction metric.
+                Defaults to "interaction".
+            **kwargs (dict, optional): Additional arguments to pass to the model,
+                e.g. alpha or n_jobs for ALS.
         """
-        assert method in ["nn", "als"]
+        if method not in ["nn", "als"]:
+            raise ValueError("method must be one of nn or als.")
+        if method == "nn" and optimizer not in OPTIMIZERS:
+            raise ValueError(
+                "optimizer must be one of {}.".format(", ".join(OPTIMIZERS))
+            )
+        if method == "nn" and neg_samples < 1:
+            raise ValueError("neg_samples must be at least 1 for the nn method.")
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError(
+                "dtype must be one of {}.".format(", ".join(STORAGE_DTYPES))
+            )
+        if method == "als" and dtype != "float32":
+            raise ValueError("als factors are stored as float32.")
+        if inference_dtype is not None and inference_dtype not in INFERENCE_DTYPES:
+            raise ValueError(
+                "inference_dtype must be one of {}.".format(", ".join(INFERENCE_DTYPES))
+            )
+
+        self.method = method
+        self.data = data
+        self.dev = torch.device(
+            "cuda" if use_cuda and torch.cuda.is_available() else "cpu"
+        )
+        self.embedding_dimension = embedding_dimension
+        self.train_frac = train_frac
+        self.test_frac = test_frac
+        self.epochs = epochs
+        self.reg = reg
+        self.optimizer = optimizer
+        self.lr = lr
+        self.batch_size = batch_size
+        self.neg_samples = neg_samples
+        self.num_workers = num_workers
+        self.dtype = dtype
+        self.inference_dtype = inference_dtype
+        self.user_col = user_col
+        self.item_col = item_col
+        self.weight_col = weight_col
+        self.model_kwargs = kwargs
+        self.model = None
+        self.splits = None
 
     def create(self):
-        pass
+        """
+        Index the interactions, split them into train, validation, and test sets,
+        and initialize the model.
+        """
+        df, self.user_vocab, self.item_vocab = transform_data_ids(
+            self.data.copy(),
+            user_col=self.user_col,
+            item_col=self.item_col,
+            weight_col=self.weight_col,
+        )
+        self._set_interactions(df)
+
+        n_users, n_items = len(self.user_vocab), len(self.item_vocab)
+        train = self.splits[0]
+        self.train_items = ItemSetIndex.from_arrays(
+            self.users[train], self.items[train], n_users=n_users
+        )
+
+        if self.method == "als":
+            self.model = ImplicitALS(
+                n_users,
+                n_items,
+                n_factors=self.embedding_dimension,
+                reg=self.reg,
+                iterations=self.epochs,
+                **self.model_kwargs
+            )
+        else:
+            self.model = NNMatrixFactorization(
+                n_users,
+                n_items,
+                n_factors=self.embedding_dimension,
+                optimizer=OPTIMIZERS[self.optimizer],
+                lr=self.lr,
+                l2=self.reg,
+                sparse=self.optimizer == "sparse_adam",
+                dtype=STORAGE_DTYPES[self.dtype],
+                **self.model_kwargs
+            ).to(self.dev)
+
+        return self
+
+    def train(self, profiler=None):
+        """
+        Fit the model to the training interactions.
+
+        Args:
+            profiler (TrainingProfiler, optional): Records where the training time
+                goes, see `youchoose.utils.logging`. Defaults to None.
+
+        Returns:
+            dict: The training statistics of the model.
+        """
+        if self.model is None:
+            self.create()
+        self._check_splits()
+        train = self.splits[0]
+
+        if self.method == "als":
+            self.model.fit(
+                self.users[train],
+                self.items[train],
+                self.weights[train],
+                profiler=profiler,
+            )
+        else:
+            loader = batch_dataloader(
+                self._dataset(train, on_device=not self.num_workers),
+                self.batch_size,
+                shuffle=True,
+                num_workers=self.num_workers,
+            )
+            for _ in range(self.epochs):
+                self.model.train_model(loader, profiler=profiler)
+        self._quantize()
+        self._new_model_version()
+
+        return self.model.train_stats
+
+    def evaluate(self, k: int = 10, split: int = 2, **kwargs) -> dict:
+        """
+        Ranking metrics of the held out interactions over the full item catalog,
+        never ranking an item a user has already interacted with in training.
+
+        Args:
+            k (int, optional): The cutoff of the top k metrics. Defaults to 10.
+            split (int, optional): 1 for the validation set or 2 for the test set.
+                Defaults to 2.
+            **kwargs (dict, optional): Additional arguments to pass to
+                `ranking_metrics`, e.g. a ``profiler``.
+
+        Returns:
+            dict: The mean AUC, precision@k, recall@k, NDCG@k, and MAP@k.
+        """
+        self._check_splits()
+        held_out = self.splits[split]
+        relevant = ItemSetIndex.from_arrays(
+            self.users[held_out], self.items[held_out], n_users=len(self.user_vocab)
+        )
+
+        return evaluate_model(
+            self.model, relevant, train=self.train_items, k=k, **kwargs
+        )
+
+    def save(self, path):
+        """
+        Save the trained recommender as a checkpoint directory that `load` memory
+        maps, see `youchoose.utils.checkpoint`.
+
+        The settings and the training items of each user are stored in the
+        directory, and the model, with its optimizer state and the user and item
+        vocabularies, in its "model" subdirectory. The interaction data and the
+        splits are not saved.
+
+        Args:
+            path (str): The checkpoint directory, replaced if it exists.
+        """
+        if self.model is None:
+            raise ValueError("The recommender has no model to save.")
+
+        settings = {
+            name: getattr(self, name)
+            for name in (
+                "embedding_dimension",
+                "train_frac",
+                "test_frac",
+                "epochs",
+                "reg",
+                "optimizer",
+                "lr",
+                "batch_size",
+                "neg_samples",
+                "num_workers",
+                "dtype",
+                "inference_dtype",
+                "user_col",
+                "item_col",
+                "weight_col",
+            )
+        }
+        model_kwargs = {
+            key: value
+            for key, value in self.model_kwargs.items()
+            if value is None or isinstance(value, (bool, int, float, str))
+        }
+
+        save_checkpoint(
+            path,
+            {
+                "train_items.indptr": self.train_items.indptr,
+                "train_items.indices": self.train_items.indices,
+            },
+            meta={
+                "method": self.method,
+                "model_version": self.model_version,
+                "settings": settings,
+                "model_kwargs": model_kwargs,
+            },
+        )
+        self.model.save(
+            Path(path) / "model", user_vocab=self.user_vocab, item_vocab=self.item_vocab
+        )
+
+    @classmethod
+    def load(
+        cls,
+        path,
+        data: pd.DataFrame = None,
+        use_cuda: bool = False,
+        mmap_mode: str = "c",
+        cache: RecommendationCache = None,
+    ) -> "MatrixFactorization":
+        """
+        Load a recommender saved with `save`, ready to recommend. The arrays are
+        memory mapped, so loading takes milliseconds and serving processes
+        loading the same checkpoint share its pages.
+
+        Args:
+            path (str): The checkpoint directory.
+            data (pd.DataFrame, optional): The interactions the recommender was
+                trained on, split again as in training so the loaded recommender
+                can be trained further and evaluated. Defaults to None, only
+                recommending.
+            use_cuda (bool, optional): Move the nn model to the gpu when available.
+                Defaults to False.
+            mmap_mode (str, optional): "c" to map the arrays copy-on-write, "r"
+                to map them read only for serving, or None to read them into
+                memory. Defaults to "c".
+            cache (RecommendationCache, optional): A cache for the loaded model,
+                e.g. the cache of the recommender it replaces. Entries of other
+                model versions are dropped. Defaults to None.
+
+        Raises:
+            ValueError: If the data has user or item IDs not in the checkpoint.
+        Returns:
+            MatrixFactorization: The loaded recommender.
+        """
+        arrays, meta = load_checkpoint(path, mmap_mode=mmap_mode)
+        recommender = cls(
+            meta["method"],
+            data,
+            use_cuda=use_cuda,
+            **meta["settings"],
+            **meta["model_kwargs"]
+        )
+
+        model_cls = (
+            ImplicitALS if recommender.method == "als" else NNMatrixFactorization
+        )
+        model = model_cls.load(Path(path) / "model", mmap_mode=mmap_mode)
+        if recommender.method == "nn":
+            model = model.to(recommender.dev)
+
+        recommender.model = model
+        recommender.user_vocab = model.user_vocab
+        recommender.item_vocab = model.item_vocab
+        recommender.train_items = ItemSetIndex(
+            arrays["train_items.indptr"], arrays["train_items.indices"]
+        )
+        if data is not None:
+            recommender._set_interactions(recommender._encode(data))
+        if meta.get("model_version"):
+            recommender.model_version = meta["model_version"]
+        else:
+            recommender._new_model_version()
+        recommender._quantize()
+        recommender.set_cache(cache)
+
+        return recommender
+
+    def deploy(self, **kwargs):
+        """
+        Serve the top k recommendations over HTTP until interrupted.
+
+        Args:
+            **kwargs (dict, optional): Arguments of `InferenceServer`, e.g. the
+                port, max_batch_size, or max_wait_ms.
+        """
+        InferenceServer(self, **kwargs).serve_forever()
+
+    def recommend_top(self, k: int = 10, users=None, exclude_seen: bool = True):
+        """
+        Recommend the top k items for each user.
+
+        Args:
+            k (int, optional): Number of items to recommend. Defaults to 10.
+            users (Sequence, optional): The user IDs to recommend for. Defaults to
+                every user.
+            exclude_seen (bool, optional): Never recommend items the user
+                interacted with in training. Defaults to True.
+
+        Recommendations of the given users are served from and stored in the
+        cache, if one is set with `set_cache`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The (n_users, k) item IDs and scores.
+        """
+        if users is not None and self.cache is not None:
+            options = {"exclude_seen": exclude_seen}
+            if self.inference_dtype is not None:
+                options["inference_dtype"] = self.inference_dtype
+            return self._cached_top(
+                users,
+                k,
+                lambda missing: self._recommend_top(k, missing, exclude_seen),
+                **options
+            )
+
+        return self._recommend_top(k, users, exclude_seen)
+
+    def update(
+        self,
+        data: pd.DataFrame,
+        epochs: int = 1,
+        lr: float = None,
+        products: bool = True,
+    ) -> float:
+        """
+        Update the nn model with new interactions without retraining it.
+
+        New users and items are appended to the vocabularies, the embedding
+        tables are grown to match, and only the rows of the users and items in
+        the new interactions are fine-tuned with `NNMatrixFactorization.fold_in`.
+        The new interactions are added to the training items of each user, and
+        `save` persists the extended vocabularies with the model. As in training,
+        every interaction is a positive with weight 1.0, whatever its weight
+        column.
+
+        Args:
+            data (pd.DataFrame): The new interactions, with the same columns as
+                the training data.
+            epochs (int, optional): Number of passes over the new interactions.
+                Defaults to 1.
+            lr (float, optional): Learning rate of the fold-in. Defaults to the
+                learning rate of the recommender.
+            products (bool, optional): Also update the item rows, otherwise only
+                the users are folded in. Defaults to True.
+
+        Returns:
+            float: The mean loss of the last fold-in epoch.
+        """
+        if self.method != "nn":
+            raise ValueError("Incremental updates are only supported by nn.")
+        if self.model is None:
+            raise ValueError("Train or load the recommender before updating it.")
+
+        users = self.user_vocab.encode(data[self.user_col].to_numpy(), grow=True)
+        items = self.item_vocab.encode(data[self.item_col].to_numpy(), grow=True)
+        weights = np.ones(len(data), dtype=np.float32)
+        n_users, n_items = len(self.user_vocab), len(self.item_vocab)
+
+        self.model.grow(n_users, n_items)
+        self.train_items = self.train_items.extend(users, items, n_users=n_users)
+
+        dataset = InteractionsDataset.from_arrays(
+            users,
+            items,
+            weights,
+            n_items,
+            dev=self.dev,
+            num_negs=self.neg_samples,
+            index=self.train_items,
+        )
+        loss = self.model.fold_in(
+            batch_dataloader(dataset, self.batch_size, shuffle=True),
+            epochs=epochs,
+            lr=lr or self.lr,
+            products=products,
+        )
+        self._quantize()
+        self._new_model_version()
+
+        return loss
+
+    def most_active_users(self, n: int = 1000) -> np.ndarray:
+        """
+        The IDs of the n users with the most training interactions, e.g. to warm
+        the cache with `warm_cache`.
+        """
+        counts = self.train_items.counts()
+        n = min(n, len(counts))
+        top = np.argpartition(-counts, n - 1)[:n] if n else np.arange(0)
+
+        return self.user_vocab.decode(top[np.argsort(-counts[top], kind="stable")])
+
+    def _recommend_top(self, k: int, users, exclude_seen: bool):
+        if users is not None:
+            users = self.user_vocab.encode(np.asarray(users))
+            if (users < 0).any():
+                raise ValueError("Unknown user IDs.")
+
+        top_items, top_scores = self.model.recommend_top(
+            k=k, users=users, exclude=self.train_items if exclude_seen else None
+        )
+        items = self.item_vocab.decode(top_items.numpy().ravel())
+
+        return items.reshape(top_items.shape), top_scores.numpy()
 
-    def train(self):
-        pass
+    def _set_interactions(self, df: pd.DataFrame):
+        self.splits = split_indices(
+            df, train_frac=self.train_frac, test_frac=self.test_frac
+        )
+        self.users = df[self.user_col].to_numpy()
+        self.items = df[self.item_col].to_numpy()
+        self.weights = df[self.weight_col].to_numpy(dtype=np.float32)
 
-    def evaluate(self):
-        pass
+    def _encode(self, data: pd.DataFrame) -> pd.DataFrame:
+        # The vocabularies of the checkpoint may have been extended by `update`,
+        # so the IDs are encoded with them rather than indexed again.
+        df = data.copy()
+        df[self.user_col] = self.user_vocab.encode(df[self.user_col].to_numpy())
+        df[self.item_col] = self.item_vocab.encode(df[self.item_col].to_numpy())
+        if (df[self.user_col] < 0).any() or (df[self.item_col] < 0).any():
+            raise ValueError("The data has user or item IDs not in the checkpoint.")
+        df[self.weight_col] = 1.0
 
-    def save(self):
-        pass
+        return df
 
-    def load(self):
-        pass
+    def _check_splits(self):
+        if self.splits is None:
+            raise ValueError(
+                "The recommender has no interaction data, load it with the data "
+                "it was trained on to train or evaluate it."
+            )
 
-    def deploy(self):
-        pass
+    def _quantize(self):
+        if self.inference_dtype is not None:
+            self.model.quantize(self.inference_dtype)
 
-    def recommend_top(self):
-        pass
+    def _dataset(self, idx: np.ndarray, on_device=True) -> InteractionsDataset:
+        return InteractionsDataset.from_arrays(
+            self.users[idx],
+            self.items[idx],
+            self.weights[idx],
+            len(self.item_vocab),
+            dev=self.dev if on_device else torch.device("cpu"),
+            num_negs=self.neg_samples,
+        )
@@ -5,7 +5,9 @@
 Neural network layer library.
 
 """
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class ScaledEmbedding(nn.Embedding):
@@ -34,3 +36,61 @@ class ZeroEmbedding(nn.Embedding):
         Initialize parameters.
         """
         self.weight.data.zero_()
+
+
+class QuantizedEmbedding(nn.Module):
+    """
+    Embedding table stored as int8 with a float scale per row, a quarter of the
+    memory of a float32 table, for inference.
+
+    Each row is scaled so its largest absolute value maps to 127 and rounded,
+    so the error of every value is at most half the row's scale.
+
+    .. math:: weights_i ~ scale_i q_i, scale_i = max_j |weights_{ij}| / 127
+    """
+
+    def __init__(self, num_embeddings: int, embedding_dim: int):
+        """
+        Args:
+            num_embeddings (int): Number of rows.
+            embedding_dim (int): Dimension of each row.
+        """
+        super(QuantizedEmbedding, self).__init__()
+
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.register_buffer(
+            "weight", torch.zeros((num_embeddings, embedding_dim), dtype=torch.int8)
+        )
+        self.register_buffer("scale", torch.ones((num_embeddings, 1)))
+
+    @classmethod
+    def from_float(cls, weight: torch.Tensor) -> "QuantizedEmbedding":
+        """
+        Quantize the rows of a float table.
+        """
+        weight = weight.detach().float()
+        embedding = cls(0, weight.shape[1])
+
+        scale = weight.abs().amax(dim=1, keepdim=True) / 127
+        scale[scale == 0] = 1.0
+        embedding.weight = torch.round(weight / scale).clamp(-127, 127).to(torch.int8)
+        embedding.scale = scale
+        embedding.num_embeddings = len(weight)
+
+        return embedding
+
+    def forward(self, input):
+        """
+        The dequantized float rows of the indices.
+        """
+        return F.embedding(input, self.weight).float() * F.embedding(input, self.scale)
+
+    def dequantize(self) -> torch.Tensor:
+        """
+        The float table the quantized rows represent.
+        """
+        return self.weight.float() * self.scale
+
+    def __len__(self):
+        return self.num_embeddings
@@ -4,11 +4,17 @@
 """
 The recommender class.
 """
+import uuid
+
+import numpy as np
 
 
 class Recommender:
     """ Recommender Base class."""
 
+    cache = None
+    model_version = None
+
     def create(self):
         pass
 
@@ -29,3 +35,67 @@ class Recommender:
 
     def recommend_top(self):
         pass
+
+    def set_cache(self, cache):
+        """
+        Cache the recommendations of `recommend_top` for the current model
+        version, dropping any entries of other versions.
+
+        Args:
+            cache (RecommendationCache): The cache, or None to stop caching.
+        """
+        self.cache = cache
+        if cache is not None:
+            cache.invalidate(keep=self.model_version)
+
+    def warm_cache(self, users, k: int = 10, batch_size: int = 1024, **kwargs):
+        """
+        Compute and cache the recommendations of the users in batches, e.g. for
+        the most active users after a retrain.
+
+        Args:
+            users (Sequence): The user IDs.
+            k (int, optional): Number of items to recommend. Defaults to 10.
+            batch_size (int, optional): Number of users scored at once. Defaults
+                to 1024.
+            **kwargs (dict, optional): Additional arguments to pass to
+                `recommend_top`.
+        """
+        if self.cache is None:
+            raise ValueError("Set a cache before warming it.")
+
+        users = np.asarray(users)
+        for lo in range(0, len(users), batch_size):
+            self.recommend_top(k=k, users=users[lo : lo + batch_size], **kwargs)
+
+    def _new_model_version(self):
+        """
+        Give the model a new version, after it is trained or loaded, so the
+        cached recommendations of the previous model are no longer served.
+        """
+        self.model_version = uuid.uuid4().hex
+        if self.cache is not None:
+            self.cache.invalidate(keep=self.model_version)
+
+    def _cached_top(self, users, k: int, compute, **options):
+        """
+        The top k items and scores of the users, computing only those not in the
+        cache with a single call of ``compute(users)`` and caching them.
+        """
+        users = np.asarray(users)
+        keys = [
+            self.cache.key(self.model_version, user, k, **options) for user in users
+        ]
+        cached = [self.cache.get(key) for key in keys]
+
+        missing = [row for row, entry in enumerate(cached) if entry is None]
+        if missing:
+            items, scores = compute(users[missing])
+            for i, row in enumerate(missing):
+                cached[row] = (items[i], scores[i])
+                self.cache.put(keys[row], items[i], scores[i])
+
+        return (
+            np.stack([items for items, _ in cached]),
+            np.stack([scores for _, scores in cached]),
+        )
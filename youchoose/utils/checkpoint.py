@@ -0,0 +1,208 @@
+# Copyright (c) 2019, Corey Smith
+# Distributed under the MIT License.
+# See LICENCE file in root directory for full terms.
+"""
+Checkpoints of tensors and arrays stored as raw arrays.
+
+A checkpoint is a directory holding one .npy file per tensor or array and a
+meta.json describing them, along with any other settings of the model. Loading
+memory maps the arrays, so a model of several GB loads in milliseconds, only the pages that
+are read are brought into memory, and processes loading the same checkpoint
+share those pages. With the default copy-on-write mapping a process that writes
+to a tensor, e.g. by training, gets a private copy of the pages it changes and
+the files are never modified.
+
+    checkpoint/
+        meta.json
+        user_factors.weight.npy
+        product_factors.weight.npy
+        ...
+"""
+import functools
+import importlib
+import inspect
+import json
+import os
+import shutil
+import warnings
+from pathlib import Path
+
+import numpy as np
+import torch
+
+META_FILE = "meta.json"
+FORMAT_VERSION = 1
+
+# Classes are only imported from these packages, as a checkpoint names the
+# classes its model is created with.
+IMPORT_PREFIXES = ("youchoose.", "torch.optim.", "torch.nn.modules.")
+
+# Tensors of these types are stored as an integer view of the same width, as
+# numpy has no equivalent type.
+_VIEW_DTYPES = {torch.bfloat16: torch.int16}
+
+
+def save_checkpoint(path, arrays: dict, meta: dict = None):
+    """
+    Save tensors and arrays as .npy files, and their names and the metadata as
+    json.
+
+    The checkpoint is written next to the path and then renamed into place,
+    after the checkpoint it replaces is renamed aside, so a process loading the
+    path never sees a partly written checkpoint. The replace is not atomic: the
+    path is missing between the two renames, and a crash between them leaves
+    the old checkpoint next to the path.
+
+    Args:
+        path (str): The checkpoint directory, replaced if it exists.
+        arrays (dict): The tensors or numpy arrays keyed by name. The name is
+            used as the file name of the array.
+        meta (dict, optional): Json serializable metadata. Defaults to None.
+    """
+    path = Path(path)
+    staging = path.with_name("{}.tmp-{}".format(path.name, os.getpid()))
+    if staging.exists():
+        shutil.rmtree(staging)
+    staging.mkdir(parents=True)
+
+    entries = {}
+    for name, value in arrays.items():
+        entry = {"file": "{}.npy".format(name), "tensor": torch.is_tensor(value)}
+        if entry["tensor"]:
+            value = value.detach().cpu()
+            entry["dtype"] = str(value.dtype).replace("torch.", "")
+            if value.dtype in _VIEW_DTYPES:
+                value = value.view(_VIEW_DTYPES[value.dtype])
+            value = value.numpy()
+
+        value = np.ascontiguousarray(value)
+        entry["shape"] = list(value.shape)
+        entry["object"] = value.dtype == object
+        np.save(staging / entry["file"], value, allow_pickle=entry["object"])
+        entries[name] = entry
+
+    with open(staging / META_FILE, "w") as f:
+        json.dump(
+            {"format_version": FORMAT_VERSION, "arrays": entries, "meta": meta or {}},
+            f,
+            indent=2,
+        )
+
+    old = path.with_name("{}.old-{}".format(path.name, os.getpid()))
+    if old.exists():
+        shutil.rmtree(old)
+    if path.exists():
+        path.rename(old)
+    staging.rename(path)
+    if old.exists():
+        shutil.rmtree(old)
+
+
+def load_checkpoint(path, mmap_mode: str = "c"):
+    """
+    Load the tensors, arrays, and metadata saved with `save_checkpoint`.
+
+    Args:
+        path (str): The checkpoint directory.
+        mmap_mode (str, optional): How the arrays are memory mapped, "c" for
+            copy-on-write, "r" for read only, or None to read them into memory.
+            Tensors sharing a read only map must never be written to. Arrays of
+            python objects, marked as such when saved, are read into memory.
+            Defaults to "c".
+
+    Returns:
+        Tuple[dict, dict]: The tensors and arrays keyed by name, and the metadata.
+    """
+    path = Path(path)
+    if not (path / META_FILE).exists():
+        raise ValueError("{} is not a checkpoint directory.".format(path))
+
+    with open(path / META_FILE) as f:
+        saved = json.load(f)
+    if saved.get("format_version", 0) > FORMAT_VERSION:
+        raise ValueError(
+            "Checkpoint format {} is newer than {}.".format(
+                saved["format_version"], FORMAT_VERSION
+            )
+        )
+
+    arrays = {}
+    for name, entry in saved["arrays"].items():
+        filename = path / entry["file"]
+        if entry.get("object", False):
+            array = np.load(filename, allow_pickle=True)
+        else:
+            array = np.load(filename, mmap_mode=mmap_mode)
+
+        if entry["tensor"]:
+            array = _to_tensor(array)
+            dtype = getattr(torch, entry["dtype"])
+            if dtype in _VIEW_DTYPES:
+                array = array.view(dtype)
+        arrays[name] = array
+
+    return arrays, saved["meta"]
+
+
+def object_path(obj) -> str:
+    """
+    The import path of a class, or of the class of an object.
+    """
+    cls = obj if inspect.isclass(obj) else type(obj)
+
+    return "{}.{}".format(cls.__module__, cls.__qualname__)
+
+
+def import_object(name: str):
+    """
+    Import a class from the path given by `object_path`.
+
+    Only classes defined in the packages of `IMPORT_PREFIXES` are imported, so
+    loading a checkpoint never calls arbitrary code named in its metadata.
+
+    Raises:
+        ValueError: If the path is not a class of an allowed package.
+    """
+    if not name.startswith(IMPORT_PREFIXES):
+        raise ValueError("Importing {} is not allowed.".format(name))
+
+    module, _, qualname = name.rpartition(".")
+    obj = importlib.import_module(module)
+    for attr in qualname.split("."):
+        obj = getattr(obj, attr)
+
+    if not (inspect.isclass(obj) and object_path(obj).startswith(IMPORT_PREFIXES)):
+        raise ValueError("Importing {} is not allowed.".format(name))
+
+    return obj
+
+
+def constructor_config(obj) -> dict:
+    """
+    The class and the json serializable constructor arguments of an object, for
+    the arguments stored as attributes of the same name.
+    """
+    kwargs = {}
+    for name in inspect.signature(type(obj).__init__).parameters:
+        value = getattr(obj, name, None)
+        if name != "self" and isinstance(value, (bool, int, float, str)):
+            kwargs[name] = value
+
+    return {"class": object_path(obj), "kwargs": kwargs}
+
+
+def from_config(config: dict):
+    """
+    A factory creating objects from the output of `constructor_config`.
+    """
+    return functools.partial(import_object(config["class"]), **config["kwargs"])
+
+
+def _to_tensor(array: np.ndarray) -> torch.Tensor:
+    if array.ndim == 0:
+        return torch.from_numpy(np.array(array))
+
+    with warnings.catch_warnings():
+        # The caller is told never to write to tensors of a read only map.
+        warnings.filterwarnings("ignore", message="The given NumPy array")
+        return torch.from_numpy(array)
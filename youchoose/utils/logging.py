@@ -5,4 +5,322 @@
  Library for logging process and errors during ingestion, data manipulation,
  training, and serving of the recommender systems. For pytorch models, the logging
  can be done using TensorBoard.
+
+ `TrainingProfiler` records where the time of training and evaluation goes. A
+ loop runs in a section, e.g. "train" or "evaluate", and its work is split into
+ phases such as data fetch, forward, backward, and optimizer step. Each section
+ keeps the time of every phase, the samples per second, and the peak memory, and
+ can write a torch.profiler trace for TensorBoard. Loops take ``profiler=None``
+ and fall back to `NULL_PROFILER`, whose methods do nothing, so instrumentation
+ costs a few attribute lookups per batch when disabled.
+
+    profiler = TrainingProfiler(trace_dir="runs/profile")
+    model.train_model(loader, profiler=profiler)
+    print(profiler.report())
 """
+import logging
+import sys
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from typing import Optional
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class _Phase:
+    """
+    Reusable context manager adding its elapsed time to a phase of the current
+    section.
+    """
+
+    __slots__ = ("profiler", "name", "start", "record")
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+        self.record = None
+
+    def __enter__(self):
+        if self.profiler._trace is not None:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        profiler._synchronize()
+        profiler._current["phases"][self.name] += time.perf_counter() - self.start
+        if self.record is not None:
+            self.record.__exit__(*exc)
+            self.record = None
+        return False
+
+
+class TrainingProfiler:
+    """
+    Per-phase timers, throughput, memory high-water marks, and optional
+    torch.profiler traces of training and evaluation loops.
+    """
+
+    def __init__(
+        self,
+        synchronize: bool = True,
+        trace_dir: str = None,
+        trace_sections=("train",),
+        trace_wait: int = 1,
+        trace_warmup: int = 1,
+        trace_active: int = 3,
+    ):
+        """
+        Args:
+            synchronize (bool, optional): Wait for queued gpu work at the end of
+                each phase, so the time of asynchronous kernels is attributed to
+                the phase that launched them. Defaults to True.
+            trace_dir (str, optional): Write a torch.profiler trace of the first
+                run of each traced section to this directory, viewable in
+                TensorBoard. Defaults to None, no traces.
+            trace_sections (Sequence[str], optional): The sections to trace.
+                Defaults to ("train",).
+            trace_wait (int, optional): Steps skipped before tracing. Defaults to 1.
+            trace_warmup (int, optional): Steps traced but discarded while the
+                profiler warms up. Defaults to 1.
+            trace_active (int, optional): Steps recorded in the trace. Defaults
+                to 3.
+        """
+        self.synchronize = synchronize
+        self.trace_dir = trace_dir
+        self.trace_sections = tuple(trace_sections)
+        self.trace_schedule = (trace_wait, trace_warmup, trace_active)
+        self.sections = {}
+
+        self._phases = {}
+        self._traced = set()
+        self._trace = None
+        self._current = None
+        self._name = None
+        self._start = 0.0
+        self._cuda = False
+        self._dev = None
+
+    def start(self, section: str, dev: torch.device = None):
+        """
+        Start timing a run of a section, e.g. an epoch of training.
+
+        Args:
+            section (str): Name of the section.
+            dev (torch.device, optional): The device the loop runs on, used for
+                the gpu memory high-water mark. Defaults to the cpu.
+        """
+        self._name = section
+        self._current = {"samples": 0, "phases": defaultdict(float)}
+        self._cuda = (
+            dev is not None
+            and torch.device(dev).type == "cuda"
+            and torch.cuda.is_available()
+        )
+        self._dev = dev
+        if self._cuda:
+            torch.cuda.reset_peak_memory_stats(dev)
+
+        if (
+            self.trace_dir is not None
+            and section in self.trace_sections
+            and section not in self._traced
+        ):
+            self._traced.add(section)
+            self._trace = _torch_profile(self.trace_dir, section, self.trace_schedule)
+            self._trace.__enter__()
+
+        self._synchronize()
+        self._start = time.perf_counter()
+
+    def phase(self, name: str) -> _Phase:
+        """
+        A context manager timing a phase of the current section.
+        """
+        phase = self._phases.get(name)
+        if phase is None:
+            phase = self._phases[name] = _Phase(self, name)
+        return phase
+
+    def iterate(self, iterable):
+        """
+        Iterate over the batches of a loader, timing each fetch as the "data"
+        phase.
+        """
+        phase = self.phase("data")
+        iterator = iter(iterable)
+        while True:
+            with phase:
+                batch = next(iterator, _END)
+            if batch is _END:
+                return
+            yield batch
+
+    def step(self, samples: int):
+        """
+        Mark the end of a batch of ``samples`` samples.
+        """
+        self._current["samples"] += samples
+        if self._trace is not None:
+            self._trace.step()
+
+    def stop(self) -> dict:
+        """
+        Stop the run of the current section and add it to the section's totals.
+
+        Returns:
+            dict: The statistics of the run.
+        """
+        self._synchronize()
+        seconds = time.perf_counter() - self._start
+        if self._trace is not None:
+            self._trace.__exit__(None, None, None)
+            self._trace = None
+
+        run = self._current
+        run["seconds"] = seconds
+        run["phases"] = dict(run["phases"])
+        peak_rss_mb = _peak_rss_mb()
+        if peak_rss_mb is not None:
+            run["peak_rss_mb"] = peak_rss_mb
+        if self._cuda:
+            run["peak_cuda_mb"] = torch.cuda.max_memory_allocated(self._dev) / 2**20
+
+        totals = self.sections.setdefault(
+            self._name,
+            {"runs": 0, "samples": 0, "seconds": 0.0, "phases": defaultdict(float)},
+        )
+        totals["runs"] += 1
+        totals["samples"] += run["samples"]
+        totals["seconds"] += seconds
+        for name, phase_seconds in run["phases"].items():
+            totals["phases"][name] += phase_seconds
+        for key in ("peak_rss_mb", "peak_cuda_mb"):
+            if key in run:
+                totals[key] = max(totals.get(key, 0.0), run[key])
+
+        logger.debug("%s: %s", self._name, _format_section(run))
+        self._current = None
+
+        return run
+
+    def summary(self) -> dict:
+        """
+        The totals of each section, with the samples per second and the share of
+        the time spent in each phase.
+        """
+        summary = {}
+        for name, totals in self.sections.items():
+            seconds = totals["seconds"]
+            summary[name] = dict(
+                totals,
+                phases=dict(totals["phases"]),
+                samples_per_sec=totals["samples"] / seconds if seconds else 0.0,
+                phase_fractions={
+                    phase: phase_seconds / seconds if seconds else 0.0
+                    for phase, phase_seconds in totals["phases"].items()
+                },
+            )
+
+        return summary
+
+    def report(self) -> str:
+        """
+        A table of the time of each phase of each section.
+        """
+        lines = []
+        for name, section in self.summary().items():
+            lines.append("{}: {}".format(name, _format_section(section)))
+            for phase, phase_seconds in section["phases"].items():
+                lines.append(
+                    "    {:<12}{:>10.3f}s {:>6.1f}%".format(
+                        phase, phase_seconds, 100 * section["phase_fractions"][phase]
+                    )
+                )
+
+        return "\n".join(lines)
+
+    def _synchronize(self):
+        if self._cuda and self.synchronize:
+            torch.cuda.synchronize(self._dev)
+
+
+class NullProfiler:
+    """
+    A profiler that records nothing, used when profiling is disabled.
+    """
+
+    _phase = nullcontext()
+
+    def start(self, section: str, dev: torch.device = None):
+        pass
+
+    def phase(self, name: str):
+        return self._phase
+
+    def iterate(self, iterable):
+        return iterable
+
+    def step(self, samples: int):
+        pass
+
+    def stop(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def _torch_profile(trace_dir: str, section: str, trace_schedule: tuple):
+    wait, warmup, active = trace_schedule
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(
+            wait=wait, warmup=warmup, active=active, repeat=1
+        ),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(
+            trace_dir, worker_name=section
+        ),
+        record_shapes=True,
+        profile_memory=True,
+    )
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """
+    Peak resident memory of the process in MB, or None where the resource module
+    is not available, e.g. on Windows.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # ru_maxrss is in bytes on macOS and in kB elsewhere.
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _format_section(section: dict) -> str:
+    seconds = section["seconds"]
+    text = "{:.3f}s, {:,} samples, {:,.0f} samples/s".format(
+        seconds, section["samples"], section["samples"] / seconds if seconds else 0.0
+    )
+    if "peak_rss_mb" in section:
+        text += ", peak rss {:.0f}MB".format(section["peak_rss_mb"])
+    if "peak_cuda_mb" in section:
+        text += ", peak cuda {:.0f}MB".format(section["peak_cuda_mb"])
+
+    return text